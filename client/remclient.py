@@ -123,6 +123,11 @@ def _get_prefix(regexp):
     return regexp[:prefix_length] or None
 
 
+def _IsMethodNotSupported(fault, method):
+    """проверяет, что вызов завершился ошибкой из-за отсутствия метода на сервере (старая версия сервера)"""
+    return ('method "%s" is not supported' % method) in fault.faultString
+
+
 class DuplicatePackageNameException(Exception):
     def __init__(self, message, *args, **kwargs):
         super(DuplicatePackageNameException, self).__init__(*args, **kwargs)
@@ -183,7 +188,7 @@ class Queue(object):
         """возвращает краткую информацию о запущенных/выполненных задачах"""
         return self.proxy.queue_status(self.name)
 
-    def ListPackets(self, filter, name_regex=None, prefix=None):
+    def ListPackets(self, filter, name_regex=None, prefix=None, limit=None, cursor=None):
         """возвращает список пакетов из очереди, подпадающих под действие фильтра
         возможные значения парметра filter:
             all       - все пакеты
@@ -193,10 +198,16 @@ class Queue(object):
             pending   - пакеты с готовыми для выполнения задачами
             waiting   - пакеты, ожидающие таймаут, после возникшей ошибки
             working   - пакеты, работающие в данный момент
-        возвращается список объектов типа JobPacketInfo"""
+        пакеты упорядочены по именам
+        возвращается список объектов типа JobPacketInfo
+        если задан limit, то возвращается не больше limit пакетов и кортеж (список, cursor),
+        cursor передаётся в следующий вызов для получения следующей страницы (None - пакетов больше нет)"""
         assert filter in ("errored", "suspended", "worked", "waiting", "pending", "working", "all")
-        plist = self.proxy.queue_list(self.name, filter, name_regex, prefix)
-        return [JobPacketInfo(self.conn, pck_id) for pck_id in plist]
+        if limit is None:
+            plist = self.proxy.queue_list(self.name, filter, name_regex, prefix)
+            return [JobPacketInfo(self.conn, pck_id) for pck_id in plist]
+        page = self.proxy.queue_list(self.name, filter, name_regex, prefix, cursor, limit)
+        return [JobPacketInfo(self.conn, pck_id) for pck_id in page["packets"]], page["cursor"]
 
     def ChangeWorkingLimit(self, lmtValue):
         """изменяет runtime лимит - одновременно запущенных задач из очереди"""
@@ -207,11 +218,16 @@ class Queue(object):
            в случае, если очередь не пуста, то удаление не произойдёт и кинется исключение"""
         self.proxy.queue_delete(self.name)
 
-    def ListUpdated(self, last_modified, filter=None):
+    def ListUpdated(self, last_modified, filter=None, limit=None, cursor=None):
+        """возвращает список пакетов, изменённых не раньше last_modified, упорядоченный по времени изменения
+        параметры filter, limit и cursor аналогичны параметрам метода ListPackets"""
         if filter:
             assert filter in ("errored", "suspended", "worked", "waiting", "pending", "working", "all")
-        plist = self.proxy.queue_list_updated(self.name, last_modified, filter)
-        return [JobPacketInfo(self.conn, pck_id) for pck_id in plist]
+        if limit is None:
+            plist = self.proxy.queue_list_updated(self.name, last_modified, filter)
+            return [JobPacketInfo(self.conn, pck_id) for pck_id in plist]
+        page = self.proxy.queue_list_updated(self.name, last_modified, filter, cursor, limit)
+        return [JobPacketInfo(self.conn, pck_id) for pck_id in page["packets"]], page["cursor"]
 
     def SetSuccessLifeTime(self, lifetime):
         seconds = lifetime
@@ -243,7 +259,8 @@ class JobPacket(object):
         self.id = self.proxy.create_packet(name, priority, notify_emails, wait_tags, set_tag, kill_all_jobs_on_error, packet_name_policy, resetable)
 
     def AddJob(self, shell, parents=None, pipe_parents=None, set_tag=None, tries=DEFAULT_TRIES_COUNT, files=None, \
-               max_err_len=None, retry_delay=None, pipe_fail=False, description="", notify_timeout=NOTIFICATION_TIMEOUT, max_working_time=KILL_JOB_DEFAULT_TIMEOUT, output_to_status=False):
+               max_err_len=None, retry_delay=None, pipe_fail=False, description="", notify_timeout=NOTIFICATION_TIMEOUT, max_working_time=KILL_JOB_DEFAULT_TIMEOUT, output_to_status=False,
+               streaming=False, stream_tee=False):
         """добавляет задачу в пакет
         shell - коммандная строка, которую следует выполнить
         tries - количество попыток выполнения команды (в случае неуспеха команда перазапускается ограниченное число раз) (по умолчанию: 5)
@@ -254,14 +271,20 @@ class JobPacket(object):
         description - опциональный параметр, задающий человекочитамое имя джоба
         files - список файлов, которые нужно положить в рабочую директорию задания (рабочая директория у всех заданий внутри одного пакета одна и та же)
                можно вместо списка указать dictionary, в этом случае значение словаря будет указывать на путь до файла, а ключ на имя, с которым этот файл следует положить 
-               в рабочий каталог задания (реально в рабочем каталоге создаются symlink'и на файлы, располагающиеся в одной общей директории, куда копируются все бинарники)"""
+               в рабочий каталог задания (реально в рабочем каталоге создаются symlink'и на файлы, располагающиеся в одной общей директории, куда копируются все бинарники)
+        streaming - задание запускается одновременно со своим единственным pipe_parents заданием и читает его stdout через pipe,
+               без записи на диск; при ошибке любого задания такой цепочки перезапускается вся цепочка
+        stream_tee - при streaming дополнительно сохранять stdout родительского задания в файл (для отладки)"""
         parents = [job.id for job in parents or []]
         pipe_parents = [job.id for job in pipe_parents or []]
         if files is not None:
             self.AddFiles(files)
+        # streaming parameters are passed only if they are used, so old servers accept the call
+        streaming_args = (streaming, stream_tee) if streaming else ()
         return JobInfo(id=self.proxy.pck_add_job(self.id, shell, parents,
                        pipe_parents, set_tag, tries, max_err_len, retry_delay,
-                       pipe_fail, description, notify_timeout, max_working_time, output_to_status))
+                       pipe_fail, description, notify_timeout, max_working_time, output_to_status,
+                       *streaming_args))
 
     def AddJobsBulk(self, *jobs):
         """быстрое(batch) добавление задач в пакет
@@ -273,6 +296,7 @@ class JobPacket(object):
                 self.AddFiles(job["files"])
             parents = [pj.id for pj in job.get("parents", [])]
             pipe_parents = [pj.id for pj in job.get("pipe_parents", [])]
+            streaming_args = (True, job.get("stream_tee", False)) if job.get("streaming") else ()
             multicall.pck_add_job(self.id, job["shell"], parents, pipe_parents,
                                   job.get("set_tag", None),
                                   job.get("tries", self.DEFAULT_TRIES_COUNT),
@@ -282,7 +306,8 @@ class JobPacket(object):
                                   job.get("description", ""),
                                   job.get("notify_timeout", NOTIFICATION_TIMEOUT),
                                   job.get("max_working_time", KILL_JOB_DEFAULT_TIMEOUT),
-                                  job.get("output_to_status", False))
+                                  job.get("output_to_status", False),
+                                  *streaming_args)
         return multicall()
 
     def AddFiles(self, files, retries=1):
@@ -295,7 +320,9 @@ class JobPacketInfo(object):
     """прокси объект для манипулирования пакетом задач в REM
     Объекты этого класса не нужно создавать вручную, правильный способ их получать - метод Queue.ListPackets"""
     DEF_INFO_TIMEOUT = 1800
-    DEF_ATTRS = set(["pck_id", "proxy", "updStamp", "update", "__dict__", "Suspend", "Resume", "Restart", "RestartFromErrors", "Delete", "AddFiles", "multiupdate", "__setstatus__"])
+    FILE_CHUNK_SIZE = 4 << 20
+    WAIT_CALL_TIMEOUT = 300
+    DEF_ATTRS = set(["pck_id", "proxy", "updStamp", "update", "__dict__", "Suspend", "Resume", "Restart", "RestartFromErrors", "Delete", "AddFiles", "multiupdate", "__setstatus__", "Wait", "WAIT_CALL_TIMEOUT"])
 
     def __init__(self, connector, pck_id):
         self.pck_id = pck_id
@@ -326,7 +353,26 @@ class JobPacketInfo(object):
                 raise RuntimeError("multiupdate method can process only jobs from the same server")
         if first is None:
             return set()#nothing to do
-        multicall = xmlrpc_client.MultiCall(first.proxy)
+        try:
+            statuses = first.proxy.pck_status_bulk([obj.pck_id for obj in objects], None, True)
+        except xmlrpc_client.Fault as e:
+            if not _IsMethodNotSupported(e, "pck_status_bulk"):
+                raise
+            return cls._multiupdate_by_multicall(first.proxy, objects, verbose)
+        goodObjects = set()
+        for obj, pck_status in zip(objects, statuses):
+            if pck_status is None:
+                if verbose:
+                    print("nonexisted packet id: %s" % obj.pck_id, file=sys.stderr)
+                continue
+            obj.__setstatus__(pck_status)
+            goodObjects.add(obj)
+        return goodObjects
+
+    @classmethod
+    def _multiupdate_by_multicall(cls, proxy, objects, verbose):
+        """multiupdate для серверов без метода pck_status_bulk"""
+        multicall = xmlrpc_client.MultiCall(proxy)
         for obj in objects:
             multicall.pck_status(obj.pck_id)
         multicall_iterator = multicall()
@@ -346,6 +392,24 @@ class JobPacketInfo(object):
         """принудительный апдейт информации об объекте (xmlrpc-вызов)"""
         self.__setstatus__(self.proxy.pck_status(self.pck_id))
 
+    def Wait(self, states=("SUCCESSFULL", "ERROR"), timeout=None):
+        """ждёт перехода пакета в одно из состояний states (по умолчанию - завершение работы пакета)
+        ожидание происходит на стороне сервера, без периодического опроса состояния пакета
+        timeout - максимальное время ожидания в секундах (None - ждать без ограничения)
+        возвращает состояние пакета после ожидания"""
+        if isinstance(states, six.string_types):
+            states = (states, )
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            callTimeout = self.WAIT_CALL_TIMEOUT
+            if deadline is not None:
+                callTimeout = min(max(deadline - time.time(), 0), callTimeout)
+            state = self.proxy.pck_wait([self.pck_id], list(states), callTimeout)[self.pck_id]
+            if state in states or (deadline is not None and time.time() >= deadline):
+                break
+        self.update()
+        return self.state
+
     def Suspend(self, kill_jobs=False):
         """приостанавливает выполнение пакета"""
         if kill_jobs:
@@ -456,6 +520,13 @@ class JobPacketInfo(object):
                 raise AttributeError("can't find file \"%s\"" % fpath)
 
             checksum = self._GetFileChecksum(fpath, self.conn.checksumDbPath)
+            if os.path.getsize(fpath) >= self.conn.chunked_upload_threshold:
+                if not self._TryCheckBinaryAndLock(checksum, fpath):
+                    checksum = self._CalcFileChecksum(fpath)
+                    if not self._TryCheckBinaryAndLock(checksum, fpath):
+                        self._UploadFile(fpath, checksum)
+                self.proxy.pck_add_binary(self.pck_id, fname, checksum)
+                continue
             if not self._TryCheckBinaryAndLock(checksum, fpath):
                 data = open(fpath, 'rb').read()
                 checksum2 = hashlib.md5(data).hexdigest()
@@ -465,6 +536,22 @@ class JobPacketInfo(object):
 
             self.proxy.pck_add_binary(self.pck_id, fname, checksum)
 
+    def _UploadFile(self, path, checksum):
+        """загружает файл на сервер частями по conn.upload_chunk_size байт,
+        если предыдущая загрузка файла была прервана, то она продолжается с места остановки"""
+        # offsets are passed as strings (xmlrpc integers are limited by 2^31 - 1)
+        offset = int(self.proxy.binary_upload_begin(checksum))
+        if offset < 0:
+            return
+        with open(path, "rb") as reader:
+            reader.seek(offset)
+            while True:
+                chunk = reader.read(self.conn.upload_chunk_size)
+                if not chunk:
+                    break
+                offset = int(self.proxy.binary_upload_append(checksum, str(offset), xmlrpc_client.Binary(chunk)))
+        self.proxy.binary_upload_commit(checksum)
+
     def AddFiles(self, files, retries=1):
         return _RetriableMethod(self._AddFiles, retries, True, AttributeError)(files)
 
@@ -476,6 +563,26 @@ class JobPacketInfo(object):
         data = binary.data
         return data
 
+    def ReadFile(self, filename, offset=0, length=None, tail=None):
+        """читает часть файла из рабочей директории пакета
+        offset - смещение начала читаемого куска, length - его длина (сервер ограничивает длину куска)
+        tail - если задан, то читается кусок, начинающийся за tail байт до конца файла
+        возвращается кортеж (данные, смещение начала данных, текущий размер файла)"""
+        # offsets and sizes are passed as strings (xmlrpc integers are limited by 2^31 - 1)
+        part = self.proxy.pck_get_file(self.pck_id, filename, str(offset), length and str(length),
+                                       tail and str(tail))
+        return part["data"].data, int(part["offset"]), int(part["size"])
+
+    def IterFile(self, filename, offset=0, chunk_size=FILE_CHUNK_SIZE):
+        """итератор по кускам файла из рабочей директории пакета, начиная со смещения offset
+        (для чтения дописываемого файла следующий вызов можно начинать с offset, равного прочитанному размеру)"""
+        while True:
+            data, offset, _ = self.ReadFile(filename, offset, chunk_size)
+            if not data:
+                return
+            offset += len(data)
+            yield data
+
     def GetWorkingTime(self):
         def get_res_working_time(res):
             fmtTime = "%Y/%m/%d %H:%M:%S"
@@ -539,18 +646,27 @@ class Tag(object):
         """проверяет, установлен ли данный тэг"""
         return self.proxy.check_tag(self.name)
 
-    def Set(self):
-        """устанавливает тэг"""
+    def Set(self, durable=False):
+        """устанавливает тэг
+        durable - дождаться записи события в журнал сервера"""
+        if durable:
+            return self.proxy.set_tag(self.name, True)
         return self.proxy.set_tag(self.name)
 
-    def Unset(self):
-        """сбрасывает тэг"""
+    def Unset(self, durable=False):
+        """сбрасывает тэг
+        durable - дождаться записи события в журнал сервера"""
+        if durable:
+            return self.proxy.unset_tag(self.name, True)
         return self.proxy.unset_tag(self.name)
 
-    def Reset(self, message=""):
-        """сброс тэга и остановка всех зависящих от него пакетов"""
+    def Reset(self, message="", durable=False):
+        """сброс тэга и остановка всех зависящих от него пакетов
+        durable - дождаться записи события в журнал сервера"""
         if not message:
             logging.warning("Reset without useful reason is deprecated")
+        if durable:
+            return self.proxy.reset_tag(self.name, message, True)
         return self.proxy.reset_tag(self.name, message)
 
     def ListDependentPackets(self):
@@ -571,11 +687,13 @@ class TagsBulk(object):
             self.tags = []
 
     def Check(self):
-        multicall = xmlrpc_client.MultiCall(self.conn.proxy)
-        for tag in self.tags:
-            multicall.check_tag(tag)
-        multicall_iterator = multicall()
-        self.states = dict(list(zip(self.tags, multicall_iterator)))
+        try:
+            states = self.conn.proxy.check_tags(self.tags)
+        except xmlrpc_client.Fault as e:
+            if not _IsMethodNotSupported(e, "check_tags"):
+                raise
+            states = self._multicall("check_tag")
+        self.states = dict(zip(self.tags, states))
 
     def FilterSet(self):
         self.Check()
@@ -586,21 +704,29 @@ class TagsBulk(object):
         return TagsBulk(self.conn, [x for x in self.tags if not self.states[x]])
 
     def Set(self):
-        multicall = xmlrpc_client.MultiCall(self.conn.proxy)
-        for obj in self.tags:
-            multicall.set_tag(obj)
-        return multicall()
+        return self._bulkcall("set_tags", "set_tag")
 
     def Unset(self):
-        multicall = xmlrpc_client.MultiCall(self.conn.proxy)
-        for obj in self.tags:
-            multicall.unset_tag(obj)
-        return multicall()
+        return self._bulkcall("unset_tags", "unset_tag")
 
     def Reset(self):
+        return self._bulkcall("reset_tags", "reset_tag")
+
+    def _bulkcall(self, method, single_method):
+        """групповой вызов method для всех тэгов, для старых серверов - MultiCall вызовов single_method,
+        результат в обоих случаях - последовательность результатов вызовов single_method"""
+        try:
+            getattr(self.conn.proxy, method)(self.tags)
+        except xmlrpc_client.Fault as e:
+            if not _IsMethodNotSupported(e, method):
+                raise
+            return self._multicall(single_method)
+        return [None] * len(self.tags)
+
+    def _multicall(self, method):
         multicall = xmlrpc_client.MultiCall(self.conn.proxy)
-        for obj in self.tags:
-            multicall.reset_tag(obj)
+        for tag in self.tags:
+            getattr(multicall, method)(tag)
         return multicall()
 
     def GetTags(self):
@@ -610,13 +736,20 @@ class TagsBulk(object):
 class Connector(object):
     """объект коннектор, для работы с REM"""
 
-    def __init__(self, url, conn_retries=5, verbose=False, checksumDbPath=None, packet_name_policy=DEFAULT_DUPLICATE_NAMES_POLICY, logger_name=None):
+    CHUNKED_UPLOAD_THRESHOLD = 64 << 20
+    UPLOAD_CHUNK_SIZE = 16 << 20
+
+    def __init__(self, url, conn_retries=5, verbose=False, checksumDbPath=None, packet_name_policy=DEFAULT_DUPLICATE_NAMES_POLICY, logger_name=None,
+                 chunked_upload_threshold=CHUNKED_UPLOAD_THRESHOLD, upload_chunk_size=UPLOAD_CHUNK_SIZE):
         """конструктор коннектора
-        принимает один параметр - url REM сервера"""
+        принимает один параметр - url REM сервера
+        файлы размером не меньше chunked_upload_threshold байт загружаются на сервер частями по upload_chunk_size байт"""
         self.proxy = RetriableXMLRPCProxy(url, tries=conn_retries, verbose=verbose, allow_none=True)
         self.verbose = verbose
         self.checksumDbPath = checksumDbPath
         self.packet_name_policy = packet_name_policy
+        self.chunked_upload_threshold = chunked_upload_threshold
+        self.upload_chunk_size = upload_chunk_size
         if logger_name is None:
             self.logger = logging.getLogger('remclient.default')
         else:
@@ -671,6 +804,18 @@ class Connector(object):
             prefix = _get_prefix(name_regex)
         return fn(name_regex, prefix, memory_only)
 
+    def ListTags(self, name_regex=None, prefix=None, memory_only=True, limit=None, cursor=None):
+        """возвращает список пар (имя тэга, состояние) для тэгов, подпадающих под name_regex и prefix
+        memory_only=False - включать тэги, сохранённые на диск
+        если задан limit, то возвращается кортеж (список не длиннее limit тэгов, упорядоченных по именам, cursor),
+        cursor передаётся в следующий вызов для получения следующей страницы (None - тэгов больше нет)"""
+        if prefix is None and name_regex:
+            prefix = _get_prefix(name_regex)
+        if limit is None:
+            return self.proxy.list_tags(name_regex, prefix, memory_only)
+        page = self.proxy.list_tags(name_regex, prefix, memory_only, cursor, limit)
+        return page["tags"], page["cursor"]
+
     def PacketInfo(self, packet):
         """возвращает объект для манипуляций с пакетом (см. класс JobPacketInfo)
         принимает один параметр - объект типа JobPacket"""
@@ -681,6 +826,37 @@ class Connector(object):
             raise RuntimeError("can't create PacketInfo instance from %r" % packet)
         return JobPacketInfo(self, pck_id)
 
+    def PacketsStatus(self, packets, fields=None, include_jobs=False):
+        """возвращает словарь pck_id -> статус для списка пакетов (объекты JobPacket, JobPacketInfo или id)
+        fields - список полей статуса (например ["state", "last_modified"]), None - все поля
+        информация о задачах возвращается только при include_jobs=True
+        несуществующие пакеты в результат не попадают"""
+        pck_ids = [pck.pck_id if isinstance(pck, JobPacketInfo) else pck.id if isinstance(pck, JobPacket) else pck
+                   for pck in packets]
+        statuses = self.proxy.pck_status_bulk(pck_ids, fields, include_jobs)
+        return dict((pck_id, status) for pck_id, status in zip(pck_ids, statuses) if status is not None)
+
+    def QueryPackets(self, queue=None, state=None, name_prefix=None, modified_since=None, fields=None,
+                     include_jobs=False):
+        """возвращает список статусов пакетов, удовлетворяющих всем заданным условиям
+            queue          - имя очереди (None - все очереди)
+            state          - состояние пакета или список состояний ("PENDING", "ERROR", ...)
+            name_prefix    - префикс имени пакета
+            modified_since - время последнего изменения не раньше заданного
+        параметры fields и include_jobs аналогичны параметрам метода PacketsStatus
+        каждый статус содержит поле id - идентификатор пакета"""
+        return self.proxy.pck_status_query(queue, state, name_prefix, modified_since, fields, include_jobs)
+
+    def ReadEvents(self, cursor=None, limit=None):
+        """возвращает события сервера (изменения состояний пакетов, запуски и завершения задач, изменения тэгов),
+        произошедшие после cursor, в виде кортежа (список событий, cursor для следующего вызова, reset)
+        cursor=None - начать чтение с текущего момента (возвращается пустой список событий)
+        reset=True означает, что часть событий потеряна (cursor устарел или сервер был перезапущен),
+        и состояние нужно перечитать полностью; события возвращаются начиная с самого старого из сохранённых
+        каждое событие - словарь с полями time, type, id (пакета или тэга) и дополнительными полями типа события"""
+        page = self.proxy.read_events(cursor, limit)
+        return page["events"], page["cursor"], page["reset"]
+
     def TagsBulk(self, *args, **kws):
         return TagsBulk(self, *args, **kws)
 
@@ -3,20 +3,15 @@ from __future__ import with_statement
 import logging
 import os
 import re
-import select
 import signal
-import socket
 import time
-import threading
-from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
-from SocketServer import ThreadingMixIn
-import Queue as StdQueue
 import xmlrpclib
 import datetime
 
-from rem import constants, osspec
+from rem import constants, launcher, osspec, waiters
+from rem.rpcserver import XMLRPCServer, detachable_method
 from rem import traced_rpc_method
-from rem import CheckEmailAddress, DefaultContext, JobPacket, PacketState, Scheduler, ThreadJobWorker, TimeTicker, XMLRPCWorker
+from rem import CheckEmailAddress, DefaultContext, JobPacket, PacketState, Scheduler, ThreadJobWorker, SchedTimer
 
 class DuplicatePackageNameException(Exception):
     def __init__(self, pck_name, serv_name, *args, **kwargs):
@@ -24,44 +19,13 @@ class DuplicatePackageNameException(Exception):
         self.message = 'DuplicatePackageNameException: Packet with name %s already exists in REM[%s]' % (pck_name, serv_name)
 
 
-class AsyncXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
-    def __init__(self, poolsize, *args, **kws):
-        if socket.has_ipv6:
-            self.address_family = socket.AF_INET6
-        SimpleXMLRPCServer.__init__(self, *args, **kws)
-        self.poolsize = poolsize
-        self.requests = StdQueue.Queue(poolsize)
-
-    def handle_request(self):
-        try:
-            request = self.get_request()
-        except socket.error:
-            logging.error("XMLRPCServer: socket error")
-            return
-        if self.verify_request(*request):
-            self.requests.put(request)
-
-
-class AuthRequestHandler(SimpleXMLRPCRequestHandler):
-    def _dispatch(self, method, params):
-        func = self.server.funcs.get(method)
-        if not func:
-            raise Exception('method "%s" is not supported' % method)
-        username = self.headers.get("X-Username", "Unknown")
-        log_level = getattr(func, "log_level", None)
-        log_func = getattr(logging, log_level, None) if log_level else None
-        if callable(log_func):
-            log_func("RPC method (user: %s, host: %s): %s %r", username, self.address_string(), method, params)
-        return func(*params)
-
-
 _scheduler = None
 _context = None
 
 def bind1st(f, arg):
     return lambda *args, **kwargs: f(arg, *args, **kwargs)
 
-def CreateScheduler(context, canBeClear=False, restorer=None):
+def CreateScheduler(context, canBeClear=False, restorer=None, background=False):
     sched = Scheduler(context)
     wasRestoreTry = False
     if restorer:
@@ -71,7 +35,7 @@ def CreateScheduler(context, canBeClear=False, restorer=None):
             if sched.CheckBackupFilename(name):
                 backupFile = os.path.join(context.backup_directory, name)
                 try:
-                    sched.LoadBackup(backupFile, restorer)
+                    sched.LoadBackup(backupFile, restorer, background)
                     return sched
                 except Exception, e:
                     logging.exception("can't restore from file \"%s\" : %s", backupFile, e)
@@ -107,7 +71,8 @@ def create_packet(packet_name, priority, notify_emails, wait_tagnames, set_tag,
 
 @traced_rpc_method()
 def pck_add_job(pck_id, shell, parents, pipe_parents, set_tag, tries,
-                max_err_len=None, retry_delay=None, pipe_fail=False, description="", notify_timeout=constants.NOTIFICATION_TIMEOUT, max_working_time=constants.KILL_JOB_DEFAULT_TIMEOUT, output_to_status=False):
+                max_err_len=None, retry_delay=None, pipe_fail=False, description="", notify_timeout=constants.NOTIFICATION_TIMEOUT, max_working_time=constants.KILL_JOB_DEFAULT_TIMEOUT, output_to_status=False,
+                streaming=False, stream_tee=False):
     pck = _scheduler.tempStorage.GetPacket(pck_id)
     if pck is not None:
         if isinstance(shell, unicode):
@@ -115,7 +80,8 @@ def pck_add_job(pck_id, shell, parents, pipe_parents, set_tag, tries,
         parents = [pck.jobs[int(jid)] for jid in parents]
         pipe_parents = [pck.jobs[int(jid)] for jid in pipe_parents]
         job = pck.Add(shell, parents, pipe_parents, _scheduler.tagRef.AcquireTag(set_tag), tries, \
-                      max_err_len, retry_delay, pipe_fail, description, notify_timeout, max_working_time, output_to_status)
+                      max_err_len, retry_delay, pipe_fail, description, notify_timeout, max_working_time, output_to_status,
+                      streaming, stream_tee)
         return str(job.id)
     raise AttributeError("nonexisted packet id: %s" % pck_id)
 
@@ -139,8 +105,7 @@ def pck_moveto_queue(pck_id, src_queue, dst_queue):
     if pck is not None:
         if pck.state not in (PacketState.CREATED, PacketState.SUSPENDED, PacketState.ERROR):
             raise RuntimeError("can't move \"live\" packet between queues")
-        _scheduler.Queue(src_queue).Remove(pck)
-        _scheduler.Queue(dst_queue).Add(pck)
+        _scheduler.MovePacketToQueue(pck, src_queue, dst_queue)
         return
     raise AttributeError("nonexisted packet id: %s" % pck_id)
 
@@ -152,19 +117,54 @@ def check_tag(tagname):
 
 
 @traced_rpc_method("info")
-def set_tag(tagname):
-    return _scheduler.tagRef.SetTag(tagname)
+def set_tag(tagname, durable=False):
+    ret = _scheduler.tagRef.SetTag(tagname)
+    if durable:
+        _scheduler.tagRef.tag_logger.Sync()
+    return ret
 
 
 @traced_rpc_method("info")
-def unset_tag(tagname):
-    return _scheduler.tagRef.UnsetTag(tagname)
+def unset_tag(tagname, durable=False):
+    ret = _scheduler.tagRef.UnsetTag(tagname)
+    if durable:
+        _scheduler.tagRef.tag_logger.Sync()
+    return ret
+
+
+@readonly_method
+@traced_rpc_method()
+def check_tags(tagnames):
+    return _scheduler.tagRef.CheckTags(tagnames)
+
+
+@traced_rpc_method("info")
+def set_tags(tagnames, durable=False):
+    _scheduler.tagRef.SetTags(tagnames)
+    if durable:
+        _scheduler.tagRef.tag_logger.Sync()
+
+
+@traced_rpc_method("info")
+def unset_tags(tagnames, durable=False):
+    _scheduler.tagRef.UnsetTags(tagnames)
+    if durable:
+        _scheduler.tagRef.tag_logger.Sync()
+
+
+@traced_rpc_method()
+def reset_tags(tagnames, message="", durable=False):
+    _scheduler.tagRef.ResetTags(tagnames, message)
+    if durable:
+        _scheduler.tagRef.tag_logger.Sync()
 
 
 @traced_rpc_method()
-def reset_tag(tagname, message=""):
+def reset_tag(tagname, message="", durable=False):
     tag = _scheduler.tagRef.AcquireTag(tagname)
     tag.Reset(message)
+    if durable:
+        _scheduler.tagRef.tag_logger.Sync()
 
 
 @readonly_method
@@ -192,17 +192,27 @@ def queue_status(queue_name):
 
 @readonly_method
 @traced_rpc_method()
-def queue_list(queue_name, filter, name_regex=None, prefix=None):
+def queue_list(queue_name, filter, name_regex=None, prefix=None, cursor=None, limit=None):
     name_regex = name_regex and re.compile(name_regex)
     q = _scheduler.Queue(queue_name, create=False)
-    return [pck.id for pck in q.ListPackets(filter=filter, name_regex=name_regex, prefix=prefix)]
+    return _packets_page(q.ListPacketsPage(filter=filter, name_regex=name_regex, prefix=prefix,
+                                           cursor=cursor, limit=limit), limit)
 
 
 @readonly_method
 @traced_rpc_method()
-def queue_list_updated(queue_name, last_modified, filter=None):
+def queue_list_updated(queue_name, last_modified, filter=None, cursor=None, limit=None):
     q = _scheduler.Queue(queue_name, create=False)
-    return [pck.id for pck in q.ListPackets(last_modified=last_modified, filter=filter)]
+    return _packets_page(q.ListPacketsPage(last_modified=last_modified, filter=filter,
+                                           cursor=cursor, limit=limit), limit)
+
+
+def _packets_page(page, limit):
+    packets, cursor = page
+    ids = [pck.id for pck in packets]
+    if limit is None:
+        return ids
+    return {"packets": ids, "cursor": cursor}
 
 
 @traced_rpc_method("info")
@@ -217,9 +227,12 @@ def queue_delete(queue_name):
 
 @readonly_method
 @traced_rpc_method()
-def list_tags(name_regex=None, prefix=None, memory_only=True):
+def list_tags(name_regex=None, prefix=None, memory_only=True, cursor=None, limit=None):
     name_regex = name_regex and re.compile(name_regex)
-    return list(set(_scheduler.tagRef.ListTags(name_regex, prefix, memory_only)))
+    if limit is None:
+        return list(_scheduler.tagRef.ListTags(name_regex, prefix, memory_only))
+    tags, cursor = _scheduler.tagRef.ListTagsPage(name_regex, prefix, memory_only, cursor, limit)
+    return {"tags": tags, "cursor": cursor}
 
 
 @readonly_method
@@ -240,6 +253,84 @@ def pck_status(pck_id):
     raise AttributeError("nonexisted packet id: %s" % pck_id)
 
 
+def _status_row(pck, fields, include_jobs):
+    """packet status reduced to the requested fields, all fields except jobs are returned if fields is None"""
+    status = pck.Status()
+    if fields is None:
+        row = status
+        if not include_jobs:
+            row.pop("jobs", None)
+    else:
+        row = dict((field, status[field]) for field in fields if field in status)
+        if include_jobs and "jobs" in status:
+            row["jobs"] = status["jobs"]
+    row["id"] = pck.id
+    return row
+
+
+@readonly_method
+@traced_rpc_method()
+def pck_status_bulk(pck_ids, fields=None, include_jobs=False):
+    """returns list of statuses in the order of pck_ids, None for nonexisted packets"""
+    rows = []
+    for pck_id in pck_ids:
+        pck = _scheduler.GetPacket(pck_id) or _scheduler.tempStorage.GetPacket(pck_id)
+        rows.append(_status_row(pck, fields, include_jobs) if pck is not None else None)
+    return rows
+
+
+@readonly_method
+@traced_rpc_method()
+def pck_status_query(queue_name=None, state=None, name_prefix=None, modified_since=None, fields=None,
+                     include_jobs=False):
+    """returns statuses of queued packets matching all given conditions,
+    state - packet state or list of states, packets of every queue are checked if queue_name is None"""
+    if queue_name is not None:
+        queues = [_scheduler.Queue(queue_name, create=False)]
+    else:
+        queues = [q for _, q in sorted(_scheduler.qRef.items())]
+    states = None
+    if state:
+        states = frozenset([state] if isinstance(state, basestring) else state)
+    rows = []
+    for q in queues:
+        packets, _ = q.ListPacketsPage(prefix=name_prefix, last_modified=modified_since)
+        for pck in packets:
+            if states is None or pck.state in states:
+                rows.append(_status_row(pck, fields, include_jobs))
+    return rows
+
+
+@readonly_method
+@detachable_method
+@traced_rpc_method()
+def pck_wait(pck_ids, states=None, timeout=None, detach=None):
+    """waits until any of packets reaches one of states (finish states by default) or timeout expires,
+    returns dict of packets states; the states are returned at once if the call isn't detachable (multicall)"""
+    packets = []
+    for pck_id in pck_ids:
+        pck = _scheduler.GetPacket(pck_id) or _scheduler.tempStorage.GetPacket(pck_id)
+        if pck is None:
+            raise AttributeError("nonexisted packet id: %s" % pck_id)
+        packets.append(pck)
+    states = frozenset(states or (PacketState.SUCCESSFULL, PacketState.ERROR))
+    if timeout is None or timeout > constants.MAX_PACKET_WAIT_TIME:
+        timeout = constants.MAX_PACKET_WAIT_TIME
+    wait = waiters.PacketsWait(packets, states, time.time() + timeout, None)
+    if detach is None or timeout <= 0 or wait.IsReady():
+        return wait.Result()
+    wait.respond = detach()
+    waiters.GetWaiter().Add(wait)
+
+
+@readonly_method
+@traced_rpc_method()
+def read_events(cursor=None, limit=None):
+    """returns scheduler events after cursor (see rem.events), cursor None means the end of the feed"""
+    events, cursor, reset = _scheduler.eventsFeed.Read(cursor, limit)
+    return {"events": events, "cursor": cursor, "reset": reset}
+
+
 @traced_rpc_method("info")
 def pck_suspend(pck_id, kill_jobs=False):
     pck = _scheduler.GetPacket(pck_id)
@@ -287,6 +378,22 @@ def save_binary(bindata):
     _scheduler.binStorage.CreateFile(bindata.data)
 
 
+@traced_rpc_method("info")
+def binary_upload_begin(checksum):
+    # offsets and sizes are passed as strings, xmlrpclib can't marshal integers greater than 2^31 - 1
+    return str(_scheduler.binStorage.BeginUpload(checksum))
+
+
+@traced_rpc_method()
+def binary_upload_append(checksum, offset, bindata):
+    return str(_scheduler.binStorage.AppendUpload(checksum, int(offset), bindata.data))
+
+
+@traced_rpc_method("info")
+def binary_upload_commit(checksum):
+    return _scheduler.binStorage.CommitUpload(checksum)
+
+
 @traced_rpc_method("info")
 def check_binary_and_lock(checksum, localPath, tryLock=None):
     if tryLock is None:
@@ -318,11 +425,16 @@ def pck_list_files(pck_id):
 
 @readonly_method
 @traced_rpc_method()
-def pck_get_file(pck_id, filename):
+def pck_get_file(pck_id, filename, offset=None, length=None, tail=None):
     pck = _scheduler.GetPacket(pck_id)
     if pck is not None:
-        file = pck.GetFile(filename)
-        return xmlrpclib.Binary(file)
+        if offset is None and length is None and tail is None:
+            file = pck.GetFile(filename)
+            return xmlrpclib.Binary(file)
+        # offsets and sizes are passed as strings, xmlrpclib can't marshal integers greater than 2^31 - 1
+        data, offset, size = pck.GetFileRange(filename, int(offset or 0), length and int(length),
+                                              tail and int(tail))
+        return {"data": xmlrpclib.Binary(data), "offset": str(offset), "size": str(size)}
     raise AttributeError("nonexisted packet id: %s" % pck_id)
 
 
@@ -357,6 +469,12 @@ def get_backupable_state():
     return {"backup-flag": _scheduler.backupable, "child-flag": _scheduler.backupInChild}
 
 
+@readonly_method
+@traced_rpc_method()
+def get_restore_progress():
+    return _scheduler.RestoreProgress()
+
+
 @traced_rpc_method("warning")
 def do_backup():
     return _scheduler.RollBackup(force=True, child_max_working_time=None)
@@ -366,7 +484,7 @@ class RemServer(object):
         self.scheduler = scheduler
         self.readonly = readonly
         self.allow_backup_method = allow_backup_method
-        self.rpcserver = AsyncXMLRPCServer(poolsize, ("", port), AuthRequestHandler, allow_none=True)
+        self.rpcserver = XMLRPCServer(poolsize, ("", port), allow_none=True)
         self.rpcserver.register_multicall_functions()
         self.register_all_functions()
 
@@ -393,6 +511,10 @@ class RemServer(object):
         self.register_function(set_tag, "set_tag")
         self.register_function(unset_tag, "unset_tag")
         self.register_function(reset_tag, "reset_tag")
+        self.register_function(check_tags, "check_tags")
+        self.register_function(set_tags, "set_tags")
+        self.register_function(unset_tags, "unset_tags")
+        self.register_function(reset_tags, "reset_tags")
         self.register_function(get_dependent_packets_for_tag, "get_dependent_packets_for_tag")
         self.register_function(queue_suspend, "queue_suspend")
         self.register_function(queue_resume, "queue_resume")
@@ -404,12 +526,19 @@ class RemServer(object):
         self.register_function(list_tags, "list_tags")
         self.register_function(list_queues, "list_queues")
         self.register_function(pck_status, "pck_status")
+        self.register_function(pck_status_bulk, "pck_status_bulk")
+        self.register_function(pck_status_query, "pck_status_query")
+        self.register_function(pck_wait, "pck_wait")
+        self.register_function(read_events, "read_events")
         self.register_function(pck_suspend, "pck_suspend")
         self.register_function(pck_resume, "pck_resume")
         self.register_function(pck_delete, "pck_delete")
         self.register_function(pck_reset, "pck_reset")
         self.register_function(check_binary_exist, "check_binary_exist")
         self.register_function(save_binary, "save_binary")
+        self.register_function(binary_upload_begin, "binary_upload_begin")
+        self.register_function(binary_upload_append, "binary_upload_append")
+        self.register_function(binary_upload_commit, "binary_upload_commit")
         self.register_function(check_binary_and_lock, "check_binary_and_lock")
         self.register_function(pck_add_binary, "pck_add_binary")
         self.register_function(pck_list_files, "pck_list_files")
@@ -418,28 +547,15 @@ class RemServer(object):
         self.register_function(queue_set_error_lifetime, "queue_set_error_lifetime")
         self.register_function(set_backupable_state, "set_backupable_state")
         self.register_function(get_backupable_state, "get_backupable_state")
+        self.register_function(get_restore_progress, "get_restore_progress")
         if self.allow_backup_method:
             self.register_function(do_backup, "do_backup")
 
-    def request_processor(self):
-        rpc_fd = self.rpcserver.fileno()
-        while self.alive:
-            rout, _, _ = select.select((rpc_fd,), (), (), 0.01)
-            if rpc_fd in rout:
-                self.rpcserver.handle_request()
-
     def start(self):
-        self.xmlrpcworkers = [XMLRPCWorker(self.rpcserver.requests, self.rpcserver.process_request_thread)
-                              for _ in xrange(self.rpcserver.poolsize)]
-        self.alive = True
-        self.main_thread = threading.Thread(target=self.request_processor)
-        for worker in self.xmlrpcworkers:
-            worker.start()
-        self.main_thread.start()
+        self.rpcserver.Start()
 
     def stop(self):
-        self.alive = False
-        map(lambda worker: worker.Kill(), self.xmlrpcworkers)
+        self.rpcserver.Stop()
 
 
 class RemDaemon(object):
@@ -482,6 +598,10 @@ class RemDaemon(object):
                 server.stop()
             if self.timeWorker:
                 self.timeWorker.Kill()
+            self.scheduler.tagsEvictor.Kill()
+            # already set tags are delivered to packets before the final backup
+            self.scheduler.tagsDispatcher.Kill()
+            self.scheduler.tagsDispatcher.join()
             self.scheduler.Stop()
             for method in [ThreadJobWorker.Suspend, ThreadJobWorker.Kill, ThreadJobWorker.join]:
                 for worker in self.regWorkers:
@@ -499,9 +619,8 @@ class RemDaemon(object):
         self.permitFinalBackup = False
         self.scheduler.Start()
         self.regWorkers = [ThreadJobWorker(self.scheduler) for _ in xrange(self.scheduler.poolSize)]
-        self.timeWorker = TimeTicker()
-        self.timeWorker.AddCallbackListener(self.scheduler.schedWatcher)
-        for worker in self.regWorkers + [self.timeWorker]:
+        self.timeWorker = SchedTimer(self.scheduler.schedWatcher)
+        for worker in self.regWorkers + [self.timeWorker, self.scheduler.tagsEvictor, self.scheduler.tagsDispatcher]:
             worker.start()
 
     def start(self):
@@ -582,7 +701,11 @@ def scheduler_test():
 if __name__ == "__main__":
     _context = DefaultContext()
     osspec.set_process_title("[remd]%s" % ((" at " + _context.network_name) if _context.network_name else ""))
-    _scheduler = CreateScheduler(_context)
+    if _context.use_jobs_launcher and _context.execMode == "start":
+        # helper is forked before backup loading while the heap is still small
+        launcher.StartLauncher()
+    # in daemon mode queues are restored in background while RPC is already served
+    _scheduler = CreateScheduler(_context, background=_context.execMode == "start")
     if _context.execMode == "test":
         scheduler_test()
     elif _context.execMode == "start":
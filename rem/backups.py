@@ -0,0 +1,728 @@
+"""scheduler snapshots, incremental (delta) backups and packets journal support
+
+All files are sequences of records, every record is marshalled independently and
+prefixed with its length, so broken record doesn't prevent reading of the next ones.
+Objects in records are encoded by schemas from snapshot module, record is pickled entirely
+if it can't be marshalled (such records start with pickle protocol mark).
+Snapshot file starts with SNAPSHOT_MAGIC (or COMPRESSED_SNAPSHOT_MAGIC if the rest of file is
+compressed by zlib) and contains records:
+    ("snapshot", info)         - format version and numbers of queues and packets
+    ("storages", storages)     - binStorage and connManager
+    ("tags", tags)             - list of (name, tag) pairs, tags are saved without packets listeners
+    ("temp", tempStorage)      - packets that are not in queues yet
+    ("queue", queue)           - one record per queue, queue is saved without packets
+    ("packets", packets)       - group of packets of the previous queue
+    ("trailer", info)          - crc32 and size of all previous (uncompressed) data
+Delta backup contains only packets changed since the previous backup and is applied
+over the full scheduler snapshot it is based on. Packets journal is written between backups
+and is replayed over the last applied backup. Their records are:
+    ("queues", settings)       - settings of all existing queues
+    ("storages", storages)     - binStorage and connManager (saved entirely)
+    ("temp", tempStorage)      - tempStorage (saved entirely)
+    ("packet", id, qname, pck) - changed packet, qname and pck are None for removed packets
+Delta file contains all of them, journal contains only queues and packets records.
+References between records (queues, binary files, tags, packets names tracker) are saved by name.
+Old backups made as one pickled objects graph are loaded by Scheduler.loadOldBackup and are saved
+in this format by the next backup."""
+from __future__ import with_statement
+import cPickle
+import contextlib
+import cStringIO
+import gc
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+import zlib
+
+import fork_locking
+from callbacks import ICallbackAcceptor, Tag, RemoteTag
+from common import BinaryFile
+from job import Job
+from packet import JobPacket, PacketState
+from queue import Queue
+from snapshot import ObjectsEncoder, ObjectsDecoder, EncodeTags, DecodeTags, EncodeQueue, EncodeQueuePackets, \
+    DecodeQueuePackets, RestoreQueuePackets
+from storages import PacketNamesStorage, TagWrapper
+
+__all__ = ["ChangesTracker", "PacketJournal", "DeltaWriter", "DeltaReader", "SnapshotWriter", "SnapshotReader",
+           "SnapshotOutput", "SnapshotInput", "ValidateSnapshot", "ResetsCollector", "IsSnapshotFile", "GetPacketQueue", "LinkTags", "UnlinkTags", "RelinkTags"]
+
+SNAPSHOT_MAGIC = "REM-SNAPSHOT\n"
+COMPRESSED_SNAPSHOT_MAGIC = "REM-SNAPSHOT-ZLIB\n"
+SNAPSHOT_VERSION = 4
+# every supported snapshot has a trailer, old pickled backups are not snapshots at all
+SUPPORTED_SNAPSHOT_VERSIONS = (SNAPSHOT_VERSION,)
+PICKLE_MARK = "\x80"
+RECORD_HEADER = struct.Struct(">Q")
+
+
+def GetPacketQueue(pck):
+    for obj in pck.callbacks.keys():
+        if isinstance(obj, Queue):
+            return obj
+    return None
+
+
+def readMagic(stream):
+    magic = stream.read(len(SNAPSHOT_MAGIC))
+    if magic != SNAPSHOT_MAGIC:
+        magic += stream.read(len(COMPRESSED_SNAPSHOT_MAGIC) - len(magic))
+    return magic
+
+
+def IsSnapshotFile(filename):
+    with open(filename, "rb") as stream:
+        return readMagic(stream) in (SNAPSHOT_MAGIC, COMPRESSED_SNAPSHOT_MAGIC)
+
+
+class SnapshotOutput(object):
+    """writes snapshot directly to file through the buffer of limited size,
+    data is compressed on the fly if compression_level is set,
+    crc32 and size of written (uncompressed) data are kept for the trailer"""
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, filename, compression_level=0):
+        self.file = open(filename, "wb", self.BUFFER_SIZE)
+        self.compressor = zlib.compressobj(compression_level) if compression_level else None
+        self.file.write(COMPRESSED_SNAPSHOT_MAGIC if self.compressor else SNAPSHOT_MAGIC)
+        self.crc = 0
+        self.size = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.file.write(data)
+
+    def Finish(self):
+        """writes all buffered data to disk"""
+        if self.compressor:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class SnapshotInput(object):
+    """reads snapshot file (decompressing it if needed), keeps crc32 and size of read data"""
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, filename):
+        self.name = filename
+        self.file = open(filename, "rb")
+        magic = readMagic(self.file)
+        if magic not in (SNAPSHOT_MAGIC, COMPRESSED_SNAPSHOT_MAGIC):
+            self.file.close()
+            raise cPickle.UnpicklingError("%s is not a scheduler snapshot" % filename)
+        self.decompressor = zlib.decompressobj() if magic == COMPRESSED_SNAPSHOT_MAGIC else None
+        self.buffer = ""
+        self.crc = 0
+        self.size = 0
+
+    def readCompressed(self, size):
+        chunks, length = [self.buffer], len(self.buffer)
+        while length < size:
+            # unconsumed_tail keeps the rest of input, so decompressed data is bounded by requested size
+            data = self.decompressor.unconsumed_tail or self.file.read(self.CHUNK_SIZE)
+            if not data:
+                break
+            data = self.decompressor.decompress(data, max(size - length, self.CHUNK_SIZE))
+            chunks.append(data)
+            length += len(data)
+        data = "".join(chunks)
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+    def read(self, size):
+        data = self.readCompressed(size) if self.decompressor else self.file.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def ReadRecords(stream):
+    """yields raw records data from stream, stops at the end of stream or at truncated record"""
+    while True:
+        header = stream.read(RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) < RECORD_HEADER.size:
+            logging.warning("backups\ttruncated record header in %s", getattr(stream, "name", stream))
+            return
+        size, = RECORD_HEADER.unpack(header)
+        data = stream.read(size)
+        if len(data) < size:
+            logging.warning("backups\ttruncated record in %s", getattr(stream, "name", stream))
+            return
+        yield data
+
+
+def ValidateSnapshot(filename):
+    """checks snapshot integrity by its trailer without decoding of records"""
+    stream = SnapshotInput(filename)
+    try:
+        records = ReadRecords(stream)
+        header = next(records, None)
+        if header is None:
+            raise cPickle.UnpicklingError("%s is empty" % filename)
+        info = marshal.loads(header)[1] if header[:1] != PICKLE_MARK else {}
+        if info.get("version") not in SUPPORTED_SNAPSHOT_VERSIONS:
+            raise cPickle.UnpicklingError("%s has unsupported snapshot version %r" % (filename, info.get("version")))
+        last, position = None, (stream.crc, stream.size)
+        for data in records:
+            last, expected, position = data, position, (stream.crc, stream.size)
+        trailer = marshal.loads(last) if last is not None else None
+        if not (trailer and trailer[0] == "trailer"):
+            raise cPickle.UnpicklingError("%s is truncated" % filename)
+        if (trailer[1]["crc32"], trailer[1]["size"]) != expected:
+            raise cPickle.UnpicklingError("%s is corrupted: checksum mismatch" % filename)
+    finally:
+        stream.close()
+
+
+@contextlib.contextmanager
+def PausedGC():
+    """records encoding and decoding makes a lot of containers without any garbage,
+    so garbage collections are useless there and take most of the time"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class DroppedRef(object):
+    """placeholder for references restored separately (it is used as weak listener only, so dies at once)"""
+
+
+class ChangesTracker(ICallbackAcceptor):
+    """collects packets changed since the last backup"""
+
+    def __init__(self):
+        self.lock = fork_locking.Lock()
+        self.packets = {}
+
+    def Watch(self, pck):
+        pck.AddNonpersistentCallbackListener(self)
+
+    def MarkPacket(self, pck):
+        with self.lock:
+            self.packets[pck.id] = pck
+
+    def Take(self):
+        with self.lock:
+            packets, self.packets = self.packets, {}
+        return packets
+
+    def Restore(self, packets):
+        """returns changes back after unsuccessful backup"""
+        with self.lock:
+            for pck_id, pck in packets.iteritems():
+                self.packets.setdefault(pck_id, pck)
+
+    def OnChange(self, pck):
+        if isinstance(pck, JobPacket):
+            self.MarkPacket(pck)
+
+    def OnJobGet(self, job):
+        if isinstance(job, Job):
+            self.MarkPacket(job.packetRef)
+
+    def OnJobDone(self, job):
+        if isinstance(job, Job):
+            self.MarkPacket(job.packetRef)
+
+    def OnPacketReinitRequest(self, pck):
+        self.MarkPacket(pck)
+
+    def __len__(self):
+        return len(self.packets)
+
+
+class DeltaWriter(object):
+    PICKLE_RETRIES = 5
+    REF_KINDS = {Queue: "queue", BinaryFile: "binary", PacketNamesStorage: "names_tracker",
+                 Tag: "tag", RemoteTag: "tag", TagWrapper: "tag", JobPacket: "packet"}
+    PACKET_REFS = frozenset(["queue", "binary", "names_tracker", "tag"])
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.root = None
+        self.refs = self.PACKET_REFS
+        self.encoder = ObjectsEncoder(self.dumps)
+        # connManager is pickled without any references
+        self.storagesEncoder = ObjectsEncoder(lambda obj: self.dumps(obj, persistent=False))
+
+    def persistent_id(self, obj):
+        if obj is self.root:
+            return None
+        kind = self.REF_KINDS.get(type(obj))
+        if kind not in self.refs:
+            return None
+        if kind == "queue":
+            return ("queue", obj.name)
+        if kind == "binary":
+            return ("binary", obj.checksum)
+        if kind == "tag":
+            return ("tag", obj.GetFullname())
+        if kind == "packet":
+            return ("packet", obj.id)
+        return (kind,)
+
+    def dumps(self, obj, persistent=True):
+        # objects can be changed by other threads during pickling, so just try again in such case
+        for trying in xrange(self.PICKLE_RETRIES):
+            out = cStringIO.StringIO()
+            pickler = cPickle.Pickler(out, 2)
+            if persistent:
+                # is called for class instances only, builtin types are pickled without extra calls
+                pickler.inst_persistent_id = self.persistent_id
+            try:
+                pickler.dump(obj)
+                return out.getvalue()
+            except RuntimeError:
+                if trying + 1 == self.PICKLE_RETRIES:
+                    raise
+
+    def writeData(self, data):
+        self.stream.write(RECORD_HEADER.pack(len(data)))
+        self.stream.write(data)
+
+    def write(self, obj, persistent=True, root=None, refs=None):
+        """writes pickled record"""
+        self.root, self.refs = root, refs or self.PACKET_REFS
+        try:
+            data = self.dumps(obj, persistent)
+        finally:
+            self.root, self.refs = None, self.PACKET_REFS
+        self.writeData(data)
+
+    def writeEncoded(self, encode, obj=None, persistent=True, root=None, refs=None):
+        """writes marshalled record made by encode function
+        obj is pickled instead if it has values without schema and unsupported by marshal"""
+        for trying in xrange(self.PICKLE_RETRIES):
+            try:
+                with PausedGC():
+                    record = encode()
+                break
+            except RuntimeError:
+                # objects are changed by other threads
+                if trying + 1 == self.PICKLE_RETRIES:
+                    raise
+        try:
+            data = marshal.dumps(record, marshal.version)
+        except ValueError, e:
+            if obj is None:
+                raise
+            logging.warning("backups\tcan't marshal %s record, it will be pickled: %s", record[0], e)
+            return self.write(obj, persistent, root, refs)
+        self.writeData(data)
+
+    def WriteQueues(self, queues):
+        self.writeEncoded(lambda: ("queues", dict((q.name, q.GetSettings()) for q in queues)))
+
+    def WriteStorages(self, binStorage, connManager, tempStorage):
+        encode = self.storagesEncoder.Encode
+        self.writeEncoded(lambda: ("storages", {"binStorage": encode(binStorage), "connManager": encode(connManager)}),
+                          ("storages", {"binStorage": binStorage, "connManager": connManager}), persistent=False)
+        self.writeEncoded(lambda: ("temp", self.encoder.Encode(tempStorage)), ("temp", tempStorage), root=tempStorage)
+
+    def WritePacket(self, pck):
+        queue = GetPacketQueue(pck)
+        if queue is None or pck.state == PacketState.HISTORIED:
+            self.writeEncoded(lambda: ("packet", pck.id, None, None))
+        else:
+            self.writeEncoded(lambda: ("packet", pck.id, queue.name, self.encoder.Encode(pck)),
+                              ("packet", pck.id, queue.name, pck), root=pck)
+
+
+class SnapshotWriter(DeltaWriter):
+    """writes snapshot records to SnapshotOutput"""
+    TAGS_REFS = frozenset(["queue", "binary", "names_tracker", "packet"])
+    PACKETS_PER_RECORD = 1000
+
+    def WriteHeader(self, queues):
+        info = {"version": SNAPSHOT_VERSION, "queues": len(queues),
+                "packets": sum(len(list(q.ListAllPackets())) for q in queues)}
+        self.writeEncoded(lambda: ("snapshot", info))
+
+    def WriteTags(self, tagRef):
+        self.writeEncoded(lambda: ("tags", EncodeTags(self.encoder, tagRef)), ("tags", tagRef), refs=self.TAGS_REFS)
+
+    def WriteQueue(self, queue):
+        """queue packets are written by groups, so memory for encoding is limited by the group size"""
+        packets = []
+
+        def encode_queue():
+            record, packets[:] = EncodeQueue(self.encoder, queue)
+            return ("queue", record)
+
+        self.writeEncoded(encode_queue)
+        for start in xrange(0, len(packets), self.PACKETS_PER_RECORD):
+            group = packets[start:start + self.PACKETS_PER_RECORD]
+            self.writeEncoded(lambda: ("packets", EncodeQueuePackets(self.encoder, group)), ("packets", group))
+
+    def WriteTrailer(self):
+        self.writeEncoded(lambda: ("trailer", {"crc32": self.stream.crc, "size": self.stream.size}))
+
+
+class RecordsReader(object):
+    def __init__(self, sdict, names_tracker):
+        self.sdict = sdict
+        self.names_tracker = names_tracker
+        self.decoder = ObjectsDecoder(self.unpickle, self.getBinary)
+
+    def getBinary(self, checksum):
+        binStorage = self.sdict.get("binStorage")
+        return binStorage and binStorage.GetFileByHash(checksum)
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind in ("queue", "packet"):
+            return DroppedRef()
+        if kind == "binary":
+            return self.getBinary(pid[1]) or pid[1]
+        if kind == "tag":
+            # packets acquire tags by names in JobPacket.VivifyDoneTagsIfNeed
+            return pid[1]
+        if kind == "names_tracker":
+            return self.names_tracker
+        raise cPickle.UnpicklingError("unknown persistent id %r" % (pid,))
+
+    def unpickle(self, data):
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+        unpickler.persistent_load = self.persistent_load
+        return unpickler.load()
+
+    def loads(self, data):
+        with PausedGC():
+            if data[:1] == PICKLE_MARK:
+                return self.unpickle(data)
+            record = marshal.loads(data)
+            decode = self.RECORD_DECODERS.get(record[0])
+            return decode(self, record) if decode else record
+
+    def decodeStorages(self, (kind, storages)):
+        return kind, dict((name, self.decoder.Decode(data)) for name, data in storages.iteritems())
+
+    def decodeObject(self, (kind, data)):
+        return kind, self.decoder.Decode(data)
+
+    def decodeTags(self, (kind, tags)):
+        return kind, DecodeTags(self.decoder, tags)
+
+    def decodePackets(self, (kind, packets)):
+        return kind, DecodeQueuePackets(self.decoder, packets)
+
+    def decodePacket(self, (kind, pck_id, qname, data)):
+        return kind, pck_id, qname, (self.decoder.Decode(data) if data is not None else None)
+
+    RECORD_DECODERS = {"storages": decodeStorages, "temp": decodeObject, "queue": decodeObject,
+                       "tags": decodeTags, "packet": decodePacket, "packets": decodePackets}
+
+
+class DeltaReader(RecordsReader):
+    """collects changes from delta backups and packets journal for applying them queue by queue"""
+
+    def __init__(self, sdict, names_tracker):
+        super(DeltaReader, self).__init__(sdict, names_tracker)
+        self.packets = {}
+        self.queues = None
+        self.patched = set()
+
+    def ApplyFile(self, filename):
+        with open(filename, "r") as stream:
+            for data in ReadRecords(stream):
+                try:
+                    record = self.loads(data)
+                except Exception, e:
+                    logging.exception("backups\tcan't read record from %s: %s", filename, e)
+                    continue
+                kind = record[0]
+                if kind == "queues":
+                    self.queues = record[1]
+                elif kind == "storages":
+                    self.sdict.update(record[1])
+                elif kind == "temp":
+                    self.sdict["tempStorage"] = record[1]
+                elif kind == "packet":
+                    pck_id, qname, pck = record[1:]
+                    self.packets[pck_id] = (qname, pck)
+                else:
+                    logging.error("backups\tunknown record type %r in %s", kind, filename)
+
+    def ApplyFiles(self, filenames):
+        """returns number of successfully applied files"""
+        for applied, filename in enumerate(filenames):
+            logging.info("applying %s", filename)
+            try:
+                self.ApplyFile(filename)
+            except Exception, e:
+                # next files depend on the broken one, so stop at the last consistent state
+                logging.exception("can't apply %s: %s", filename, e)
+                return applied
+        return len(filenames)
+
+    def PatchQueue(self, queue):
+        """applies collected changes to the queue,
+        returns list of removed old packets and list of added new packets"""
+        removed, added = [], []
+        for pck in list(queue.ListAllPackets()):
+            if pck.id in self.packets:
+                queue.ForgetPacket(pck)
+                removed.append(pck)
+        for qname, pck in self.packets.itervalues():
+            if qname == queue.name:
+                queue.RestorePacket(pck)
+                pck.AddCallbackListener(queue)
+                added.append(pck)
+        self.FixBinaryLinks(added)
+        if self.queues and queue.name in self.queues:
+            queue.ApplySettings(self.queues[queue.name])
+        self.patched.add(queue.name)
+        return removed, added
+
+    def IsDeleted(self, queue):
+        return self.queues is not None and queue.name not in self.queues and queue.Empty()
+
+    def ListNewQueues(self):
+        """returns names of queues existing only in changes"""
+        qnames = set(qname for qname, _ in self.packets.itervalues() if qname is not None)
+        qnames.update(self.queues or ())
+        return sorted(qnames - self.patched)
+
+    def FixBinaryLinks(self, packets):
+        binStorage = self.sdict["binStorage"]
+        for pck in packets:
+            for binname, file in pck.binLinks.items():
+                if isinstance(file, BinaryFile):
+                    pck.binLinks[binname] = binStorage.GetFileByHash(file.checksum) or file.checksum
+
+
+class SnapshotReader(RecordsReader):
+    """reads snapshot record by record, queues are read lazily one by one"""
+
+    def __init__(self, stream, names_tracker):
+        """stream - SnapshotInput object"""
+        super(SnapshotReader, self).__init__({}, names_tracker)
+        self.stream = stream
+        self.records = ReadRecords(stream)
+        self.info = {}
+        self.pending = None
+        self.brokenRecords = 0
+
+    def ReadHead(self):
+        """reads everything except queues, returns scheduler state dict"""
+        for record in self.iterRecords():
+            kind = record[0]
+            if kind == "snapshot":
+                self.info = record[1]
+                if self.info.get("version") not in SUPPORTED_SNAPSHOT_VERSIONS:
+                    raise cPickle.UnpicklingError("unsupported snapshot version %r" % self.info.get("version"))
+            elif kind == "storages":
+                self.sdict.update(record[1])
+            elif kind == "tags":
+                self.sdict["tagRef"] = record[1]
+            elif kind == "temp":
+                self.sdict["tempStorage"] = record[1]
+            elif kind == "queue":
+                self.pending = record[1]
+                break
+        if "tagRef" not in self.sdict:
+            raise cPickle.UnpicklingError("snapshot has no tags record")
+        return self.sdict
+
+    def IterQueues(self):
+        """yields queues with all their packets"""
+        queue, self.pending = self.pending, None
+        for record in self.iterRecords():
+            kind = record[0]
+            if kind == "packets" and queue is not None:
+                RestoreQueuePackets(queue, record[1])
+            elif kind == "queue":
+                if queue is not None:
+                    yield queue
+                queue = record[1]
+        if queue is not None:
+            yield queue
+
+    def iterRecords(self):
+        for data in self.records:
+            try:
+                yield self.loads(data)
+            except Exception, e:
+                # records are independent, so just skip the broken one
+                self.brokenRecords += 1
+                logging.exception("backups\tcan't read snapshot record: %s", e)
+
+    def Close(self):
+        self.stream.close()
+
+
+class PacketJournal(ChangesTracker):
+    """write-ahead journal of packets and queues changes
+    changed objects are collected and written in groups once per commit_delay seconds,
+    each group is written at once and synced to disk"""
+
+    def __init__(self, scheduler, filename=None, commit_delay=0.0):
+        super(PacketJournal, self).__init__()
+        self.scheduler = scheduler
+        self.filename = filename
+        self.commit_delay = commit_delay
+        self.queuesChanged = False
+        self.fileLock = fork_locking.Lock()
+        self.hasChanges = threading.Event()
+        self.alive = False
+        self.thread = None
+        self.file = None
+        if self.filename:
+            self.Open()
+
+    def Open(self):
+        self.file = open(self.filename, "a")
+
+    def MarkPacket(self, pck):
+        if self.filename:
+            super(PacketJournal, self).MarkPacket(pck)
+            self.hasChanges.set()
+
+    def MarkQueues(self):
+        if self.filename:
+            self.queuesChanged = True
+            self.hasChanges.set()
+
+    def Start(self):
+        if self.filename and not self.alive:
+            self.alive = True
+            self.thread = threading.Thread(target=self.commitLoop, name="PacketJournal")
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def Stop(self):
+        if self.alive:
+            self.alive = False
+            self.hasChanges.set()
+            self.thread.join()
+
+    def commitLoop(self):
+        while self.alive:
+            self.hasChanges.wait()
+            if self.alive and self.commit_delay:
+                time.sleep(self.commit_delay) # collect group of changes
+            self.hasChanges.clear()
+            try:
+                self.Commit()
+            except Exception, e:
+                logging.exception("journal\tcan't commit packets changes: %s", e)
+
+    def Commit(self):
+        with self.fileLock:
+            packets = self.Take()
+            queuesChanged, self.queuesChanged = self.queuesChanged, False
+            if not packets and not queuesChanged:
+                return
+            try:
+                out = cStringIO.StringIO()
+                writer = DeltaWriter(out)
+                if queuesChanged:
+                    writer.WriteQueues(self.scheduler.qRef.values())
+                for pck in packets.itervalues():
+                    writer.WritePacket(pck)
+                self.file.write(out.getvalue())
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except:
+                self.Restore(packets)
+                self.queuesChanged = self.queuesChanged or queuesChanged
+                raise
+
+    def Rotate(self, timestamp):
+        if not self.filename:
+            return
+        with self.fileLock:
+            self.file.close()
+            if os.path.exists(self.filename):
+                os.rename(self.filename, "%s-%d" % (self.filename, timestamp))
+            self.Open()
+
+    def ListFiles(self, timestamp):
+        """returns journal files with changes made after timestamp"""
+        if not self.filename:
+            return []
+        dirname, journal_filename = os.path.split(self.filename)
+        result = []
+        for filename in os.listdir(dirname):
+            if filename.startswith(journal_filename + "-"):
+                file_time = int(filename.split("-")[-1])
+                if file_time > timestamp:
+                    result.append((file_time, os.path.join(dirname, filename)))
+        result = [filename for _, filename in sorted(result)]
+        if os.path.isfile(self.filename):
+            result.append(self.filename)
+        return result
+
+    def Clear(self, final_time):
+        if not self.filename:
+            return
+        dirname, journal_filename = os.path.split(self.filename)
+        for filename in os.listdir(dirname):
+            if filename.startswith(journal_filename + "-"):
+                file_time = int(filename.split("-")[-1])
+                if file_time <= final_time:
+                    os.remove(os.path.join(dirname, filename))
+
+
+class ResetsCollector(ICallbackAcceptor):
+    """remembers tags resets for packets which are not linked to tags yet"""
+
+    def __init__(self):
+        self.resets = {}
+
+    def OnDone(self, tag):
+        pass
+
+    def OnUndone(self, tag):
+        pass
+
+    def OnReset(self, (tag, message)):
+        self.resets[tag.GetFullname()] = message
+
+    def ApplyResets(self, tagStorage, pck):
+        for tagname in PacketTags(pck):
+            if tagname in self.resets:
+                pck.OnReset((tagStorage.AcquireTag(tagname), self.resets[tagname]))
+
+
+def PacketTags(pck):
+    return set(getattr(pck, "allTags", ())) | set(pck.waitTags)
+
+
+def LinkTags(tagStorage, pck):
+    for tagname in PacketTags(pck):
+        tagStorage.AcquireTag(tagname).AddCallbackListener(pck)
+
+
+def UnlinkTags(tagStorage, pck):
+    for tagname in PacketTags(pck):
+        tagStorage.AcquireTag(tagname).DropCallbackListener(pck)
+
+
+def RelinkTags(tagStorage, replaced):
+    """moves tags listeners from packets replaced by delta backups to the new ones"""
+    for old_pck, new_pck in replaced:
+        if old_pck is not None:
+            UnlinkTags(tagStorage, old_pck)
+        if new_pck is not None:
+            LinkTags(tagStorage, new_pck)
@@ -33,8 +33,13 @@ class CallbackHolder(Unpickable(callbacks=weakref.WeakKeyDictionary,
             del self.nonpersistent_callbacks[obj]
 
     def FireEvent(self, event, reference=None):
+        self.notifyListeners(itertools.chain(self.callbacks.keyrefs(), self.nonpersistent_callbacks.keyrefs()),
+                             event, reference)
+
+    def notifyListeners(self, listeners, event, reference=None):
+        """listeners - weak references to acceptors"""
         bad_listeners = set()
-        for obj in itertools.chain(self.callbacks.keyrefs(), self.nonpersistent_callbacks.keyrefs()):
+        for obj in listeners:
             if isinstance(obj(), ICallbackAcceptor):
                 obj().AcceptCallback(reference or self, event)
             else:
@@ -54,11 +59,22 @@ class CallbackHolder(Unpickable(callbacks=weakref.WeakKeyDictionary,
 
 
 class Tag(CallbackHolder):
+    """if tags dispatcher is set (by TagStorage) and running, events are delivered to persistent listeners (packets)
+    asynchronously by the dispatcher after nonpersistent ones (journal, connections) have been notified"""
+
     def __init__(self, tagname):
         CallbackHolder.__init__(self)
         self.done = False
         self.name = tagname
 
+    def FireEvent(self, event, reference=None):
+        dispatcher = getattr(self, "dispatcher", None)
+        if dispatcher is None or not dispatcher.IsRunning():
+            return CallbackHolder.FireEvent(self, event, reference)
+        self.notifyListeners(self.nonpersistent_callbacks.keyrefs(), event, reference)
+        if not dispatcher.Dispatch(self, event, reference, self.callbacks.keyrefs()):
+            self.notifyListeners(self.callbacks.keyrefs(), event, reference)
+
     def Set(self):
         logging.debug("tag %s\tset", self.name)
         self.done = True
@@ -90,6 +106,11 @@ class Tag(CallbackHolder):
     def GetListenersIds(self):
         return [k.id for k in self.callbacks.iterkeys()]
 
+    def __getstate__(self):
+        sdict = CallbackHolder.__getstate__(self)
+        sdict.pop("dispatcher", None)
+        return sdict
+
 
 class RemoteTag(Tag):
     def __init__(self, tagname):
@@ -48,9 +48,9 @@ def traced_rpc_method(level="debug"):
     assert callable(log_method)
 
     def traced_rpc_method(func):
-        def f(*args):
+        def f(*args, **kws):
             try:
-                return func(*args)
+                return func(*args, **kws)
             except:
                 logging.exception("")
                 raise
@@ -138,7 +138,9 @@ def Unpickable(**kws):
             for attr, builder in scheme.iteritems():
                 try:
                     if attr in sdict:
-                        sdict[attr] = builder(sdict[attr])
+                        # deserialized values are new objects, so they are used as is if they have proper type
+                        if type(sdict[attr]) is not builder.fn:
+                            sdict[attr] = builder(sdict[attr])
                     else:
                         sdict[attr] = builder()
                 except:
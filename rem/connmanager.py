@@ -1,14 +1,14 @@
+import contextlib
 import threading
 import xmlrpclib
-import select
 import bsddb3
-from SimpleXMLRPCServer import SimpleXMLRPCServer
 from ConfigParser import ConfigParser
 import cPickle
 import subprocess
 
 from common import *
 from callbacks import Tag, ICallbackAcceptor
+from rpcserver import XMLRPCServer
 
 
 class ClientInfo(Unpickable(taglist=set,
@@ -115,10 +115,11 @@ class ConnectionManager(Unpickable(topologyInfo=TopologyInfo,
                                    scheduledTasks=TimedSet.create,
                                    lock=PickableLock,
                                    alive=(bool, False),
-                                   tags_file=str),
+                                   tags_file=str,
+                                   batches=threading.local),
                         ICallbackAcceptor):
     def InitXMLRPCServer(self):
-        self.rpcserver = SimpleXMLRPCServer(("", self.port), allow_none=True)
+        self.rpcserver = XMLRPCServer(1, ("", self.port), allow_none=True)
         self.rpcserver.register_function(self.set_tags, "set_tags")
         self.rpcserver.register_function(self.list_clients, "list_clients")
         self.rpcserver.register_function(self.list_tags, "list_tags")
@@ -152,19 +153,14 @@ class ConnectionManager(Unpickable(topologyInfo=TopologyInfo,
         self.ReloadConfig()
         self.alive = True
         self.InitXMLRPCServer()
-        threading.Thread(target=self.ServerLoop).start()
+        self.rpcserver.Start()
         for client in self.topologyInfo.servers.values():
             self.scheduler.ScheduleTaskT(0, self.SendData, client, skip_logging=True)
 
     def Stop(self):
         self.alive = False
-
-    def ServerLoop(self):
-        rpc_fd = self.rpcserver.fileno()
-        while self.alive:
-            rout, _, _ = select.select((rpc_fd,), (), (), 0.01)
-            if rpc_fd in rout:
-                self.rpcserver.handle_request()
+        if getattr(self, "rpcserver", None):
+            self.rpcserver.Stop()
 
     def SendData(self, client):
         if (len(client.subscriptions) > 0 or len(client.taglist) > 0) and client.active and self.alive:
@@ -173,10 +169,12 @@ class ConnectionManager(Unpickable(topologyInfo=TopologyInfo,
             tags = list(client.taglist)[:numTags]
             subscriptions = list(client.subscriptions)[:numTags]
             try:
-                if len(tags) > 0:
+                while len(tags) > 0:
                     logging.debug("SendData to %s: %d tags", client.name, len(tags))
                     client.connection.set_tags(tags)
                     client.taglist.difference_update(tags)
+                    # after successful call all accumulated tags are sent by bulks at once
+                    tags = list(client.taglist)[:client.MAX_TAGS_BULK]
 
                 if len(subscriptions) > 0:
                     logging.debug("SendData to %s: %d subscriptions", client.name, len(subscriptions))
@@ -207,12 +205,44 @@ class ConnectionManager(Unpickable(topologyInfo=TopologyInfo,
             return
         tagname = tag.GetName()
         if not tag.IsRemote():
+            tagnames = getattr(self.batches, "tagnames", None)
+            if tagnames is not None:
+                tagnames.append(tagname)
+                return
             acceptors = self.GetTagAcceptors(tagname)
             if acceptors:
                 logging.debug("ondone connmanager %s with acceptors list %s", tagname, acceptors)
                 for clientname in acceptors:
                     self.SetTag(tagname, clientname)
 
+    @contextlib.contextmanager
+    def Batch(self):
+        """tags set by the current thread inside the block are passed to their acceptors at the end,
+        tags for the same client are added to its queue together"""
+        if getattr(self.batches, "tagnames", None) is not None:
+            yield
+            return
+        self.batches.tagnames = []
+        try:
+            yield
+        finally:
+            tagnames, self.batches.tagnames = self.batches.tagnames, None
+            if tagnames:
+                self.setTagsForAcceptors(tagnames)
+
+    def setTagsForAcceptors(self, tagnames):
+        clientsTags = {}
+        for tagname in tagnames:
+            for clientname in self.GetTagAcceptors(tagname):
+                clientsTags.setdefault(clientname, []).append(tagname)
+        for clientname, clientTagnames in clientsTags.iteritems():
+            logging.debug("set %d remote tags on host %s", len(clientTagnames), clientname)
+            client = self.topologyInfo.GetClient(clientname, checkname=False)
+            if client is None:
+                logging.error("unknown client %s appeared", clientname)
+                continue
+            client.taglist.update("%s:%s" % (self.network_name, tagname) for tagname in clientTagnames)
+
     def SetTag(self, tagname, clientname):
         logging.debug("set remote tag %s on host %s", tagname, clientname)
         client = self.topologyInfo.GetClient(clientname, checkname=False)
@@ -263,8 +293,9 @@ class ConnectionManager(Unpickable(topologyInfo=TopologyInfo,
     @traced_rpc_method()
     def set_tags(self, tags):
         logging.debug("set %d remote tags", len(tags))
-        for tagname in tags:
-            self.scheduler.tagRef.SetRemoteTag(tagname)
+        with self.scheduler.tagRef.tag_logger.Batch():
+            for tagname in tags:
+                self.scheduler.tagRef.SetRemoteTag(tagname)
         return True
 
     @traced_rpc_method()
@@ -352,5 +383,6 @@ class ConnectionManager(Unpickable(topologyInfo=TopologyInfo,
         sdict.pop("scheduler", None)
         sdict.pop("rpcserver", None)
         sdict.pop("acceptors", None)
+        sdict.pop("batches", None)
         sdict["alive"] = False
         return getattr(super(ConnectionManager, self), "__getstate__", lambda: sdict)()
@@ -11,4 +11,9 @@ WARN_DUPLICATE_NAMES_POLICY = 0b010
 DENY_DUPLICATE_NAMES_POLICY = 0b100
 DEFAULT_DUPLICATE_NAMES_POLICY = DENY_DUPLICATE_NAMES_POLICY
 
-JOB_WATCHER_MAX_DELAY = 2
\ No newline at end of file
+JOB_WATCHER_MAX_DELAY = 2
+
+#max size of packet file part returned by one pck_get_file call
+MAX_FILE_CHUNK_SIZE = 16 << 20
+#max time of one pck_wait call (in seconds)
+MAX_PACKET_WAIT_TIME = 600
@@ -37,6 +37,12 @@ class ConfigReader(ConfigParser):
         except NoOptionError:
             return default
 
+    def safe_getfloat(self, section, option, default=0.0):
+        try:
+            return self.getfloat(section, option)
+        except NoOptionError:
+            return default
+
     def safe_getboolean(self, section, option, default=False):
         try:
             return self.getboolean(section, option)
@@ -70,6 +76,8 @@ class Context(object):
         self.backup_count = config.getint("store", "backup_count")
         self.backup_in_child = config.safe_getboolean("store", "backup_in_child", False)
         self.backup_child_max_working_time = config.getint("store", "backup_child_max_working_time")
+        self.incremental_backups_count = config.safe_getint("store", "incremental_backups_count", 0)
+        self.backup_compression_level = config.safe_getint("store", "backup_compression_level", 0)
         self.journal_lifetime = config.getint("store", "journal_lifetime")
         self.binary_directory = self.prep_dir(config.get("store", "binary_dir"))
         self.binary_lifetime = config.getint("store", "binary_lifetime")
@@ -77,10 +85,18 @@ class Context(object):
         self.success_lifetime = config.getint("store", "success_packet_lifetime")
         self.tags_db_file = config.get("store", "tags_db_file")
         self.recent_tags_file = config.get("store", "recent_tags_file")
+        self.tags_cache_size = config.safe_getint("store", "tags_cache_size", 64)
+        self.recent_packets_file = config.safe_get("store", "recent_packets_file")
+        self.journal_commit_delay = config.safe_getfloat("store", "journal_commit_delay", 0.5)
         self.remote_tags_db_file = config.safe_get("store", "remote_tags_db_file")
+        self.events_feed_size = config.safe_getint("store", "events_feed_size", 100000)
+        self.events_spill_directory = config.safe_get("store", "events_spill_dir")
+        self.events_spill_segments = config.safe_getint("store", "events_spill_segments", 10)
         self.thread_pool_size = config.getint("run", "poolsize")
         self.xmlrpc_pool_size = config.safe_getint("run", "xmlrpc_poolsize", 1)
         self.readonly_xmlrpc_pool_size = config.safe_getint("run", "readonly_xmlrpc_pool_size", 1)
+        self.restore_pool_size = config.safe_getint("run", "restore_poolsize", 8)
+        self.use_jobs_launcher = config.safe_getboolean("run", "use_jobs_launcher", False)
         self.manager_port = config.getint("server", "port")
         self.manager_readonly_port = config.safe_getint("server", "readonly_port")
         self.system_port = config.safe_getint("server", "system_port")
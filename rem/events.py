@@ -0,0 +1,163 @@
+"""feed of scheduler events for external mirrors
+
+EventsFeed listens to packets (as ChangesTracker does) and to tags (as TagLogger does)
+and keeps the latest events in memory with sequential numbers. Consumers read the feed by cursors,
+so they have to process only changes instead of scanning all packets and tags.
+Events evicted from memory are optionally saved into spill segments (marshal files), which are
+removed at restart, cursors contain the feed epoch (start time) to detect it.
+
+Event types:
+    packet_state - packet state has been changed (state at the moment of the event recording)
+    packet_reset - packet has been reset and will be reinitialized
+    job_start    - job is taken for execution (job)
+    job_done     - job process has finished (job, code, success)
+    tag_set, tag_unset, tag_reset - tag events (tag reset contains message)"""
+from __future__ import with_statement
+import bisect
+import logging
+import marshal
+import os
+import threading
+import time
+
+from callbacks import ICallbackAcceptor
+
+__all__ = ["EventsFeed"]
+
+
+class EventsFeed(ICallbackAcceptor):
+    SPILL_PREFIX = "events-"
+    MAX_READ_SIZE = 10000
+
+    def __init__(self, size, spill_directory=None, spill_segments=10):
+        self.size = size
+        self.spillDirectory = spill_directory
+        self.spillSegments = spill_segments
+        self.epoch = int(time.time() * 1000)
+        self.lock = threading.Lock()
+        self.events = []
+        self.firstSeq = 0
+        # (first sequence number, filename) of spilled segments
+        self.segments = []
+        if self.spillDirectory:
+            self.clearSpill()
+
+    def IsEnabled(self):
+        return self.size > 0
+
+    def Watch(self, pck):
+        pck.AddNonpersistentCallbackListener(self)
+
+    def addEvent(self, type, objectId, extra=None):
+        with self.lock:
+            self.events.append((self.firstSeq + len(self.events), time.time(), type, objectId, extra))
+            if len(self.events) >= self.size:
+                self.evict()
+
+    def evict(self):
+        half = max(self.size // 2, 1)
+        evicted, self.events[:half] = self.events[:half], []
+        firstSeq, self.firstSeq = self.firstSeq, self.firstSeq + half
+        if not self.spillDirectory:
+            return
+        filename = os.path.join(self.spillDirectory, "%s%d-%d" % (self.SPILL_PREFIX, self.epoch, firstSeq))
+        try:
+            with open(filename, "wb") as writer:
+                marshal.dump(evicted, writer)
+        except (IOError, OSError), e:
+            logging.error("events\tcan't write spill segment %s: %s", filename, e)
+            return
+        self.segments.append((firstSeq, filename))
+        while len(self.segments) > self.spillSegments:
+            _, oldFilename = self.segments.pop(0)
+            self.removeSegment(oldFilename)
+
+    def removeSegment(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError, e:
+            logging.warning("events\tcan't remove spill segment %s: %s", filename, e)
+
+    def clearSpill(self):
+        if not os.path.isdir(self.spillDirectory):
+            os.makedirs(self.spillDirectory)
+        for filename in os.listdir(self.spillDirectory):
+            if filename.startswith(self.SPILL_PREFIX):
+                self.removeSegment(os.path.join(self.spillDirectory, filename))
+
+    def makeCursor(self, seq):
+        return "%d-%d" % (self.epoch, seq)
+
+    def parseCursor(self, cursor):
+        try:
+            epoch, seq = map(int, cursor.split("-"))
+        except (AttributeError, ValueError):
+            return None
+        return seq if epoch == self.epoch else None
+
+    def Read(self, cursor=None, limit=None):
+        """returns (events, cursor for the next call, reset flag)
+        reset is set if some events since cursor have been lost (cursor is too old or server was restarted),
+        events are returned from the oldest available one then; cursor None means the end of the feed"""
+        limit = min(limit or self.MAX_READ_SIZE, self.MAX_READ_SIZE)
+        with self.lock:
+            lastSeq = self.firstSeq + len(self.events)
+            if cursor is None:
+                return [], self.makeCursor(lastSeq), False
+            seq = self.parseCursor(cursor)
+            oldestSeq = self.segments[0][0] if self.segments else self.firstSeq
+            reset = seq is None or seq < oldestSeq or seq > lastSeq
+            if reset:
+                seq = oldestSeq
+            if seq >= self.firstSeq:
+                events = self.events[seq - self.firstSeq:seq - self.firstSeq + limit]
+                return self.formatEvents(events), self.makeCursor(seq + len(events)), reset
+            segments = list(self.segments)
+        # spilled events are read without lock
+        index = bisect.bisect_right([first for first, _ in segments], seq) - 1
+        segFirst, filename = segments[index]
+        try:
+            with open(filename, "rb") as reader:
+                events = marshal.load(reader)[seq - segFirst:seq - segFirst + limit]
+        except (IOError, OSError, EOFError, ValueError), e:
+            logging.warning("events\tcan't read spill segment %s: %s", filename, e)
+            events, reset = [], True
+            seq = self.firstSeq
+        return self.formatEvents(events), self.makeCursor(seq + len(events)), reset
+
+    @staticmethod
+    def formatEvents(events):
+        formatted = []
+        for _, tm, type, objectId, extra in events:
+            event = dict(extra) if extra else {}
+            event.update(time=tm, type=type, id=objectId)
+            formatted.append(event)
+        return formatted
+
+    """packets events"""
+
+    def OnChange(self, pck):
+        self.addEvent("packet_state", pck.id, {"state": pck.state})
+
+    def OnPacketReinitRequest(self, pck):
+        self.addEvent("packet_reset", pck.id)
+
+    def OnJobGet(self, job):
+        self.addEvent("job_start", job.packetRef.id, {"job": str(job.id)})
+
+    def OnJobDone(self, job):
+        result = job.Result()
+        self.addEvent("job_done", job.packetRef.id,
+                      {"job": str(job.id), "code": result and result.code,
+                       "success": bool(result and result.IsSuccessfull())})
+
+    """tags events"""
+
+    def OnDone(self, tag):
+        self.addEvent("tag_set", tag.GetFullname())
+
+    def OnUndone(self, tag):
+        self.addEvent("tag_unset", tag.GetFullname())
+
+    def OnReset(self, (tag, message)):
+        self.addEvent("tag_reset", tag.GetFullname(), {"message": message})
@@ -2,14 +2,16 @@ from __future__ import with_statement
 import subprocess
 import logging
 import os
+import threading
 import time
 import datetime
-import threading
 
 from callbacks import CallbackHolder
 from common import FuncRunner, SendEmail, Unpickable, safeint, nullobject, zeroint
+import launcher
 import osspec
 import packet
+import reaper
 import constants
 
 DUMMY_COMMAND_CREATOR = None
@@ -95,12 +97,15 @@ class Job(Unpickable(err=nullobject,
                      _notified=bool,
                      output_to_status=bool,
                      alive=bool,
-                     running_pids=set),
+                     running_pids=set,
+                     streaming=bool,
+                     stream_tee=bool),
           CallbackHolder):
     ERR_PENALTY_FACTOR = 6
 
     def __init__(self, shell, parents, pipe_parents, packetRef, maxTryCount, limitter, max_err_len=None,
-                 retry_delay=None, pipe_fail=False, description="", notify_timeout=constants.NOTIFICATION_TIMEOUT, max_working_time=constants.KILL_JOB_DEFAULT_TIMEOUT, output_to_status=False):
+                 retry_delay=None, pipe_fail=False, description="", notify_timeout=constants.NOTIFICATION_TIMEOUT, max_working_time=constants.KILL_JOB_DEFAULT_TIMEOUT, output_to_status=False,
+                 streaming=False, stream_tee=False):
         super(Job, self).__init__()
         self.maxTryCount = maxTryCount
         self.limitter = limitter
@@ -119,55 +124,33 @@ class Job(Unpickable(err=nullobject,
         self.packetRef = packetRef
         self.AddCallbackListener(self.packetRef)
         self.output_to_status = output_to_status
-
-    @staticmethod
-    def __read_stream(fh, buffer):
-        buffer.append(fh.read())
-
-    #copy-paste from multiprocessing/forking.py
-    def popen_wait(self, process, timeout=None):
-        if timeout is None:
-            return process.poll()
-        deadline = time.time() + timeout
-        delay = 0.0005
-        res = None
-        while 1:
-            res = process.poll()
-            if res is not None:
-                break
-            remaining = deadline - time.time()
-            if remaining <= 0:
-                break
-            delay = min(delay * 2, remaining, constants.JOB_WATCHER_MAX_DELAY)
-            time.sleep(delay)
-        return res
+        # stdout of the only pipe parent is passed through OS pipe while both jobs are running
+        self.streaming = streaming
+        self.stream_tee = stream_tee
 
     def __wait_process(self, process, err_pipe):
-        out = []
-        stderrReadThread = threading.Thread(target=Job.__read_stream, args=(err_pipe, out))
-        stderrReadThread.setDaemon(True)
-        stderrReadThread.start()
         if process.stdin:
             process.stdin.close()
-        last_update_time = time.time()
-        working_time = 0
-        poll = process.poll
-        _time = time.time
-        while poll() is None:
-            working_time += _time() - last_update_time
-            last_update_time = _time()
-            if working_time < self.notify_timeout < self.max_working_time and not self._notified:
-                if self.popen_wait(process, self.notify_timeout - working_time) is None:
-                    self._timeoutNotify(working_time + _time() - last_update_time)
-
-            elif working_time < self.max_working_time:
-                if self.popen_wait(process, self.max_working_time - working_time) is None:
-                    process.kill()
-                    self.results.append(TimeOutExceededResult(self.id))
-                    break
-            time.sleep(0.001)
-        stderrReadThread.join()
-        return "", out[0]
+        start_time = time.time()
+        notify_deadline = start_time + self.notify_timeout \
+            if self.notify_timeout < self.max_working_time and not self._notified else None
+        watch = reaper.GetReaper().Watch(process, err_pipe.fileno(),
+                                         notify_deadline=notify_deadline,
+                                         kill_deadline=start_time + self.max_working_time,
+                                         on_notify=lambda: self._scheduleTimeoutNotify(start_time))
+        watch.Wait()
+        if watch.killed_by_timeout:
+            self.results.append(TimeOutExceededResult(self.id))
+        return "", watch.GetErrors()
+
+    def _scheduleTimeoutNotify(self, start_time):
+        # called from reaper thread, so e-mail sending is delegated to scheduler workers
+        working_time = time.time() - start_time
+        scheduler = getattr(packet.PacketCustomLogic.SchedCtx, "Scheduler", None)
+        if scheduler is not None:
+            scheduler.ScheduleTaskT(0, self._timeoutNotify, working_time)
+        else:
+            self._timeoutNotify(working_time)
 
     def _timeoutNotify(self, working_time):
         self.cached_working_time = working_time
@@ -226,14 +209,20 @@ class Job(Unpickable(err=nullobject,
                        else self._make_run_args()
 
             logging.debug("out: %s, in: %s", self.output, self.input)
-            process = subprocess.Popen(run_args, stdout=self.output.fileno(), stdin=self.input.fileno(),
-                                       stderr=self.errPipe[1].fileno(), close_fds=True, cwd=self.packetRef.directory,
-                                       preexec_fn=os.setpgrp)
+            jobsLauncher = launcher.GetLauncher()
+            if jobsLauncher:
+                process = jobsLauncher.Launch(run_args, self.input.fileno(), self.output.fileno(),
+                                              self.errPipe[1].fileno(), cwd=self.packetRef.directory)
+            else:
+                process = subprocess.Popen(run_args, stdout=self.output.fileno(), stdin=self.input.fileno(),
+                                           stderr=self.errPipe[1].fileno(), close_fds=True,
+                                           cwd=self.packetRef.directory, preexec_fn=os.setpgrp)
             jobPid = process.pid
             #in case when we stopped during start implicitly kill himself
             if jobPid is not None:
                 for tracker in pidTrackers: tracker.add(jobPid)
             self.errPipe[1].close()
+            self.closePipeStreams()
             if not self.alive:
                 self.Terminate()
             _, err = self.__wait_process(process, self.errPipe[0])
@@ -253,6 +242,12 @@ class Job(Unpickable(err=nullobject,
             self.CloseStreams()
             self.FireEvent("done")
 
+    def closePipeStreams(self):
+        # pipe ends belong to the started process now, so the peer gets EOF/EPIPE right after its exit
+        for key, stream in ((("in", self.id), self.input), (("out", self.id), self.output)):
+            if stream is not None and self.packetRef.isPipeStream(key) and not stream.closed:
+                stream.close()
+
     def CloseStreams(self):
         if self.output_to_status and self.output:
             try:
@@ -306,6 +301,22 @@ class Job(Unpickable(err=nullobject,
         return self.results[-1] if self.results else None
 
 
+class JobPipeline(object):
+    """jobs connected by streaming edges, they are run simultaneously by one worker"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def Run(self, worker_trace_pids=None):
+        threads = [threading.Thread(target=job.Run, args=(worker_trace_pids,), name="JobPipeline-%s" % job.id)
+                   for job in self.jobs[1:]]
+        for thread in threads:
+            thread.start()
+        self.jobs[0].Run(worker_trace_pids)
+        for thread in threads:
+            thread.join()
+
+
 class FuncJob(object):
     def __init__(self, runner):
         assert isinstance(runner, FuncRunner), "incorrent arguments for FuncJob initializing"
@@ -1,9 +1,14 @@
 from __future__ import with_statement
 import bsddb3
+import contextlib
 import cPickle
+import itertools
 import logging
 import os
+import threading
+import time
 
+import fork_locking
 from common import Unpickable, PickableRLock
 from callbacks import ICallbackAcceptor, RemoteTag, Tag
 
@@ -39,13 +44,47 @@ class ResetTagEvent(TagEvent, Unpickable(message=str)):
         tag_logger.tagRef.ResetTag(self.tagname, self.message)
 
 
+class SetTagsEvent(TagEvent):
+    """group of SetTagEvent saved as one journal record"""
+
+    def __init__(self, tagnames):
+        self.tagnames = tagnames
+
+    def Redo(self, tag_logger):
+        for tagname in self.tagnames:
+            SetTagEvent(tagname).Redo(tag_logger)
+
+
+class UnsetTagsEvent(TagEvent):
+    """group of UnsetTagEvent saved as one journal record"""
+
+    def __init__(self, tagnames):
+        self.tagnames = tagnames
+
+    def Redo(self, tag_logger):
+        for tagname in self.tagnames:
+            tag_logger.tagRef.UnsetTag(tagname)
+
+
 class TagLogger(Unpickable(lock=PickableRLock), ICallbackAcceptor):
+    """journal of tags events
+    events are buffered in memory and written by separate thread in groups (one sync per group),
+    group is collected at most commit_delay seconds; use Sync() to wait for events durability"""
+
     def __init__(self, tagRef):
         super(TagLogger, self).__init__()
         self.file = None
         self.tagRef = tagRef
         self.restoring_mode = False
         self.file_opened = False
+        self.buffer = []
+        self.bufferLock = fork_locking.Lock()
+        self.hasEvents = threading.Event()
+        self.commit_delay = 0.0
+        self.alive = False
+        self.thread = None
+        # events of the current thread batch (see Batch)
+        self.batches = threading.local()
 
     def Open(self, filename):
         self.file = bsddb3.rnopen(filename, "c")
@@ -53,14 +92,52 @@ class TagLogger(Unpickable(lock=PickableRLock), ICallbackAcceptor):
 
     def UpdateContext(self, context):
         self.db_file = context.recent_tags_file
+        self.commit_delay = context.journal_commit_delay
         self.Open(self.db_file)
 
+    def Start(self):
+        if not self.alive:
+            self.alive = True
+            self.thread = threading.Thread(target=self.commitLoop, name="TagLogger")
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def Stop(self):
+        if self.alive:
+            self.alive = False
+            self.hasEvents.set()
+            self.thread.join()
+
+    def commitLoop(self):
+        while self.alive:
+            self.hasEvents.wait()
+            if self.alive and self.commit_delay:
+                time.sleep(self.commit_delay) # collect group of events
+            self.hasEvents.clear()
+            try:
+                self.Commit()
+            except Exception, e:
+                logging.exception("journal\tcan't commit tags events: %s", e)
+
     def LockedAppend(self, data):
         if not self.restoring_mode:
-            if not self.file_opened:
-                with self.lock:
+            with self.bufferLock:
+                self.buffer.append(data)
+            if self.alive:
+                self.hasEvents.set()
+            else:
+                self.Commit()
+
+    def Commit(self):
+        """writes all buffered events to the journal"""
+        with self.lock:
+            with self.bufferLock:
+                events, self.buffer = self.buffer, []
+            if not events:
+                return
+            try:
+                if not self.file_opened:
                     self.Open(self.db_file)
-            with self.lock:
                 try:
                     key = self.file.last()[0] + 1
                 except bsddb3.error as e:
@@ -70,13 +147,59 @@ class TagLogger(Unpickable(lock=PickableRLock), ICallbackAcceptor):
                         raise
                     else:
                         key = 1
-                self.file[key] = data
-            self.file.sync()
+                for data in events:
+                    self.file[key] = data
+                    key += 1
+                self.file.sync()
+            except:
+                with self.bufferLock:
+                    self.buffer[:0] = events
+                raise
+
+    def Sync(self):
+        """waits until all already happened events are written"""
+        # Commit() is serialized by self.lock, so all preceding events are written after it
+        self.Commit()
 
     def LogEvent(self, cls, *args, **kws):
+        events = getattr(self.batches, "events", None)
+        if events is not None:
+            events.append(cls(*args, **kws))
+            return
         obj = cls(*args, **kws)
         self.LockedAppend(cPickle.dumps(obj))
 
+    @contextlib.contextmanager
+    def Batch(self):
+        """events logged by the current thread inside the block are appended to the journal together,
+        sequential set and unset events are joined into SetTagsEvent and UnsetTagsEvent records"""
+        if getattr(self.batches, "events", None) is not None:
+            yield
+            return
+        self.batches.events = []
+        try:
+            yield
+        finally:
+            events, self.batches.events = self.batches.events, None
+            self.appendBatch(events)
+
+    def appendBatch(self, events):
+        records = []
+        groups = {SetTagEvent: SetTagsEvent, UnsetTagEvent: UnsetTagsEvent}
+        for cls, group in itertools.groupby(events, type):
+            if cls in groups:
+                records.append(cPickle.dumps(groups[cls]([event.tagname for event in group])))
+            else:
+                records.extend(cPickle.dumps(event) for event in group)
+        if not records or self.restoring_mode:
+            return
+        with self.bufferLock:
+            self.buffer.extend(records)
+        if self.alive:
+            self.hasEvents.set()
+        else:
+            self.Commit()
+
     def OnDone(self, tag):
         if isinstance(tag, (Tag, RemoteTag)):
             self.LogEvent(SetTagEvent, tag.GetFullname())
@@ -119,6 +242,7 @@ class TagLogger(Unpickable(lock=PickableRLock), ICallbackAcceptor):
     def Rotate(self, timestamp):
         logging.info("TagLogger.Rotate")
         with self.lock:
+            self.Commit()
             self.file.close()
             if os.path.exists(self.db_file):
                 new_filename = "%s-%d" % (self.db_file, timestamp)
@@ -0,0 +1,347 @@
+"""jobs launching through a small helper process
+
+Forking the daemon with its multi-GB heap for every job is expensive, and subprocess.Popen(close_fds=True)
+additionally walks all descriptors up to the limit in every child. JobsLauncher forks a helper process
+at startup (before backups are loaded), so the helper's heap is tiny. Job specs are sent to the helper
+over a unix socket, job stdin/stdout/stderr descriptors are passed with SCM_RIGHTS; the helper spawns
+jobs and reports their pids and exit statuses back."""
+from __future__ import with_statement
+import errno
+import fcntl
+import logging
+import marshal
+import os
+import select
+import signal
+import socket
+import struct
+import threading
+import _multiprocessing
+
+import fork_locking
+
+__all__ = ["LaunchedProcess", "JobsLauncher", "StartLauncher", "GetLauncher"]
+
+FRAME_HEADER = struct.Struct(">I")
+# exit status of jobs which were running when the helper process had gone
+UNKNOWN_RETURNCODE = 666
+
+
+def _retry_on_eintr(func, *args):
+    while True:
+        try:
+            return func(*args)
+        except (OSError, IOError), e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _close_fds(keep):
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = xrange(os.sysconf("SC_OPEN_MAX"))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _read_exactly(fd, size):
+    chunks = []
+    while size:
+        data = _retry_on_eintr(os.read, fd, size)
+        if not data:
+            raise EOFError("unexpected end of launcher stream")
+        chunks.append(data)
+        size -= len(data)
+    return "".join(chunks)
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[_retry_on_eintr(os.write, fd, data):]
+
+
+def read_frame(fd):
+    size, = FRAME_HEADER.unpack(_read_exactly(fd, FRAME_HEADER.size))
+    return marshal.loads(_read_exactly(fd, size))
+
+
+def write_frame(fd, message):
+    data = marshal.dumps(message)
+    _write_all(fd, FRAME_HEADER.pack(len(data)) + data)
+
+
+def returncode_from_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class LauncherServer(object):
+    """helper process side: single thread serving spawn requests and reaping spawned jobs"""
+
+    def __init__(self, sockfd):
+        self.sockfd = sockfd
+        self.children = set()
+        # standard descriptors are kept open, so received descriptors never collide with them
+        for fd in (0, 1, 2):
+            try:
+                os.fstat(fd)
+            except OSError:
+                os.open(os.devnull, os.O_RDWR)
+        # helper is stopped by closing of the daemon's end of the socket
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.wakeupReader, self.wakeupWriter = os.pipe()
+        for fd in (self.wakeupReader, self.wakeupWriter):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            _set_cloexec(fd)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.wakeupWriter)
+
+    def Serve(self):
+        while True:
+            try:
+                readable, _, _ = select.select([self.sockfd, self.wakeupReader], [], [])
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if self.wakeupReader in readable:
+                try:
+                    os.read(self.wakeupReader, 4096)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            self.reapChildren()
+            if self.sockfd in readable:
+                try:
+                    request = read_frame(self.sockfd)
+                except EOFError:
+                    return
+                fds = [_retry_on_eintr(_multiprocessing.recvfd, self.sockfd) for _ in xrange(request["nfds"])]
+                try:
+                    self.spawn(request, fds)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+
+    def spawn(self, request, fds):
+        errReader, errWriter = os.pipe()
+        _set_cloexec(errWriter)
+        try:
+            pid = os.fork()
+        except OSError, e:
+            os.close(errReader)
+            os.close(errWriter)
+            write_frame(self.sockfd, ("error", request["id"], str(e)))
+            return
+        if not pid:
+            os.close(errReader)
+            self.execChild(request, fds, errWriter)
+        os.close(errWriter)
+        with os.fdopen(errReader) as reader:
+            error = _retry_on_eintr(reader.read)
+        if error:
+            _retry_on_eintr(os.waitpid, pid, 0)
+            write_frame(self.sockfd, ("error", request["id"], error))
+            return
+        self.children.add(pid)
+        write_frame(self.sockfd, ("started", request["id"], pid))
+
+    def execChild(self, request, fds, errWriter):
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGCHLD, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            os.setpgrp()
+            # received descriptors are never less than 3, so they aren't overwritten by dup2
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            for fd in set(fds + [self.sockfd, self.wakeupReader, self.wakeupWriter]):
+                os.close(fd)
+            if request["cwd"]:
+                os.chdir(request["cwd"])
+            os.execvp(request["args"][0], request["args"])
+        except BaseException, e:
+            try:
+                os.write(errWriter, "%s: %s" % (e.__class__.__name__, e))
+            except BaseException:
+                pass
+        finally:
+            os._exit(255)
+
+    def reapChildren(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                self.children.clear()
+                break
+            if not pid:
+                break
+            self.children.discard(pid)
+            write_frame(self.sockfd, ("exited", pid, returncode_from_status(status)))
+
+
+class LaunchedProcess(object):
+    """subprocess.Popen-like object for the job spawned by launcher"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.stdin = None
+        self.returncode = None
+        self.exited = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.exited.wait()
+        return self.returncode
+
+    def setReturnCode(self, returncode):
+        self.returncode = returncode
+        self.exited.set()
+
+
+class LaunchRequest(object):
+    def __init__(self):
+        self.ready = threading.Event()
+        self.process = None
+        self.error = None
+
+
+class JobsLauncher(object):
+    def __init__(self):
+        self.pid = None
+        self.sockfd = None
+        self.alive = False
+        self.sendLock = threading.Lock()
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.processes = {}
+        self.nextRequestId = 0
+
+    def Start(self):
+        daemonSock, helperSock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        fork_locking.acquire_fork()
+        try:
+            pid = os.fork()
+        finally:
+            fork_locking.release_fork()
+        if not pid:
+            exit_code = 0
+            try:
+                daemonSock.close()
+                _close_fds(keep=(helperSock.fileno(), ))
+                LauncherServer(helperSock.fileno()).Serve()
+            except BaseException:
+                exit_code = 1
+            os._exit(exit_code)
+        helperSock.close()
+        self.pid = pid
+        self.sock = daemonSock
+        self.sockfd = daemonSock.fileno()
+        _set_cloexec(self.sockfd)
+        self.alive = True
+        reader = threading.Thread(target=self.readReplies, name="JobsLauncher")
+        reader.setDaemon(True)
+        reader.start()
+        logging.info("launcher\thelper process %s has been started", pid)
+
+    def IsAlive(self):
+        return self.alive
+
+    def Launch(self, args, stdin, stdout, stderr, cwd=None):
+        """spawns process in its own process group, returns LaunchedProcess object"""
+        request = LaunchRequest()
+        with self.lock:
+            if not self.alive:
+                raise RuntimeError("jobs launcher isn't running")
+            requestId = self.nextRequestId
+            self.nextRequestId += 1
+            self.requests[requestId] = request
+        try:
+            with self.sendLock:
+                write_frame(self.sockfd, {"id": requestId, "args": list(args), "cwd": cwd, "nfds": 3})
+                for fd in (stdin, stdout, stderr):
+                    _retry_on_eintr(_multiprocessing.sendfd, self.sockfd, fd)
+        except:
+            with self.lock:
+                self.requests.pop(requestId, None)
+            raise
+        request.ready.wait()
+        if request.error:
+            raise OSError(request.error)
+        return request.process
+
+    def readReplies(self):
+        try:
+            while True:
+                self.processReply(read_frame(self.sockfd))
+        except EOFError:
+            logging.error("launcher\thelper process %s has gone", self.pid)
+        except Exception, e:
+            logging.exception("launcher\treplies reading error: %s", e)
+        with self.lock:
+            self.alive = False
+            requests, self.requests = self.requests, {}
+            processes, self.processes = self.processes, {}
+        for request in requests.itervalues():
+            request.error = "jobs launcher has gone"
+            request.ready.set()
+        for process in processes.itervalues():
+            process.setReturnCode(UNKNOWN_RETURNCODE)
+        try:
+            _retry_on_eintr(os.waitpid, self.pid, 0)
+        except OSError:
+            pass
+
+    def processReply(self, reply):
+        kind = reply[0]
+        if kind == "exited":
+            _, pid, returncode = reply
+            with self.lock:
+                process = self.processes.pop(pid, None)
+            if process is not None:
+                process.setReturnCode(returncode)
+            return
+        _, requestId, value = reply
+        with self.lock:
+            request = self.requests.pop(requestId)
+            if kind == "started":
+                request.process = self.processes[value] = LaunchedProcess(value)
+            else:
+                request.error = value
+        request.ready.set()
+
+
+_launcher = None
+
+
+def StartLauncher():
+    global _launcher
+    if _launcher is None:
+        _launcher = JobsLauncher()
+        _launcher.Start()
+    return _launcher
+
+
+def GetLauncher():
+    """returns running launcher or None if jobs should be started directly"""
+    if _launcher is not None and _launcher.IsAlive():
+        return _launcher
+    return None
@@ -1,12 +1,17 @@
 #OS specific functions
 #Linux/FreeBSD implementation
 from __future__ import with_statement
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import logging
 import os
 import signal
 import stat
 import subprocess
 import sys
+import threading
 import time
 
 import fork_locking
@@ -92,6 +97,118 @@ def get_null_output():
     return open("/dev/null", "w")
 
 
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _load_sendfile():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+
+_sendfile = _load_sendfile() if sys.platform.startswith("linux") else None
+
+FEED_CHUNK_SIZE = 1 << 20
+
+
+def copy_file_to_fd(in_fd, out_fd):
+    """copies file to descriptor (e.g. pipe) by constant-size chunks, in kernel if sendfile() is available"""
+    global _sendfile
+    while _sendfile is not None:
+        sent = _sendfile(out_fd, in_fd, None, FEED_CHUNK_SIZE)
+        if sent > 0:
+            continue
+        if sent == 0:
+            return
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(err, os.strerror(err))
+        # sendfile() into pipe isn't supported by old kernels
+        _sendfile = None
+    while True:
+        data = os.read(in_fd, FEED_CHUNK_SIZE)
+        if not data:
+            return
+        while data:
+            data = data[os.write(out_fd, data):]
+
+
+def _feed_pipe(readers, pipe_fd):
+    try:
+        for reader in readers:
+            copy_file_to_fd(reader.fileno(), pipe_fd)
+    except OSError, e:
+        # EPIPE: consumer has exited without reading all its input
+        if e.errno != errno.EPIPE:
+            logging.warning("osspec	pipe feeding error: %s", e)
+    except:
+        logging.exception("osspec	pipe feeding error")
+    finally:
+        os.close(pipe_fd)
+        for reader in readers:
+            reader.close()
+
+
+def get_concatenated_input(filenames):
+    """returns read end of pipe fed with content of files one by one from separate thread,
+    so no concatenated copy of files is made on disk or in memory"""
+    readers = [open(filename, "r") for filename in filenames]
+    pipe_rd, pipe_wr = os.pipe()
+    _set_cloexec(pipe_wr)
+    feeder = threading.Thread(target=_feed_pipe, args=(readers, pipe_wr), name="PipeFeeder")
+    feeder.setDaemon(True)
+    feeder.start()
+    return os.fdopen(pipe_rd, "r")
+
+
+def _tee_pipe(in_fd, out_fd, writer):
+    try:
+        while True:
+            data = os.read(in_fd, FEED_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            try:
+                while out_fd is not None and data:
+                    data = data[os.write(out_fd, data):]
+            except OSError, e:
+                if e.errno != errno.EPIPE:
+                    raise
+                # consumer has exited, the copy on disk is kept complete anyway
+                os.close(out_fd)
+                out_fd = None
+    except:
+        logging.exception("osspec	pipe teeing error")
+    finally:
+        os.close(in_fd)
+        if out_fd is not None:
+            os.close(out_fd)
+        writer.close()
+
+
+def get_pipe(tee_filename=None):
+    """returns (reader, writer) pair of pipe ends,
+    all data passed through the pipe is copied to tee_filename if it's set"""
+    pipe_rd, pipe_wr = os.pipe()
+    map(_set_cloexec, (pipe_rd, pipe_wr))
+    if tee_filename is None:
+        return os.fdopen(pipe_rd, "r"), os.fdopen(pipe_wr, "w")
+    tee_rd, tee_wr = os.pipe()
+    map(_set_cloexec, (tee_rd, tee_wr))
+    thread = threading.Thread(target=_tee_pipe, args=(pipe_rd, tee_wr, open(tee_filename, "w")), name="PipeTee")
+    thread.setDaemon(True)
+    thread.start()
+    return os.fdopen(tee_rd, "r"), os.fdopen(pipe_wr, "w")
+
+
 def reg_signal_handler(signum, handler):
     signals.register(signum, handler)
 
@@ -106,6 +223,15 @@ def create_symlink(src, dst, reallocate=True):
     return os.symlink(src, dst)
 
 
+def fsync_directory(path):
+    """makes directory entries changes (e.g. rename into the directory) durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def set_common_executable(path):
     mode = os.stat(path)[0] | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
     os.chmod(path, mode)
@@ -5,13 +5,18 @@ import os
 import time
 import shutil
 import errno
+import itertools
 
 from callbacks import CallbackHolder, ICallbackAcceptor, Tag, tagset
 from common import BinaryFile, PickableRLock, SendEmail, Unpickable, safeStringEncode
-from job import Job, PackedExecuteResult
+from job import Job, JobPipeline, PackedExecuteResult
+import constants
 import osspec
 import fork_locking
 
+# generations of memoized packet status (itertools.count is advanced atomically)
+_status_generations = itertools.count(1)
+
 class PacketState(object):
     CREATED = "CREATED"                 #created only packet
     WORKABLE = "WORKABLE"               #working packet without pending jobs
@@ -114,6 +119,7 @@ class JobPacketImpl(object):
             tag.AddCallbackListener(self)
         self.allTags = set(tag.GetFullname() for tag in wait_tags)
         self.waitTags = set(tag.GetFullname() for tag in wait_tags if not tag.IsSet())
+        self.invalidateStatus()
 
     def SetDoneTags(self):
         if self.done_indicator:
@@ -124,6 +130,7 @@ class JobPacketImpl(object):
             tagname = tag.GetFullname()
             if tagname in self.waitTags:
                 self.waitTags.remove(tagname)
+                self.invalidateStatus()
             if len(self.waitTags) == 0 and self.state == PacketState.SUSPENDED:
                 self.Resume()
 
@@ -208,6 +215,8 @@ class JobPacketImpl(object):
                 logging.exception("Packet %s release place error", self.id)
         self.directory = None
         self.streams.clear()
+        self.pipeStreams.clear()
+        self.invalidateStatus(self.jobs)
 
     def CreatePlace(self, context):
         if getattr(self, "directory", None):
@@ -229,6 +238,7 @@ class JobPacketImpl(object):
         osspec.set_common_executable(self.directory)
         self.CreateLinks(context)
         self.streams = dict()
+        self.pipeStreams = set()
 
     def ListFiles(self):
         files = []
@@ -239,7 +249,7 @@ class JobPacketImpl(object):
                 logging.exception("directory %s listing error", self.directory)
         return files
 
-    def GetFile(self, filename):
+    def getFilePath(self, filename):
         if not self.directory:
             raise RuntimeError("working directory doesn't exist")
         path = os.path.join(self.directory, filename)
@@ -247,16 +257,33 @@ class JobPacketImpl(object):
             raise AttributeError("not existing file: %s" % filename)
         if os.path.dirname(path) != self.directory:
             raise AttributeError("file %s is outside working directory" % filename)
-        with open(path, "r") as reader:
+        return path
+
+    def GetFile(self, filename):
+        with open(self.getFilePath(filename), "r") as reader:
             data = reader.read()
             return data
 
+    def GetFileRange(self, filename, offset=0, length=None, tail=None):
+        """returns (data, offset, file_size), data is read from offset or tail bytes before the end of file,
+        length is limited by constants.MAX_FILE_CHUNK_SIZE"""
+        with open(self.getFilePath(filename), "r") as reader:
+            size = os.fstat(reader.fileno()).st_size
+            if tail is not None:
+                offset = max(size - tail, 0)
+            offset = min(max(offset, 0), size)
+            if length is None or length > constants.MAX_FILE_CHUNK_SIZE:
+                length = constants.MAX_FILE_CHUNK_SIZE
+            reader.seek(offset)
+            return reader.read(max(length, 0)), offset, size
+
     """process internal job start/stop"""
 
     def ProcessJobStart(self, job):
         job.input = self.createInput(job.id)
         job.output = self.createOutput(job.id)
         self._add_working(job)
+        self.invalidateStatus([job.id])
 
     def _add_working(self, job):
         self.working.add(job.id)
@@ -272,6 +299,7 @@ class JobPacketImpl(object):
             self.working.clear()
             if self._working_empty:
                 self._working_empty.notify_all()
+        self.invalidateStatus()
 
     def _wait_working_empty(self):
         if not self.working:
@@ -289,20 +317,14 @@ class JobPacketImpl(object):
         nState, nTimeout = None, 0
         self._remove_working(job)
         result = job.Result()
+        head = self.pipelineHead(job.id)
+        if head in self.pipelineRuns:
+            return self.processPipelineJobDone(head, job, result)
         if self.state in (PacketState.NONINITIALIZED, PacketState.SUSPENDED):
             self.leafs.add(job.id)
         elif result is not None and result.IsSuccessfull():
-            self.done.add(job.id)
-            if self.job_done_indicator.get(job.id):
-                self.job_done_indicator[job.id].Set()
-            for nid in self.edges[job.id]:
-                self.waitJobs[nid].remove(job.id)
-                if not self.waitJobs[nid]:
-                    self.leafs.add(nid)
-            if len(self.done) == len(self.jobs):
-                nState = PacketState.SUCCESSFULL
-            elif self.leafs and self.state != PacketState.WAITING:
-                nState = PacketState.PENDING
+            self.markJobDone(job.id)
+            nState = self.stateAfterJobsDone()
         elif result is None or result.CanRetry():
             self.leafs.add(job.id)
             nState = PacketState.WAITING
@@ -313,6 +335,88 @@ class JobPacketImpl(object):
             nState = PacketState.ERROR
         return nState, nTimeout
 
+    def processPipelineJobDone(self, head, job, result):
+        """pipeline is done when all its jobs are finished, whole pipeline is restarted after any error
+        (outputs of its jobs have been consumed by the failed ones and aren't saved anywhere)"""
+        results = self.pipelineRuns[head]
+        results[job.id] = result
+        members = self.pipelineMembers(head)
+        failed = [self.jobs[jid] for jid, res in results.iteritems() if res is None or not res.IsSuccessfull()]
+        if failed:
+            self.closePipelineStreams(members)
+        if len(results) < len(members):
+            return None, 0
+        del self.pipelineRuns[head]
+        if self.state in (PacketState.NONINITIALIZED, PacketState.SUSPENDED):
+            self.leafs.add(head)
+            return None, 0
+        if not failed:
+            for jid in members:
+                self.markJobDone(jid)
+            return self.stateAfterJobsDone(), 0
+        if all(fjob.Result() is None or fjob.Result().CanRetry() for fjob in failed):
+            self.leafs.add(head)
+            nTimeout = max(getattr(fjob, "retry_delay", None) or fjob.ERR_PENALTY_FACTOR ** fjob.tries
+                           for fjob in failed)
+            logging.debug("packet %s\tpipeline %s is waiting for %s sec", self.name, head, nTimeout)
+            return PacketState.WAITING, nTimeout
+        self.result = PackedExecuteResult(len(self.done), len(self.jobs))
+        return PacketState.ERROR, 0
+
+    def markJobDone(self, jid):
+        self.done.add(jid)
+        if self.job_done_indicator.get(jid):
+            self.job_done_indicator[jid].Set()
+        for nid in self.edges[jid]:
+            if self.jobs[nid].streaming:
+                continue
+            self.waitJobs[nid].remove(jid)
+            if not self.waitJobs[nid]:
+                self.leafs.add(nid)
+
+    def stateAfterJobsDone(self):
+        if len(self.done) == len(self.jobs):
+            return PacketState.SUCCESSFULL
+        elif self.leafs and self.state != PacketState.WAITING:
+            return PacketState.PENDING
+
+    """streaming pipelines methods"""
+
+    def pipelineHead(self, jid):
+        job = self.jobs[jid]
+        while job.streaming:
+            job = self.jobs[job.inputs[0]]
+        return job.id
+
+    def pipelineMembers(self, head):
+        """returns list of jobs connected with head by streaming edges (head is the first one)"""
+        members = [head]
+        for jid in members:
+            members.extend(nid for nid in self.edges[jid] if self.jobs[nid].streaming)
+        return members
+
+    def streamingConsumer(self, jid):
+        for nid in self.edges[jid]:
+            if self.jobs[nid].streaming:
+                return nid
+        return None
+
+    def createPipelineStreams(self, members):
+        for jid in members[1:]:
+            job = self.jobs[jid]
+            pid, = job.inputs
+            tee_filename = os.path.join(self.directory, "out-%s" % pid) if job.stream_tee else None
+            reader, writer = osspec.get_pipe(tee_filename)
+            self.setStream(("in", jid), reader, pipe=True)
+            self.setStream(("out", pid), writer, pipe=True)
+
+    def closePipelineStreams(self, members):
+        for jid in members:
+            for key in (("in", jid), ("out", jid)):
+                stream = self.streams.get(key)
+                if stream is not None and self.isPipeStream(key) and not stream.closed:
+                    stream.close()
+
 
 # job module.
 class JobPacket(Unpickable(lock=PickableRLock,
@@ -331,6 +435,9 @@ class JobPacket(Unpickable(lock=PickableRLock,
                            flags=int,
                            kill_all_jobs_on_error=(bool, True),
                            _working_empty=lambda : None,
+                           pipelineRuns=dict,
+                           statusCache=dict,
+                           pipeStreams=set,
                            isResetable=(bool, True)),
                 CallbackHolder,
                 ICallbackAcceptor,
@@ -363,6 +470,9 @@ class JobPacket(Unpickable(lock=PickableRLock,
 
         sdict.pop('waitingTime', None) # obsolete
         sdict.pop('_working_empty', None)
+        sdict.pop('pipelineRuns', None)
+        sdict.pop('statusCache', None)
+        sdict.pop('pipeStreams', None)
 
         return sdict
 
@@ -381,41 +491,60 @@ class JobPacket(Unpickable(lock=PickableRLock,
         if stream is not None:
             if not stream.closed:
                 stream.close()
-            if stream.name != "<uninitialized file>":
+            if stream.name != "<uninitialized file>" and (type, jid) not in self.pipeStreams:
                 return stream.name
         filename = os.path.join(self.directory, "%s-%s" % (type, jid))
         if os.path.isfile(filename):
             return filename
         return None
 
+    def setStream(self, key, stream, pipe=False):
+        """pipe ends are recorded, so they are never taken for files"""
+        self.streams[key] = stream
+        if pipe:
+            self.pipeStreams.add(key)
+        else:
+            self.pipeStreams.discard(key)
+        return stream
+
+    def isPipeStream(self, key):
+        return key in self.pipeStreams
+
     def createInput(self, jid):
         if jid in self.jobs:
-            filename = self.stream_file(jid, "in")
             job = self.jobs[jid]
+            if job.streaming:
+                stream = self.streams.get(("in", jid))
+                if stream is None or stream.closed:
+                    # pipeline has been broken before the job start
+                    stream = self.setStream(("in", jid), osspec.get_null_input())
+                return stream
+            filename = self.stream_file(jid, "in")
             if filename is not None:
-                stream = self.streams[("in", jid)] = open(filename, "r")
+                stream = self.setStream(("in", jid), open(filename, "r"))
             elif len(job.inputs) == 0:
-                stream = self.streams[("in", jid)] = osspec.get_null_input()
+                stream = self.setStream(("in", jid), osspec.get_null_input())
             elif len(job.inputs) == 1:
                 pid, = job.inputs
                 logging.debug("pid: %s, pck_id: %s", pid, self.id)
-                stream = self.streams[("in", jid)] = open(self.stream_file(pid, "out"), "r")
+                stream = self.setStream(("in", jid), open(self.stream_file(pid, "out"), "r"))
             else:
-                with open(os.path.join(self.directory, "in-%s" % jid), "w") as writer:
-                    for pid in job.inputs:
-                        with open(self.streams[("out", pid)].name, "r") as reader:
-                            writer.write(reader.read())
-                stream = self.streams[("in", jid)] = open(writer.name, "r")
+                stream = self.setStream(("in", jid), osspec.get_concatenated_input(
+                    [self.stream_file(pid, "out") for pid in job.inputs]), pipe=True)
             return stream
         raise RuntimeError("alien job input request")
 
     def createOutput(self, jid):
         if jid in self.jobs:
+            if self.streamingConsumer(jid) is not None:
+                stream = self.streams.get(("out", jid))
+                if stream is None or stream.closed:
+                    stream = self.setStream(("out", jid), osspec.get_null_output())
+                return stream
             filename = self.stream_file(jid, "out")
             if filename is None:
                 filename = os.path.join(self.directory, "out-%s" % jid)
-            stream = self.streams[("out", jid)] = open(filename, "w")
-            return stream
+            return self.setStream(("out", jid), open(filename, "w"))
         raise RuntimeError("alien job output request")
 
     def canChangeState(self, state):
@@ -437,6 +566,7 @@ class JobPacket(Unpickable(lock=PickableRLock,
         logging.debug("packet %s\tnew state %r", self.name, self.state)
         self.FireEvent("change")
         self.history.append((self.state, time.time()))
+        self.invalidateStatus()
         PacketCustomLogic(self).DoChangeStateAction()
         return True
 
@@ -462,34 +592,55 @@ class JobPacket(Unpickable(lock=PickableRLock,
         if isinstance(ref, Job):
             logging.debug("job %s\tdone [%s]", ref.shell, ref.Result())
             self.FireEvent("job_done", ref)
+            nState = None
             if ref.id in self.jobs and ref.id in self.working:
                 with self.lock:
                     nState, nTimeout = self.ProcessJobDone(ref)
-                if nState:
-                    if nState == PacketState.WAITING:
-                        self.waitingDeadline = time.time() + nTimeout
-                    self.changeState(nState)
+            # job results have been changed before the event
+            self.invalidateStatus([ref.id])
+            if nState:
+                if nState == PacketState.WAITING:
+                    self.waitingDeadline = time.time() + nTimeout
+                self.changeState(nState)
         elif isinstance(ref, Tag):
             self.ProcessTagEvent(ref)
 
     def Add(self, shell, parents, pipe_parents, set_tag, tries,
-            max_err_len, retry_delay, pipe_fail, description, notify_timeout, max_working_time, output_to_status):
+            max_err_len, retry_delay, pipe_fail, description, notify_timeout, max_working_time, output_to_status,
+            streaming=False, stream_tee=False):
         if self.state not in (PacketState.CREATED, PacketState.SUSPENDED):
             raise RuntimeError("incorrect state for \"Add\" operation: %s" % self.state)
         with self.lock:
             parents = list(set(p.id for p in parents + pipe_parents))
             pipe_parents = list(p.id for p in pipe_parents)
+            self.checkStreamingEdges(parents, pipe_parents, streaming, stream_tee)
             job = Job(shell, parents, pipe_parents, self, maxTryCount=tries,
                       limitter=None, max_err_len=max_err_len, retry_delay=retry_delay,
-                      pipe_fail=pipe_fail, description=description, notify_timeout=notify_timeout, max_working_time=max_working_time, output_to_status=output_to_status)
+                      pipe_fail=pipe_fail, description=description, notify_timeout=notify_timeout, max_working_time=max_working_time, output_to_status=output_to_status,
+                      streaming=streaming, stream_tee=stream_tee)
             self.jobs[job.id] = job
             if set_tag:
                 self.job_done_indicator[job.id] = set_tag
             self.edges[job.id] = []
             for p in parents:
                 self.edges[p].append(job.id)
+            self.invalidateStatus()
             return job
 
+    def checkStreamingEdges(self, parents, pipe_parents, streaming, stream_tee):
+        if streaming:
+            if len(pipe_parents) != 1 or parents != pipe_parents:
+                raise RuntimeError("streaming job must have exactly one parent passed as pipe_parents")
+            pid, = pipe_parents
+            if self.streamingConsumer(pid) is not None:
+                raise RuntimeError("output of job %s is already streamed to another job" % pid)
+            if not stream_tee and any(pid in self.jobs[nid].inputs for nid in self.edges[pid]):
+                raise RuntimeError("output of job %s is read from file by other jobs, stream_tee is needed" % pid)
+        for pid in pipe_parents:
+            nid = self.streamingConsumer(pid)
+            if nid is not None and not self.jobs[nid].stream_tee:
+                raise RuntimeError("output of job %s is streamed to job %s without stream_tee" % (pid, nid))
+
     def UpdateJobsDependencies(self):
         def visit(startJID):
             st = [[startJID, 0]]
@@ -502,7 +653,9 @@ class JobPacket(Unpickable(lock=PickableRLock,
                 if num < len(adj):
                     st[-1][1] += 1
                     nid = adj[num]
-                    self.waitJobs[nid].add(jid)
+                    # streaming jobs are started together with their pipe parents
+                    if not self.jobs[nid].streaming:
+                        self.waitJobs[nid].add(jid)
                     if nid not in discovered:
                         discovered.add(nid)
                         st.append([nid, 0])
@@ -513,6 +666,13 @@ class JobPacket(Unpickable(lock=PickableRLock,
                     finished.add(jid)
 
         with self.lock:
+            self.pipelineRuns.clear()
+            # pipelines are restarted from their heads, streamed outputs aren't saved
+            for jid, job in self.jobs.iteritems():
+                if job.streaming and jid not in self.done:
+                    while job.streaming:
+                        job = self.jobs[job.inputs[0]]
+                        self.done.discard(job.id)
             discovered = set()
             finished = set()
             self.waitJobs = dict((jid, set()) for jid in self.jobs if jid not in self.done)
@@ -522,7 +682,8 @@ class JobPacket(Unpickable(lock=PickableRLock,
                     #reset tries count for discovered jobs
             for jid in discovered:
                 self.jobs[jid].tries = 0
-            self.leafs = set(jid for jid in discovered if not self.waitJobs[jid])
+            self.leafs = set(jid for jid in discovered if not self.waitJobs[jid] and not self.jobs[jid].streaming)
+        self.invalidateStatus()
 
     def Resume(self, resumeWorkable=False):
         allowed_states = [PacketState.CREATED, PacketState.SUSPENDED]
@@ -548,11 +709,18 @@ class JobPacket(Unpickable(lock=PickableRLock,
             self.lock.acquire()
             for leaf in self.leafs:
                 if self.jobs[leaf].CanStart():
-                    self.FireEvent("job_get", self.jobs[leaf])
+                    members = self.pipelineMembers(leaf)
+                    for jid in members:
+                        self.FireEvent("job_get", self.jobs[jid])
                     self.leafs.remove(leaf)
+                    if len(members) > 1:
+                        self.pipelineRuns[leaf] = {}
+                        self.createPipelineStreams(members)
+                        return JobPipeline([self.jobs[jid] for jid in members])
                     return self.jobs[leaf]
         finally:
             self.lock.release()
+            self.invalidateStatus()
             if not self.leafs:
                 self.changeState(PacketState.WORKABLE)
 
@@ -562,20 +730,49 @@ class JobPacket(Unpickable(lock=PickableRLock,
     def History(self):
         return self.history or []
 
+    def invalidateStatus(self, jids=None):
+        """drops memoized status; jids - jobs which results or output files have been changed"""
+        cache = self.statusCache
+        if jids:
+            jobGenerations = cache.setdefault("job_generations", {})
+            for jid in jids:
+                jobGenerations[jid] = next(_status_generations)
+        cache["generation"] = next(_status_generations)
+
     def Status(self):
-        history = self.History()
+        """status is rebuilt only after packet changes, time dependent fields are computed on every call"""
+        cache = self.statusCache
+        memo = cache.get("packet")
+        if memo is None or memo[0] != cache.get("generation"):
+            memo = cache["packet"] = self.buildStatus()
+        _, status, wait_time, wait_start = memo
+        now = time.time()
+        status = status.copy()
+        if wait_start is not None:
+            wait_time += now - wait_start
+        status["wait_time"] = wait_time
+        if status["state"] == PacketState.WAITING:
+            status["waiting_time"] = max(int(self.waitingDeadline - now), 0)
+        return status
+
+    def buildStatus(self):
+        """returns (generation, status, closed waiting intervals time, start of current waiting interval)"""
+        cache = self.statusCache
+        generation = cache.get("generation")
+        history = list(self.History())
         total_time = history[-1][1] - history[0][1]
         wait_time = 0
+        wait_start = None
 
-        for ((state, start_time), (_, end_time)) in zip(history, history[1:] + [("", time.time())]):
+        for ((state, start_time), (_, end_time)) in zip(history, history[1:] + [("", None)]):
             if state in (PacketState.SUSPENDED, PacketState.WAITING):
-                wait_time += end_time - start_time
+                if end_time is None:
+                    wait_start = start_time
+                else:
+                    wait_time += end_time - start_time
 
         result_tag = self.done_indicator.name if self.done_indicator else None
 
-        waiting_time = max(int(self.waitingDeadline - time.time()), 0) \
-            if self.state == PacketState.WAITING else None
-
         all_tags = list(getattr(self, 'allTags', []))
 
         status = dict(name=self.name,
@@ -586,9 +783,9 @@ class JobPacket(Unpickable(lock=PickableRLock,
                       priority=self.priority,
                       history=history,
                       total_time=total_time,
-                      wait_time=wait_time,
+                      wait_time=None,
                       last_modified=history[-1][1],
-                      waiting_time=waiting_time)
+                      waiting_time=None)
         extra_flags = set()
         if self.state == PacketState.ERROR and self.CheckFlag(PacketFlag.RCVR_ERROR):
             extra_flags.add("can't-be-recovered")
@@ -601,15 +798,18 @@ class JobPacket(Unpickable(lock=PickableRLock,
                           PacketState.WORKABLE, PacketState.PENDING,
                           PacketState.SUCCESSFULL, PacketState.WAITING):
             status["jobs"] = []
-            for jid, job in self.jobs.iteritems():
+            jobsCache = cache.setdefault("jobs", {})
+            jobGenerations = cache.setdefault("job_generations", {})
+            for jid, job in self.jobs.items():
+                memo = jobsCache.get(jid)
+                if memo is None or memo[0] != jobGenerations.get(jid):
+                    memo = jobsCache[jid] = (jobGenerations.get(jid), self.buildJobStatus(job))
+                jobStatus = memo[1]
                 result = job.Result()
-                results = []
-                if result:
-                    results = [safeStringEncode(str(res)) for res in job.results]
 
                 state = "done" if jid in self.done \
                     else "working" if jid in self.working \
-                    else "pending" if jid in self.leafs \
+                    else "pending" if jid in self.leafs or (job.streaming and self.pipelineHead(jid) in self.leafs) \
                     else "errored" if result and not result.IsSuccessfull() \
                     else "suspended"
 
@@ -617,27 +817,26 @@ class JobPacket(Unpickable(lock=PickableRLock,
                 if self.state == PacketState.WORKABLE:
                     wait_jobs = map(str, self.waitJobs.get(jid, []))
 
-                parents = map(str, job.parents or [])
-                pipe_parents = map(str, job.inputs or [])
-
-                output_filename = None
-                if getattr(job, 'output', None) and os.path.isfile(job.output.name):
-                    output_filename = os.path.basename(job.output.name)
-
-
-                status["jobs"].append(
-                    dict(id=str(job.id),
-                         shell=job.shell,
-                         desc=job.description,
-                         state=state,
-                         results=results,
-                         parents=parents,
-                         pipe_parents=pipe_parents,
-                         output_filename=output_filename,
-                         wait_jobs=wait_jobs,
-                     )
-                )
-        return status
+                status["jobs"].append(dict(jobStatus, state=state, wait_jobs=wait_jobs))
+        return generation, status, wait_time, wait_start
+
+    def buildJobStatus(self, job):
+        """job status fields which are changed only with job results or output file"""
+        results = []
+        if job.Result():
+            results = [safeStringEncode(str(res)) for res in job.results]
+
+        output_filename = None
+        if getattr(job, 'output', None) and os.path.isfile(job.output.name):
+            output_filename = os.path.basename(job.output.name)
+
+        return dict(id=str(job.id),
+                    shell=job.shell,
+                    desc=job.description,
+                    results=results,
+                    parents=map(str, job.parents or []),
+                    pipe_parents=map(str, job.inputs or []),
+                    output_filename=output_filename)
 
     def AddBinary(self, binname, file):
         self.AddLink(binname, file)
@@ -647,9 +846,11 @@ class JobPacket(Unpickable(lock=PickableRLock,
 
     def SetFlag(self, flag):
         self.flags |= flag
+        self.invalidateStatus()
 
     def ClearFlag(self, flag):
         self.flags &= ~flag
+        self.invalidateStatus()
 
     def UserSuspend(self, kill_jobs=False):
         self.SetFlag(PacketFlag.USER_SUSPEND)
@@ -699,11 +900,13 @@ class JobPacket(Unpickable(lock=PickableRLock,
         self.done.clear()
         for job in self.jobs.values():
             job.results = []
+        self.invalidateStatus(self.jobs)
         self.FireEvent("packet_reinit_request")
 
     def OnReset(self, (ref, message)):
         if isinstance(ref, Tag):
             self.waitTags.add(ref.GetFullname())
+            self.invalidateStatus()
             if self.isResetable:
                 if self.state == PacketState.SUCCESSFULL and self.done_indicator:
                     self.done_indicator.Reset(message)
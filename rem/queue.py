@@ -1,13 +1,105 @@
 from __future__ import with_statement
+import bisect
 import itertools
 import time
 import logging
+import re
+import sre_constants
+import sre_parse
 
 from common import emptyset, TimedSet, PackSet, PickableRLock, Unpickable
 from callbacks import CallbackHolder, ICallbackAcceptor
 from packet import JobPacket, PacketCustomLogic, PacketState
 
 
+def RegexPrefix(regex):
+    """returns literal prefix of all strings matched by compiled regex"""
+    if regex.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE):
+        return ""
+    prefix = []
+    try:
+        items = sre_parse.parse(regex.pattern)
+    except sre_constants.error:
+        return ""
+    for op, arg in items:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(chr(arg))
+    return "".join(prefix)
+
+
+class PacketsListingIndex(object):
+    """packets of queue ordered by names and by modification times for fast paginated listing
+    modification index is append-only, packets changed later are skipped at reading
+    (they are met again with the new modification time), stale items are removed in batch"""
+    KEY_SLACK = 1.0
+
+    def __init__(self, packets=()):
+        self.modified = {}
+        self.byName = []
+        self.byTime = []
+        self.lastKey = 0
+        for pck in packets:
+            history = pck.History()
+            self.modified[pck] = history[-1][1] if history else 0
+            self.byName.append((pck.name, pck.id, pck))
+        self.byName.sort()
+        self.byTime = sorted((tm, pck.id, pck) for pck, tm in self.modified.iteritems())
+        if self.byTime:
+            self.lastKey = self.byTime[-1][0]
+
+    def Update(self, pck):
+        # packet history is appended after change notification, so current time is used as a key;
+        # keys are kept monotonic, so changes are appended to the end of index
+        key = max(time.time(), self.lastKey)
+        if pck not in self.modified:
+            bisect.insort(self.byName, (pck.name, pck.id, pck))
+        elif self.modified[pck] == key:
+            return
+        self.modified[pck] = self.lastKey = key
+        self.byTime.append((key, pck.id, pck))
+        if len(self.byTime) > 2 * len(self.modified) + 1000:
+            self.byTime = [item for item in self.byTime if self.modified.get(item[2]) == item[0]]
+
+    def Remove(self, pck):
+        if self.modified.pop(pck, None) is None:
+            return
+        item = (pck.name, pck.id, pck)
+        pos = bisect.bisect_left(self.byName, item)
+        if pos < len(self.byName) and self.byName[pos] == item:
+            del self.byName[pos]
+
+    def IterByName(self, prefix="", cursor=None):
+        """yields (cursor, packet) pairs ordered by names starting after cursor"""
+        start = (prefix, )
+        if cursor and tuple(cursor) > start:
+            start = tuple(cursor)
+        for pos in xrange(bisect.bisect_left(self.byName, start), len(self.byName)):
+            name, pck_id, pck = self.byName[pos]
+            if not name.startswith(prefix):
+                break
+            if cursor and (name, pck_id) <= tuple(cursor):
+                continue
+            yield [name, pck_id], pck
+
+    def IterByTime(self, last_modified=None, cursor=None):
+        """yields (cursor, packet) pairs ordered by modification time starting after cursor"""
+        # keys may be a bit less than history times, exact times are checked below
+        start = ((last_modified or 0) - self.KEY_SLACK, )
+        if cursor and tuple(cursor) > start:
+            start = tuple(cursor)
+        for pos in xrange(bisect.bisect_left(self.byTime, start), len(self.byTime)):
+            key, pck_id, pck = self.byTime[pos]
+            if self.modified.get(pck) != key:
+                continue
+            if cursor and (key, pck_id) <= tuple(cursor):
+                continue
+            history = pck.History()
+            if last_modified and (not history or history[-1][1] < last_modified):
+                continue
+            yield [key, pck_id], pck
+
+
 class Queue(Unpickable(pending=PackSet.create,
                        worked=TimedSet.create,
                        errored=TimedSet.create,
@@ -21,13 +113,16 @@ class Queue(Unpickable(pending=PackSet.create,
                        successForgetTm=int,
                        workingLimit=(int, 1),
                        success_lifetime=(int, 0),
-                       errored_lifetime=(int, 0)),
+                       errored_lifetime=(int, 0),
+                       packetViews=lambda: None,
+                       listingIndex=lambda: None),
             CallbackHolder,
             ICallbackAcceptor):
     VIEW_BY_ORDER = "pending", "waited", "errored", "suspended", "worked", "noninitialized"
     VIEW_BY_STATE = {PacketState.SUSPENDED: "suspended", PacketState.WORKABLE: "suspended",
                      PacketState.PENDING: "pending", PacketState.ERROR: "errored", PacketState.SUCCESSFULL: "worked",
                      PacketState.WAITING: "waited", PacketState.NONINITIALIZED: "noninitialized"}
+    SETTINGS_FIELDS = "isSuspended", "workingLimit", "success_lifetime", "errored_lifetime"
 
     def __init__(self, name):
         super(Queue, self).__init__()
@@ -38,13 +133,46 @@ class Queue(Unpickable(pending=PackSet.create,
         with self.lock:
             for q in self.VIEW_BY_ORDER:
                 sdict[q] = sdict[q].copy()
+        sdict.pop("packetViews", None)
+        sdict.pop("listingIndex", None)
         return sdict
 
+    def getPacketsIndex(self):
+        """returns packet -> view name index, it is built on demand after queue restoring"""
+        if self.packetViews is None:
+            with self.lock:
+                if self.packetViews is None:
+                    index = {}
+                    for qname in self.VIEW_BY_ORDER:
+                        for pck in getattr(self, qname):
+                            if pck in index:
+                                logging.warning("packet %r is in several queues", pck)
+                            index[pck] = qname
+                    self.packetViews = index
+        return self.packetViews
+
+    def getListingIndex(self):
+        if self.listingIndex is None:
+            with self.lock:
+                if self.listingIndex is None:
+                    self.listingIndex = PacketsListingIndex(self.getPacketsIndex())
+        return self.listingIndex
+
+    def GetSettings(self):
+        return dict((attr, getattr(self, attr)) for attr in self.SETTINGS_FIELDS)
+
+    def ApplySettings(self, settings):
+        for attr in self.SETTINGS_FIELDS:
+            if attr in settings:
+                setattr(self, attr, settings[attr])
+
     def SetSuccessLifeTime(self, lifetime):
         self.success_lifetime = lifetime
+        self.FireEvent("queue_change", self)
 
     def SetErroredLifeTime(self, lifetime):
         self.errored_lifetime = lifetime
+        self.FireEvent("queue_change", self)
 
     def OnJobGet(self, ref):
         #lock has been already gotten in Queue.Get
@@ -81,27 +209,30 @@ class Queue(Unpickable(pending=PackSet.create,
 
     def relocatePacket(self, pck):
         dest_queue_name = self.VIEW_BY_STATE.get(pck.state, None)
-        dest_queue = getattr(self, dest_queue_name) if dest_queue_name else None
-        if not (dest_queue and pck in dest_queue):
-            logging.debug("queue %s\tmoving packet %s typed as %s", self.name, pck.name, pck.state)
-            self.movePacket(pck, dest_queue)
-
-    def movePacket(self, pck, dest_queue):
-        src_queue = None
-        for qname in self.VIEW_BY_ORDER:
-            queue = getattr(self, qname, {})
-            if pck in queue:
-                if src_queue is not None:
-                    logging.warning("packet %r is in several queues", pck)
-                src_queue = queue
-        if src_queue != dest_queue:
+        if dest_queue_name:
+            index = self.getListingIndex()
             with self.lock:
-                if src_queue is not None:
-                    src_queue.remove(pck)
-                if dest_queue is not None:
-                    dest_queue.add(pck)
-            if pck.state == PacketState.PENDING:
-                self.FireEvent("task_pending")
+                index.Update(pck)
+        if not (dest_queue_name and self.getPacketsIndex().get(pck) == dest_queue_name):
+            logging.debug("queue %s\tmoving packet %s typed as %s", self.name, pck.name, pck.state)
+            self.movePacket(pck, dest_queue_name)
+
+    def movePacket(self, pck, dest_queue_name):
+        index = self.getPacketsIndex()
+        with self.lock:
+            src_queue_name = index.get(pck)
+            if src_queue_name == dest_queue_name:
+                return
+            if src_queue_name is not None:
+                getattr(self, src_queue_name).remove(pck)
+                del index[pck]
+                if dest_queue_name is None and self.listingIndex is not None:
+                    self.listingIndex.Remove(pck)
+            if dest_queue_name is not None:
+                getattr(self, dest_queue_name).add(pck)
+                index[pck] = dest_queue_name
+        if pck.state == PacketState.PENDING:
+            self.FireEvent("task_pending")
 
     def OnPacketReinitRequest(self, pck):
         self.FireEvent('packet_reinit_request', pck)
@@ -124,7 +255,7 @@ class Queue(Unpickable(pending=PackSet.create,
     def Remove(self, pck):
         if pck.state not in (PacketState.CREATED, PacketState.SUSPENDED, PacketState.ERROR):
             raise RuntimeError("can't remove \"live\" packet from queue")
-        if pck not in self.ListAllPackets():
+        if pck not in self.getPacketsIndex():
             logging.info("%s", list(self.ListAllPackets()))
             raise RuntimeError("packet %s is not in queue %s" % (pck.id, self.name))
         with self.lock:
@@ -133,6 +264,32 @@ class Queue(Unpickable(pending=PackSet.create,
         self.movePacket(pck, None)
 
 
+    def ForgetPacket(self, pck):
+        """removes packet from queue without any events (for backups restoring only)"""
+        index = self.getPacketsIndex()
+        with self.lock:
+            qname = index.pop(pck, None)
+            if qname is not None:
+                getattr(self, qname).remove(pck)
+            if self.listingIndex is not None:
+                self.listingIndex.Remove(pck)
+
+    def RestorePacket(self, pck, dest_queue_name=None, tm=None):
+        """puts packet into queue without any events (for backups restoring only)
+        packet is put into the view by its state if dest_queue_name isn't set,
+        tm is the time of packet adding into worked and errored views"""
+        dest_queue_name = dest_queue_name or self.VIEW_BY_STATE.get(pck.state, None)
+        if dest_queue_name:
+            self.ForgetPacket(pck)
+            with self.lock:
+                if tm is not None:
+                    getattr(self, dest_queue_name).add(pck, tm)
+                else:
+                    getattr(self, dest_queue_name).add(pck)
+                self.getPacketsIndex()[pck] = dest_queue_name
+                if self.listingIndex is not None:
+                    self.listingIndex.Update(pck)
+
     def _CheckStartableJobs(self):
         return self.pending and len(self.working) < self.workingLimit and self.IsAlive()
 
@@ -155,6 +312,9 @@ class Queue(Unpickable(pending=PackSet.create,
                     if pck == pckIncorrect:
                         PacketCustomLogic(pck).DoEmergencyAction()
                         self.pending.pop()
+                        self.getPacketsIndex().pop(pck, None)
+                        if self.listingIndex is not None:
+                            self.listingIndex.Remove(pck)
                         return None
                     else:
                         pckIncorrect = pck
@@ -177,16 +337,49 @@ class Queue(Unpickable(pending=PackSet.create,
             yield pck
 
     def ListPackets(self, filter=None, name_regex=None, prefix=None, last_modified=None):
-        packets = []
-        for pck in self.FilterPackets(filter):
-            if name_regex and not name_regex.match(pck.name):
-                continue
-            if prefix and not pck.name.startswith(prefix):
-                continue
-            if last_modified and (not pck.History() or pck.History()[-1][1] < last_modified):
-                continue
-            packets.append(pck)
-        return packets
+        return self.ListPacketsPage(filter, name_regex, prefix, last_modified)[0]
+
+    def ListPacketsPage(self, filter=None, name_regex=None, prefix=None, last_modified=None, cursor=None, limit=None):
+        """returns list of packets and cursor for the next page (None if there are no more packets)
+        packets are ordered by modification time if last_modified is set and by names otherwise"""
+        filter = filter or "all"
+        if filter not in ("errored", "suspended", "pending", "worked", "working", "waiting", "all"):
+            raise KeyError(filter)
+        if limit is not None and limit <= 0:
+            raise ValueError("page limit must be positive: %r" % (limit,))
+        view_name = {"waiting": "waited"}.get(filter, filter)
+        prefix = prefix or ""
+        if name_regex:
+            regex_prefix = RegexPrefix(name_regex)
+            if regex_prefix.startswith(prefix):
+                prefix = regex_prefix
+            elif not prefix.startswith(regex_prefix):
+                return [], None
+        index = self.getListingIndex()
+        packets, next_cursor = [], None
+        with self.lock:
+            views = self.getPacketsIndex()
+            working = self.GetWorkingPackets() if filter == "working" else None
+            if last_modified:
+                items = index.IterByTime(last_modified, cursor)
+            else:
+                items = index.IterByName(prefix, cursor)
+            for item_cursor, pck in items:
+                if working is not None:
+                    if pck not in working:
+                        continue
+                elif filter != "all" and views.get(pck) != view_name:
+                    continue
+                if name_regex and not name_regex.match(pck.name):
+                    continue
+                if prefix and not pck.name.startswith(prefix):
+                    continue
+                if limit is not None and len(packets) >= limit:
+                    next_cursor = cursor
+                    break
+                packets.append(pck)
+                cursor = item_cursor
+        return packets, next_cursor
 
     def Resume(self, resumeWorkable=False):
         self.isSuspended = False
@@ -199,10 +392,12 @@ class Queue(Unpickable(pending=PackSet.create,
                     pck.changeState(PacketState.ERROR)
                 except:
                     logging.error("can't mark packet %s as errored")
+        self.FireEvent("queue_change", self)
         self.FireEvent("task_pending")
 
     def Suspend(self):
         self.isSuspended = True
+        self.FireEvent("queue_change", self)
 
     def Status(self):
         return {"alive": self.IsAlive(), "pending": len(self.pending), "suspended": len(self.suspended),
@@ -213,6 +408,7 @@ class Queue(Unpickable(pending=PackSet.create,
 
     def ChangeWorkingLimit(self, lmtValue):
         self.workingLimit = int(lmtValue)
+        self.FireEvent("queue_change", self)
         if self._CheckStartableJobs:
             self.FireEvent('task_pending')
 
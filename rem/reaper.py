@@ -0,0 +1,238 @@
+from __future__ import with_statement
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import select
+import signal
+import threading
+import time
+
+import constants
+
+__all__ = ["WatchedProcess", "ProcessReaper", "GetReaper"]
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class WatchedProcess(object):
+    """job process state shared between ProcessReaper and the thread waiting for the job"""
+
+    def __init__(self, process, err_fd, notify_deadline=None, kill_deadline=None, on_notify=None):
+        self.process = process
+        self.err_fd = err_fd
+        self.notify_deadline = notify_deadline
+        self.kill_deadline = kill_deadline
+        self.on_notify = on_notify
+        self.err_chunks = []
+        self.killed_by_timeout = False
+        self.scheduled_deadlines = 0
+        self.finished = threading.Event()
+
+    def Wait(self):
+        self.finished.wait()
+        return self.process.returncode
+
+    def GetErrors(self):
+        return "".join(self.err_chunks)
+
+    def IsFinished(self):
+        return self.finished.isSet()
+
+
+class ProcessReaper(threading.Thread):
+    """single thread watching all running jobs:
+        - stderr of every job is read through one poll() object without blocking
+        - stderr EOF means process exit (exit status is collected right after it)
+        - notify_timeout and max_working_time are processed as deadlines in one heap"""
+    READ_SIZE = 64 * 1024
+    LINGER_MIN_DELAY = 0.001
+
+    def __init__(self):
+        super(ProcessReaper, self).__init__(name="ProcessReaper")
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.incoming = []
+        self.watches = {}
+        self.lingering = set()
+        self.lingerDelay = self.LINGER_MIN_DELAY
+        self.deadlines = []
+        self.staleDeadlines = 0
+        self.poller = select.poll()
+        self.wakeupReader, self.wakeupWriter = os.pipe()
+        for fd in (self.wakeupReader, self.wakeupWriter):
+            _set_nonblocking(fd)
+        self.poller.register(self.wakeupReader, select.POLLIN)
+
+    def Watch(self, process, err_fd, notify_deadline=None, kill_deadline=None, on_notify=None):
+        _set_nonblocking(err_fd)
+        watch = WatchedProcess(process, err_fd, notify_deadline, kill_deadline, on_notify)
+        with self.lock:
+            self.incoming.append(watch)
+        self.Wakeup()
+        return watch
+
+    def Wakeup(self):
+        try:
+            os.write(self.wakeupWriter, "\0")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        errorDelay = 0
+        while True:
+            try:
+                self.processEvents()
+                errorDelay = 0
+            except Exception, e:
+                logging.exception("reaper\tevents processing error %s", e)
+                # repeating error mustn't make the thread spin
+                errorDelay = min(max(errorDelay * 2, self.LINGER_MIN_DELAY), constants.JOB_WATCHER_MAX_DELAY)
+                time.sleep(errorDelay)
+
+    def processEvents(self):
+        self.registerIncoming()
+        try:
+            events = self.poller.poll(self.getPollTimeout())
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, _ in events:
+            if fd == self.wakeupReader:
+                self.drainWakeups()
+            elif fd in self.watches:
+                watch = self.watches[fd]
+                try:
+                    self.readErrors(watch)
+                except Exception, e:
+                    self.dropWatch(watch, e)
+        self.checkLingering()
+        self.processDeadlines()
+
+    def registerIncoming(self):
+        with self.lock:
+            incoming, self.incoming = self.incoming, []
+        for watch in incoming:
+            try:
+                self.poller.register(watch.err_fd, select.POLLIN | select.POLLPRI)
+            except Exception, e:
+                self.dropWatch(watch, e)
+                continue
+            self.watches[watch.err_fd] = watch
+            for deadline, action in ((watch.notify_deadline, "notify"), (watch.kill_deadline, "kill")):
+                if deadline is not None:
+                    heapq.heappush(self.deadlines, (deadline, action, watch))
+                    watch.scheduled_deadlines += 1
+
+    def getPollTimeout(self):
+        timeouts = []
+        if self.deadlines:
+            timeouts.append(self.deadlines[0][0] - time.time())
+        if self.lingering:
+            timeouts.append(self.lingerDelay)
+        if not timeouts:
+            return None
+        return max(min(timeouts), 0) * 1000
+
+    def drainWakeups(self):
+        try:
+            os.read(self.wakeupReader, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def readErrors(self, watch):
+        try:
+            data = os.read(watch.err_fd, self.READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            logging.warning("reaper\tcan't read stderr of process %s: %s", watch.process.pid, e)
+            data = ""
+        if data:
+            watch.err_chunks.append(data)
+            return
+        self.poller.unregister(watch.err_fd)
+        del self.watches[watch.err_fd]
+        # stderr is closed, process is exiting right now (or has closed it explicitly)
+        self.lingering.add(watch)
+        self.lingerDelay = self.LINGER_MIN_DELAY
+
+    def checkLingering(self):
+        if not self.lingering:
+            return
+        for watch in list(self.lingering):
+            try:
+                if watch.process.poll() is None:
+                    continue
+            except Exception, e:
+                self.dropWatch(watch, e)
+                continue
+            self.lingering.remove(watch)
+            self.finish(watch)
+        self.lingerDelay = min(self.lingerDelay * 2, constants.JOB_WATCHER_MAX_DELAY)
+
+    def processDeadlines(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, action, watch = heapq.heappop(self.deadlines)
+            watch.scheduled_deadlines -= 1
+            if watch.IsFinished():
+                self.staleDeadlines -= 1
+                continue
+            if action == "kill":
+                logging.debug("reaper\tprocess %s exceeded max working time", watch.process.pid)
+                watch.killed_by_timeout = True
+                try:
+                    # job is started as process group leader, so all its children are killed too
+                    os.killpg(watch.process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            elif callable(watch.on_notify):
+                try:
+                    watch.on_notify()
+                except Exception, e:
+                    logging.exception("reaper\tnotification error for process %s: %s", watch.process.pid, e)
+
+    def dropWatch(self, watch, error):
+        """stops watching of the process which can't be processed anymore,
+        the process is killed to not leave it running without control"""
+        logging.error("reaper\tprocess %s can't be watched: %s", watch.process.pid, error)
+        if self.watches.get(watch.err_fd) is watch:
+            del self.watches[watch.err_fd]
+            try:
+                self.poller.unregister(watch.err_fd)
+            except (KeyError, ValueError):
+                pass
+        self.lingering.discard(watch)
+        try:
+            os.killpg(watch.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.finish(watch)
+
+    def finish(self, watch):
+        watch.finished.set()
+        self.staleDeadlines += watch.scheduled_deadlines
+        if self.staleDeadlines > len(self.deadlines) / 2:
+            self.deadlines = [item for item in self.deadlines if not item[2].IsFinished()]
+            heapq.heapify(self.deadlines)
+            self.staleDeadlines = 0
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def GetReaper():
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None or not _reaper.isAlive():
+            _reaper = ProcessReaper()
+            _reaper.start()
+        return _reaper
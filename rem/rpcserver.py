@@ -0,0 +1,437 @@
+"""event-loop XML-RPC server
+
+One thread owns all sockets: it accepts connections, reads HTTP requests and writes responses
+using epoll, connections are kept alive between calls. Complete requests are passed to the pool
+of XMLRPCWorker threads through the queue, encoded responses are passed back to the loop with
+a byte written to the wakeup pipe. Neither the loop nor the workers sleep or poll by timeout,
+the loop only wakes up at the expiration time of the least recently active connection.
+The calls queue is bounded by the pool size: if it is full, connections with complete requests
+stop being read until workers take queued calls, so clients are pushed back by TCP."""
+from __future__ import with_statement
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import Queue as StdQueue
+import xmlrpclib
+from collections import OrderedDict, deque
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
+
+from workers import XMLRPCWorker
+
+__all__ = ["XMLRPCServer", "detachable_method"]
+
+
+def detachable_method(func):
+    """method gets detach keyword argument - function which releases worker thread from the call
+    and returns function writing the call result later (see XMLRPCServer.processCall)"""
+    func.detachable_method = True
+    return func
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class HTTPRequest(object):
+    def __init__(self, connection, path, headers, body):
+        self.connection = connection
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class HTTPConnection(object):
+    """HTTP/1.x connection state, all methods are called by the loop thread only"""
+    READ_SIZE = 64 * 1024
+    MAX_HEADERS_SIZE = 64 * 1024
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.chunks = []
+        self.size = 0
+        self.head = None
+        self.output = ""
+        self.busy = False
+        self.keepAlive = True
+        self.closed = False
+        self.lastActivity = time.time()
+
+    def Read(self):
+        """returns False if peer has closed the connection"""
+        while True:
+            try:
+                data = self.sock.recv(self.READ_SIZE)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                if e.args[0] == errno.EINTR:
+                    continue
+                return False
+            if not data:
+                return False
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def ParseRequest(self):
+        """returns HTTPRequest if it has been received completely, raises ValueError for malformed requests"""
+        if self.head is None:
+            data = "".join(self.chunks)
+            self.chunks = [data] if data else []
+            end = data.find("\r\n\r\n")
+            if end < 0:
+                if self.size > self.MAX_HEADERS_SIZE:
+                    raise ValueError("too long request headers")
+                return None
+            lines = data[:end].split("\r\n")
+            method, path, version = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            if method != "POST":
+                raise ValueError("unsupported method %s" % method)
+            connection = headers.get("connection", "").lower()
+            self.keepAlive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+            self.head = (path, headers, end + 4, int(headers.get("content-length", 0)))
+        path, headers, offset, length = self.head
+        if self.size < offset + length:
+            return None
+        data = "".join(self.chunks)
+        body, rest = data[offset:offset + length], data[offset + length:]
+        self.chunks = [rest] if rest else []
+        self.size = len(rest)
+        self.head = None
+        return HTTPRequest(self, path, headers, body)
+
+    def Write(self):
+        """returns True if all output has been written"""
+        while self.output:
+            try:
+                sent = self.sock.send(self.output)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.output = self.output[sent:]
+        return True
+
+    def Close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class XMLRPCServer(SimpleXMLRPCDispatcher):
+    rpc_paths = ("/", "/RPC2")
+    LISTEN_BACKLOG = 128
+    # responses larger than the threshold are compressed if client accepts gzip (as in SimpleXMLRPCRequestHandler)
+    ENCODE_THRESHOLD = 1400
+    IDLE_CONNECTION_TIMEOUT = 600
+
+    def __init__(self, poolsize, address, allow_none=False, encoding=None):
+        SimpleXMLRPCDispatcher.__init__(self, allow_none, encoding)
+        self.poolsize = poolsize
+        self.socket = socket.socket(socket.AF_INET6 if socket.has_ipv6 else socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(self.LISTEN_BACKLOG)
+        self.socket.setblocking(0)
+        # the loop is the only producer of calls, so the queue is bounded by queueCall
+        # (workers are stopped by None put into the queue, it must not block)
+        self.calls = StdQueue.Queue()
+        # (connection, request) pairs waiting for free space in the calls queue
+        self.stalled = deque()
+        self.responsesLock = threading.Lock()
+        self.responses = []
+        # fd -> connection, ordered by the last activity time
+        self.connections = OrderedDict()
+        self.workers = []
+        self.thread = None
+        self.alive = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def Start(self):
+        self.epoll = select.epoll()
+        self.wakeupReader, self.wakeupWriter = os.pipe()
+        for fd in (self.wakeupReader, self.wakeupWriter):
+            _set_nonblocking(fd)
+        self.epoll.register(self.socket.fileno(), select.EPOLLIN)
+        self.epoll.register(self.wakeupReader, select.EPOLLIN)
+        self.alive = True
+        self.workers = [XMLRPCWorker(self.calls, self.processCall) for _ in xrange(self.poolsize)]
+        for worker in self.workers:
+            worker.start()
+        self.thread = threading.Thread(target=self.serveLoop, name="XMLRPCServer")
+        self.thread.start()
+
+    def Stop(self):
+        self.alive = False
+        for worker in self.workers:
+            worker.Kill()
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeupWriter, "\0")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    """loop thread methods"""
+
+    def serveLoop(self):
+        while self.alive:
+            try:
+                events = self.epoll.poll(self.closeIdleConnections())
+            except IOError, e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            try:
+                self.processEvents(events)
+            except Exception, e:
+                logging.exception("rpcserver\tevents processing error: %s", e)
+        for connection in self.connections.values():
+            connection.Close()
+        self.connections.clear()
+        self.epoll.close()
+        self.socket.close()
+
+    def processEvents(self, events):
+        for fd, mask in events:
+            if fd == self.socket.fileno():
+                self.acceptConnections()
+            elif fd == self.wakeupReader:
+                self.drainWakeups()
+            elif fd in self.connections:
+                self.processConnection(self.connections[fd], mask)
+        self.writeResponses()
+        self.queueStalledCalls()
+
+    def acceptConnections(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error("rpcserver\tconnection accepting error: %s", e)
+                return
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = HTTPConnection(sock, address)
+            self.connections[connection.fd] = connection
+            self.epoll.register(connection.fd, select.EPOLLIN)
+
+    def drainWakeups(self):
+        try:
+            os.read(self.wakeupReader, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def processConnection(self, connection, mask):
+        if mask & select.EPOLLOUT:
+            self.writeConnection(connection)
+        if not connection.closed and mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            self.touchConnection(connection)
+            if not connection.Read():
+                self.closeConnection(connection)
+                return
+            self.processInput(connection)
+
+    def processInput(self, connection):
+        # requests of one connection are processed sequentially
+        if connection.busy or connection.closed:
+            return
+        try:
+            request = connection.ParseRequest()
+        except (ValueError, IndexError), e:
+            logging.warning("rpcserver\tbad request from %s: %s", connection.address[0], e)
+            connection.keepAlive = False
+            self.startWriting(connection, self.makeResponse(400, "", False))
+            return
+        if request is not None:
+            connection.busy = True
+            if self.stalled or not self.queueCall(request):
+                # connection isn't read until the request is queued, stalled requests are queued in order
+                self.stalled.append((connection, request))
+                self.epoll.modify(connection.fd, 0)
+                # worker may have taken a call before the request was marked as stalled
+                self.queueStalledCalls()
+
+    def queueStalledCalls(self):
+        while self.stalled:
+            connection, request = self.stalled[0]
+            if not connection.closed:
+                if not self.queueCall(request):
+                    return
+                self.epoll.modify(connection.fd, select.EPOLLIN)
+            self.stalled.popleft()
+
+    def queueCall(self, request):
+        if self.calls.qsize() >= self.poolsize:
+            return False
+        self.calls.put((request, ))
+        return True
+
+    def writeResponses(self):
+        with self.responsesLock:
+            responses, self.responses = self.responses, []
+        for connection, response in responses:
+            if not connection.closed:
+                self.startWriting(connection, response)
+
+    def startWriting(self, connection, response):
+        connection.output = response
+        self.writeConnection(connection)
+        if not connection.closed and connection.output:
+            self.epoll.modify(connection.fd, select.EPOLLIN | select.EPOLLOUT)
+
+    def writeConnection(self, connection):
+        try:
+            if not connection.Write():
+                return
+        except socket.error, e:
+            logging.debug("rpcserver\tresponse writing error for %s: %s", connection.address[0], e)
+            self.closeConnection(connection)
+            return
+        if not connection.keepAlive:
+            self.closeConnection(connection)
+            return
+        self.epoll.modify(connection.fd, select.EPOLLIN)
+        connection.busy = False
+        self.touchConnection(connection)
+        self.processInput(connection)
+
+    def touchConnection(self, connection):
+        connection.lastActivity = time.time()
+        if self.connections.pop(connection.fd, None) is not None:
+            self.connections[connection.fd] = connection
+
+    def closeIdleConnections(self):
+        """closes connections without activity during IDLE_CONNECTION_TIMEOUT,
+        returns poll timeout until the next expiration (-1 if there are no connections)"""
+        while self.connections:
+            connection = next(self.connections.itervalues())
+            timeout = connection.lastActivity + self.IDLE_CONNECTION_TIMEOUT - time.time()
+            if timeout > 0:
+                return timeout
+            if connection.busy:
+                # long calls (e.g. pck_wait) aren't interrupted
+                self.touchConnection(connection)
+            else:
+                logging.debug("rpcserver	closing idle connection from %s", connection.address[0])
+                self.closeConnection(connection)
+        return -1
+
+    def closeConnection(self, connection):
+        if self.connections.pop(connection.fd, None) is not None:
+            try:
+                self.epoll.unregister(connection.fd)
+            except (IOError, ValueError):
+                pass
+        connection.Close()
+
+    """worker threads methods"""
+
+    def sendResponse(self, connection, response):
+        with self.responsesLock:
+            self.responses.append((connection, response))
+        self.wakeup()
+
+    def makeResponse(self, code, body, keepAlive, headers=()):
+        lines = ["HTTP/1.1 %d %s" % (code, "OK" if code == 200 else "Error")]
+        lines.extend("%s: %s" % header for header in headers)
+        lines.append("Content-Length: %d" % len(body))
+        if not keepAlive:
+            lines.append("Connection: close")
+        return "\r\n".join(lines) + "\r\n\r\n" + body
+
+    def makeResultResponse(self, request, response):
+        headers = [("Content-Type", "text/xml")]
+        if len(response) > self.ENCODE_THRESHOLD and "gzip" in request.headers.get("accept-encoding", ""):
+            try:
+                response = xmlrpclib.gzip_encode(response)
+                headers.append(("Content-Encoding", "gzip"))
+            except NotImplementedError:
+                pass
+        return self.makeResponse(200, response, request.connection.keepAlive, headers)
+
+    def processCall(self, request):
+        if self.stalled:
+            # there is free space in the calls queue now
+            self.wakeup()
+        connection = request.connection
+        if request.path not in self.rpc_paths:
+            self.sendResponse(connection, self.makeResponse(404, "", connection.keepAlive))
+            return
+        detached = []
+        failed = []
+        responded = []
+        respondLock = threading.Lock()
+
+        def respondOnce(response):
+            with respondLock:
+                if responded:
+                    return
+                responded.append(True)
+            self.sendResponse(connection, response)
+
+        def detach():
+            detached.append(True)
+
+            def respond(result):
+                response = xmlrpclib.dumps((result,), methodresponse=1, allow_none=self.allow_none,
+                                           encoding=self.encoding)
+                respondOnce(self.makeResultResponse(request, response))
+
+            return respond
+
+        def dispatch(method, params):
+            try:
+                return self.dispatchCall(request, method, params, detach)
+            except:
+                # fault is sent even if the method has been detached before the error
+                failed.append(True)
+                raise
+
+        try:
+            body = request.body
+            if request.headers.get("content-encoding", "identity") == "gzip":
+                body = xmlrpclib.gzip_decode(body)
+            response = self._marshaled_dispatch(body, dispatch)
+        except Exception, e:
+            logging.exception("rpcserver\trequest processing error: %s", e)
+            respondOnce(self.makeResponse(500, "", connection.keepAlive))
+            return
+        if not detached or failed:
+            respondOnce(self.makeResultResponse(request, response))
+
+    def dispatchCall(self, request, method, params, detach):
+        func = self.funcs.get(method)
+        if not func:
+            raise Exception('method "%s" is not supported' % method)
+        log_level = getattr(func, "log_level", None)
+        log_func = getattr(logging, log_level, None) if log_level else None
+        if callable(log_func):
+            username = request.headers.get("x-username", "Unknown")
+            log_func("RPC method (user: %s, host: %s): %s %r", username, request.connection.address[0], method,
+                     params)
+        if getattr(func, "detachable_method", False):
+            return func(*params, **{"detach": detach})
+        return func(*params)
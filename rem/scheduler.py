@@ -1,4 +1,5 @@
 from __future__ import with_statement
+import contextlib
 import shutil
 import time
 import logging
@@ -9,9 +10,9 @@ import gc
 from common import PickableStdQueue, PickableStdPriorityQueue
 import common
 from Queue import Empty
-import cStringIO
-import StringIO
 import itertools
+import threading
+from multiprocessing.pool import ThreadPool
 
 import fork_locking
 from job import FuncJob, FuncRunner
@@ -22,7 +23,11 @@ from packet import JobPacket, PacketState, PacketFlag
 from queue import Queue
 from storages import PacketNamesStorage, TagStorage, ShortStorage, BinaryStorage, GlobalPacketStorage
 from callbacks import ICallbackAcceptor, CallbackHolder
+from backups import ChangesTracker, PacketJournal, DeltaWriter, DeltaReader, SnapshotWriter, SnapshotReader, \
+    SnapshotOutput, SnapshotInput, ValidateSnapshot, ResetsCollector, IsSnapshotFile, LinkTags, UnlinkTags
 import osspec
+from events import EventsFeed
+from workers import TagsEvictor, TagsDispatcher
 
 class SchedWatcher(Unpickable(tasks=PickableStdPriorityQueue.create,
                               lock=PickableLock,
@@ -31,16 +36,26 @@ class SchedWatcher(Unpickable(tasks=PickableStdPriorityQueue.create,
                    ICallbackAcceptor,
                    CallbackHolder):
     def OnTick(self, ref):
-        tm = time.time()
-        while not self.tasks.empty():
-            with self.lock:
+        self.PopReadyTasks()
+
+    def PopReadyTasks(self):
+        """moves already expired tasks to workingQueue
+        returns timeout until the nearest scheduled deadline (None if there are no such tasks)"""
+        hasReadyTasks = False
+        timeout = None
+        with self.lock:
+            tm = time.time()
+            while not self.tasks.empty():
                 runtm, runner = self.tasks.peak()
                 if runtm > tm:
+                    timeout = runtm - tm
                     break
-                else:
-                    self.tasks.get()
-                    self.workingQueue.put(runner)
-                    self.FireEvent("task_pending")
+                self.tasks.get()
+                self.workingQueue.put(runner)
+                hasReadyTasks = True
+        if hasReadyTasks:
+            self.FireEvent("task_pending")
+        return timeout
 
     def AddTaskD(self, deadline, fn, *args, **kws):
         if "skip_logging" in kws:
@@ -49,7 +64,18 @@ class SchedWatcher(Unpickable(tasks=PickableStdPriorityQueue.create,
             skipLoggingFlag = False
         if not skipLoggingFlag:
             logging.debug("new task %r scheduled on %s", fn, time.ctime(deadline))
-        self.tasks.put((deadline, (FuncRunner(fn, args, kws))))
+        runner = FuncRunner(fn, args, kws)
+        with self.lock:
+            if deadline <= time.time():
+                self.workingQueue.put(runner)
+                event = "task_pending"
+            else:
+                isNearest = self.tasks.empty() or deadline < self.tasks.peak()[0]
+                self.tasks.put((deadline, runner))
+                event = "task_scheduled" if isNearest else None
+        # events are fired without SchedWatcher.lock to avoid lock order inversion with Scheduler.lock
+        if event:
+            self.FireEvent(event)
 
     def AddTaskT(self, timeout, fn, *args, **kws):
         self.AddTaskD(time.time() + timeout, fn, *args, **kws)
@@ -140,11 +166,13 @@ class Scheduler(Unpickable(lock=PickableRLock,
                            #storage with knowledge about nonassigned packets (packets that was created but not yet assigned to appropriate queue)
                            schedWatcher=SchedWatcher, #watcher for time scheduled events
                            connManager=ConnectionManager, #connections to others rems
-                           packetNamesTracker=PacketNamesStorage
+                           packetNamesTracker=PacketNamesStorage,
+                           changesTracker=ChangesTracker #packets changed since the last backup
                         ),
                 ICallbackAcceptor):
     BackupFilenameMatchRe = re.compile("sched-(\d+).dump$")
-    UnsuccessfulBackupFilenameMatchRe = re.compile("sched-\d*.dump.tmp$")
+    DeltaBackupFilenameMatchRe = re.compile("sched-(\d+).delta-(\d+).dump$")
+    UnsuccessfulBackupFilenameMatchRe = re.compile("sched-\d*(.delta-\d*)?.dump.tmp$")
     SerializableFields = ["qRef", "tagRef", "binStorage", "tempStorage", "connManager"]
 
     def __init__(self, context):
@@ -159,12 +187,17 @@ class Scheduler(Unpickable(lock=PickableRLock,
             self.context = context
             self.poolSize = context.thread_pool_size
             self.initBackupSystem(context)
+            self.eventsFeed = EventsFeed(context.events_feed_size, context.events_spill_directory,
+                                         context.events_spill_segments)
+            self.tagsEvictor = TagsEvictor(self)
+            self.tagsDispatcher = TagsDispatcher(self)
             context.registerScheduler(self)
         self.binStorage.UpdateContext(self.context)
         self.tagRef.UpdateContext(self.context)
         PacketCustomLogic.UpdateContext(self.context)
         self.connManager.UpdateContext(self.context)
         self.HasScheduledTask = fork_locking.Condition(self.lock)
+        self.notificationsBatches = threading.local()
         self.schedWatcher.UpdateContext(self.context)
 
     def OnWaitingStart(self, ref):
@@ -176,6 +209,15 @@ class Scheduler(Unpickable(lock=PickableRLock,
         self.backupDirectory = context.backup_directory
         self.backupCount = context.backup_count
         self.backupInChild = context.backup_in_child
+        self.backupCompressionLevel = context.backup_compression_level
+        self.incrementalBackupsCount = context.incremental_backups_count
+        self.incrementalBackupsDone = 0
+        self.lastFullBackupTime = None
+        self.packetJournal = PacketJournal(self, context.recent_packets_file, context.journal_commit_delay)
+        self.restorePoolSize = context.restore_pool_size
+        self.restoreProgress = {"state": "ready"}
+        self.restored = threading.Event()
+        self.restored.set()
 
     def initProfiler(self):
         import guppy
@@ -191,10 +233,13 @@ class Scheduler(Unpickable(lock=PickableRLock,
                     if not q.Empty():
                         raise AttributeError("can't delete non-empty queue")
                     self.qRef.pop(qname)
+                    self.packetJournal.MarkQueues()
                     return True
         return False
 
     def Queue(self, qname, create=True):
+        if qname not in self.qRef:
+            self.waitRestored()
         if qname in self.qRef:
             return self.qRef[qname]
         if not create:
@@ -212,6 +257,9 @@ class Scheduler(Unpickable(lock=PickableRLock,
             if self.alive:
                 if not self.schedWatcher.Empty():
                     schedRunner = self.schedWatcher.GetTask()
+                    # several tasks may become ready at once, but task_pending is fired once for them
+                    if not self.schedWatcher.Empty() or self.queues_with_jobs:
+                        self.HasScheduledTask.notify()
                     if schedRunner:
                         return FuncJob(schedRunner)
 
@@ -255,6 +303,17 @@ class Scheduler(Unpickable(lock=PickableRLock,
     def CheckUnsuccessfulBackupFilename(self, filename):
         return bool(self.UnsuccessfulBackupFilenameMatchRe.match(filename))
 
+    def ListDeltaBackups(self, base_timestamp=None):
+        """returns list of (base timestamp, delta timestamp, filename) sorted by timestamps"""
+        deltas = []
+        for filename in os.listdir(self.backupDirectory):
+            match = self.DeltaBackupFilenameMatchRe.match(filename)
+            if match:
+                base, timestamp = int(match.group(1)), int(match.group(2))
+                if base_timestamp is None or base == base_timestamp:
+                    deltas.append((base, timestamp, filename))
+        return sorted(deltas)
+
     @common.logged()
     def forgetOldItems(self):
         for queue_name, queue in self.qRef.copy().iteritems():
@@ -262,13 +321,16 @@ class Scheduler(Unpickable(lock=PickableRLock,
 
         self.binStorage.forgetOldItems()
         self.tempStorage.forgetOldItems()
-        self.tagRef.tofileOldItems()
 
     @common.logged()
     def RollBackup(self, force=False, child_max_working_time=None):
         child_max_working_time = child_max_working_time \
             or self.context.backup_child_max_working_time
 
+        if not self.restored.isSet():
+            logging.warning("scheduler is being restored from backup now, backup skipped")
+            return
+
         if not os.path.isdir(self.backupDirectory):
             os.makedirs(self.backupDirectory)
 
@@ -278,37 +340,69 @@ class Scheduler(Unpickable(lock=PickableRLock,
         start_time = time.time()
 
         self.tagRef.tag_logger.Rotate(start_time)
+        self.packetJournal.Rotate(start_time)
 
         if not self.backupable and not force:
             logging.warning("REM is currently not in backupable state; change it back to backupable as soon as possible")
             return
 
-        def backup(fast_strings):
-            self.SaveBackup(
-                os.path.join(self.backupDirectory, "sched-%.0f.dump" % start_time),
-                cStringIO.StringIO if fast_strings else StringIO.StringIO
-            )
-
-        if self.backupInChild:
-            child = fork_locking.run_in_child(lambda : backup(True), child_max_working_time)
-
-            logging.debug("backup fork stats: %s", child.timings)
-
-            if child.errors:
-                logging.warning("Backup child process stderr: " + child.errors)
-
-            if child.term_status:
-                raise RuntimeError("Child process failed to write backup: %s" \
-                    % osspec.repr_term_status(child.term_status))
+        if not force and self.lastFullBackupTime is not None \
+                and self.incrementalBackupsDone < self.incrementalBackupsCount:
+            self.RollDeltaBackup(start_time)
         else:
-            backup(False)
+            self.RollFullBackup(start_time, child_max_working_time)
 
         backupFiles = sorted(filter(self.CheckBackupFilename, os.listdir(self.backupDirectory)), reverse=True)
         unsuccessfulBackupFiles = filter(self.CheckUnsuccessfulBackupFilename, os.listdir(self.backupDirectory))
-        for filename in backupFiles[self.backupCount:] + unsuccessfulBackupFiles:
+        keptTimestamps = set(map(self.ExtractTimestampFromBackupFilename, backupFiles[:self.backupCount]))
+        orphanedDeltaFiles = [filename for base, _, filename in self.ListDeltaBackups() if base not in keptTimestamps]
+        for filename in backupFiles[self.backupCount:] + unsuccessfulBackupFiles + orphanedDeltaFiles:
             os.unlink(os.path.join(self.backupDirectory, filename))
 
-        self.tagRef.tag_logger.Clear(start_time - self.context.journal_lifetime)
+        # journals are needed since the last full backup for deltas restoring
+        journalFinalTime = min(start_time, self.lastFullBackupTime) - self.context.journal_lifetime
+        self.tagRef.tag_logger.Clear(journalFinalTime)
+        self.packetJournal.Clear(journalFinalTime)
+
+    def RollFullBackup(self, start_time, child_max_working_time):
+        gc.collect() # for JobPacket -> Job -> JobPacket cyclic references
+
+        def backup():
+            self.SaveBackup(os.path.join(self.backupDirectory, "sched-%.0f.dump" % start_time))
+
+        changes = self.changesTracker.Take()
+        try:
+            if self.backupInChild:
+                child = fork_locking.run_in_child(backup, child_max_working_time)
+
+                logging.debug("backup fork stats: %s", child.timings)
+
+                if child.errors:
+                    logging.warning("Backup child process stderr: " + child.errors)
+
+                if child.term_status:
+                    raise RuntimeError("Child process failed to write backup: %s" \
+                        % osspec.repr_term_status(child.term_status))
+            else:
+                backup()
+        except:
+            self.changesTracker.Restore(changes)
+            raise
+
+        self.lastFullBackupTime = int("%.0f" % start_time)
+        self.incrementalBackupsDone = 0
+
+    def RollDeltaBackup(self, start_time):
+        changes = self.changesTracker.Take()
+        try:
+            self.SaveDeltaBackup(
+                os.path.join(self.backupDirectory, "sched-%d.delta-%.0f.dump" % (self.lastFullBackupTime, start_time)),
+                changes.values()
+            )
+        except:
+            self.changesTracker.Restore(changes)
+            raise
+        self.incrementalBackupsDone += 1
 
     def SuspendBackups(self):
         self.backupable = False
@@ -323,25 +417,26 @@ class Scheduler(Unpickable(lock=PickableRLock,
         self.backupInChild = True
 
     def Serialize(self, out):
-        import cPickle as pickle
-
-        sdict = {k: getattr(self, k) for k in self.SerializableFields}
-        sdict['qRef'] = sdict['qRef'].copy()
-
-        p = pickle.Pickler(out, 2)
-        p.dump(sdict)
-
-    def SaveBackup(self, filename, string_cls=StringIO.StringIO):
+        queues = self.qRef.values()
+        writer = SnapshotWriter(out)
+        writer.WriteHeader(queues)
+        writer.WriteStorages(self.binStorage, self.connManager, self.tempStorage)
+        writer.WriteTags(self.tagRef)
+        for q in queues:
+            writer.WriteQueue(q)
+        writer.WriteTrailer()
+
+    def SaveBackup(self, filename):
         tmpFilename = filename + ".tmp"
-        with open(tmpFilename, "w") as out:
-            mem_out = string_cls()
-            try:
-                self.Serialize(mem_out)
-                out.write(mem_out.getvalue())
-            finally:
-                mem_out.close()
+        out = SnapshotOutput(tmpFilename, self.backupCompressionLevel)
+        try:
+            self.Serialize(out)
+            out.Finish()
+        finally:
+            out.close()
 
         os.rename(tmpFilename, filename)
+        osspec.fsync_directory(os.path.dirname(filename) or ".")
 
         if self.context.useMemProfiler:
             try:
@@ -353,6 +448,20 @@ class Scheduler(Unpickable(lock=PickableRLock,
             except Exception, e:
                 logging.exception("%s", e)
 
+    def SaveDeltaBackup(self, filename, packets):
+        tmpFilename = filename + ".tmp"
+        with open(tmpFilename, "w") as out:
+            writer = DeltaWriter(out)
+            writer.WriteQueues(self.qRef.values())
+            writer.WriteStorages(self.binStorage, self.connManager, self.tempStorage)
+            for pck in packets:
+                writer.WritePacket(pck)
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmpFilename, filename)
+        osspec.fsync_directory(os.path.dirname(filename) or ".")
+        logging.debug("delta backup %s saved: %d changed packets", filename, len(packets))
+
     def __reduce__(self):
         return nullobject, ()
 
@@ -396,7 +505,30 @@ class Scheduler(Unpickable(lock=PickableRLock,
 
         return sdict, packets_registrator.packets
 
-    def LoadBackup(self, filename, restorer=None):
+    def LoadBackup(self, filename, restorer=None, background=False):
+        """restores scheduler state from the backup file and all backups and journals made after it
+        in background mode queues are restored one by one in separate thread
+        after the rest of scheduler state (tags, binaries, etc.) has been restored"""
+        self.restoreProgress = {"state": "restoring", "backup": filename, "started": time.time(),
+                                "queues": 0, "packets": 0, "broken-records": 0}
+        if IsSnapshotFile(filename):
+            self.loadSnapshot(filename, restorer, background)
+        else:
+            self.loadOldBackup(filename, restorer)
+            self.finishRestore()
+
+    def readChanges(self, sdict, backupTimestamp):
+        changes = DeltaReader(sdict, self.packetNamesTracker)
+        if backupTimestamp is not None:
+            deltas = self.ListDeltaBackups(backupTimestamp)
+            applied = changes.ApplyFiles([os.path.join(self.backupDirectory, name) for _, _, name in deltas])
+            lastTimestamp = deltas[applied - 1][1] if applied else backupTimestamp
+            # journal contains all changes since the last applied backup even if some delta is broken
+            changes.ApplyFiles(self.packetJournal.ListFiles(lastTimestamp))
+        return changes
+
+    def loadOldBackup(self, filename, restorer=None):
+        """restores from backup made as one pickled objects graph"""
         with self.lock:
             with open(filename, "r") as stream:
                 sdict, packets = self.Deserialize(stream, self.ObjectRegistratorClass())
@@ -404,6 +536,8 @@ class Scheduler(Unpickable(lock=PickableRLock,
             if restorer:
                 restorer(sdict, packets)
 
+            changes = self.readChanges(sdict, self.ExtractTimestampFromBackupFilename(filename))
+
             qRef = sdict.pop("qRef")
             prevWatcher = sdict.pop("schedWatcher", None) # from old backups
 
@@ -412,20 +546,141 @@ class Scheduler(Unpickable(lock=PickableRLock,
             self.UpdateContext(None)
 
             tagStorage = self.tagRef
-            for pck in packets:
+            queues = []
+            for q in qRef.values() + [Queue(qname) for qname in changes.ListNewQueues()]:
+                removed, added = changes.PatchQueue(q)
+                for pck in removed:
+                    UnlinkTags(tagStorage, pck)
+                for pck in added:
+                    LinkTags(tagStorage, pck)
+                if not changes.IsDeleted(q):
+                    queues.append(q)
+            if "tempStorage" in changes.sdict and changes.sdict["tempStorage"] is self.tempStorage:
+                for pck in self.listTempPackets():
+                    LinkTags(tagStorage, pck)
+
+            for q in queues:
+                for pck in q.ListAllPackets():
+                    pck.VivifyDoneTagsIfNeed(tagStorage)
+            for pck in self.listTempPackets():
                 pck.VivifyDoneTagsIfNeed(tagStorage)
 
             self.tagRef.Restore(self.ExtractTimestampFromBackupFilename(filename) or 0)
 
-            self.RegisterQueues(qRef)
+            pool = ThreadPool(self.restorePoolSize) if self.restorePoolSize > 1 else None
+            try:
+                self.RegisterQueues(dict((q.name, q) for q in queues), pool)
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
 
             self.schedWatcher.Clear() # remove tasks from Queue.relocatePacket
             self.FillSchedWatcher(prevWatcher)
 
-    def FillSchedWatcher(self, prev_watcher=None):
+    def loadSnapshot(self, filename, restorer=None, background=False):
+        ValidateSnapshot(filename)
+        reader = SnapshotReader(SnapshotInput(filename), self.packetNamesTracker)
+        try:
+            with self.lock:
+                sdict = reader.ReadHead()
+                self.restoreProgress.update({"queues-total": reader.info.get("queues"),
+                                             "packets-total": reader.info.get("packets")})
+
+                if restorer:
+                    restorer(sdict, [])
+
+                changes = self.readChanges(sdict, self.ExtractTimestampFromBackupFilename(filename))
+
+                self.__setstate__(sdict)
+
+                self.UpdateContext(None)
+
+                tagStorage = self.tagRef
+                for pck in self.listTempPackets():
+                    pck.VivifyDoneTagsIfNeed(tagStorage)
+                    LinkTags(tagStorage, pck)
+
+                # packets are linked to tags later, so resets from the journal are applied to them separately
+                resets = ResetsCollector()
+                tagStorage.additional_listeners.add(resets)
+                try:
+                    tagStorage.Restore(self.ExtractTimestampFromBackupFilename(filename) or 0)
+                finally:
+                    tagStorage.additional_listeners.discard(resets)
+        except:
+            reader.Close()
+            raise
+
+        def restore_queues():
+            try:
+                self.restoreQueues(reader, changes, resets)
+            except Exception, e:
+                logging.exception("can't restore queues from %s: %s", filename, e)
+                self.restoreProgress["error"] = str(e)
+            finally:
+                reader.Close()
+                self.finishRestore()
+
+        if background:
+            self.restored.clear()
+            thread = threading.Thread(target=restore_queues, name="QueuesRestorer")
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            restore_queues()
+
+    def restoreQueues(self, reader, changes, resets):
+        tagStorage = self.tagRef
+        pool = ThreadPool(self.restorePoolSize) if self.restorePoolSize > 1 else None
+        try:
+            def new_queues():
+                for qname in changes.ListNewQueues():
+                    yield Queue(qname)
+
+            for q in itertools.chain(reader.IterQueues(), new_queues()):
+                changes.PatchQueue(q)
+                if changes.IsDeleted(q):
+                    continue
+                packets = list(q.ListAllPackets())
+                for pck in packets:
+                    pck.VivifyDoneTagsIfNeed(tagStorage)
+                    LinkTags(tagStorage, pck)
+                self.RegisterQueue(q, pool)
+                with self.lock:
+                    self.FillSchedWatcher(queues=[q])
+                for pck in packets:
+                    resets.ApplyResets(tagStorage, pck)
+                self.restoreProgress["queues"] += 1
+                self.restoreProgress["packets"] += len(packets)
+                self.restoreProgress["broken-records"] = reader.brokenRecords
+                logging.debug("queue %s restored: %d packets", q.name, len(packets))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def finishRestore(self):
+        self.restoreProgress["state"] = "ready"
+        self.restoreProgress["finished"] = time.time()
+        self.restored.set()
+        logging.info("scheduler restored: %s", self.restoreProgress)
+
+    def RestoreProgress(self):
+        progress = self.restoreProgress.copy()
+        progress["elapsed"] = (progress.get("finished") or time.time()) - progress.get("started", time.time())
+        return progress
+
+    def IsRestored(self):
+        return self.restored.isSet()
+
+    def listTempPackets(self):
+        return [pck for _, (_, pck) in self.tempStorage.packets.items()]
+
+    def FillSchedWatcher(self, prev_watcher=None, queues=None):
         def list_packets_in_queues(state):
             return [
-                pck for q in self.qRef.itervalues()
+                pck for q in (self.qRef.values() if queues is None else queues)
                     for pck in q.ListAllPackets()
                         if pck.state == state
             ]
@@ -484,76 +739,107 @@ class Scheduler(Unpickable(lock=PickableRLock,
         for pck in produce_packets_to_reinit():
             pck.Reinit(self.context)
 
-    def RegisterQueues(self, qRef):
+    def RegisterQueues(self, qRef, pool=None):
         for q in qRef.itervalues():
-            self.RegisterQueue(q)
+            self.RegisterQueue(q, pool)
+
+    def revivePacketPlace(self, pck):
+        """checks packet working directory (relocates or recreates it if needed)
+        returns False if packet can't be restored"""
+        if not pck.directory:
+            return pck.state == PacketState.SUCCESSFULL
+        if os.path.isdir(pck.directory):
+            parentDir, dirname = os.path.split(pck.directory)
+            if parentDir != self.context.packets_directory:
+                dst_loc = os.path.join(self.context.packets_directory, pck.id)
+                try:
+                    logging.warning("relocates directory %s to %s", pck.directory, dst_loc)
+                    shutil.copytree(pck.directory, dst_loc)
+                    pck.directory = dst_loc
+                except:
+                    logging.exception("relocation FAIL")
+                    return False
+            return True
+        if pck.AreLinksAlive(self.context):
+            try:
+                logging.warning("resurrects directory for packet %s", pck.id)
+                pck.directory = None
+                pck.CreatePlace(self.context)
+                return True
+            except:
+                logging.exception("resurrecton FAIL")
+        return False
 
-    def RegisterQueue(self, q):
-        q.UpdateContext(self.context)
-        q.AddCallbackListener(self)
-        for pck in list(q.ListAllPackets()):
-            dstStorage = self.packStorage
-            pck.UpdateTagDependencies(self.tagRef)
-            if pck.directory:
-                if os.path.isdir(pck.directory):
-                    parentDir, dirname = os.path.split(pck.directory)
-                    if parentDir != self.context.packets_directory:
-                        dst_loc = os.path.join(self.context.packets_directory, pck.id)
-                        try:
-                            logging.warning("relocates directory %s to %s", pck.directory, dst_loc)
-                            shutil.copytree(pck.directory, dst_loc)
-                            pck.directory = dst_loc
-                        except:
-                            logging.exception("relocation FAIL")
-                            dstStorage = None
-                else:
-                    if pck.AreLinksAlive(self.context):
-                        try:
-                            logging.warning("resurrects directory for packet %s", pck.id)
-                            pck.directory = None
-                            pck.CreatePlace(self.context)
-                        except:
-                            logging.exception("resurrecton FAIL")
-                            dstStorage = None
-                    else:
-                        dstStorage = None
-            else:
-                if pck.state != PacketState.SUCCESSFULL:
-                    dstStorage = None
-            if dstStorage is None:
-                #do not print about already errored packets
-                if not pck.CheckFlag(PacketFlag.RCVR_ERROR):
-                    logging.warning(
-                        "can't restore packet directory: %s for packet %s. Packet marked as error from old state %s",
-                        pck.directory, pck.name, pck.state)
-                    pck.SetFlag(PacketFlag.RCVR_ERROR)
-                    pck.changeState(PacketState.ERROR)
-                dstStorage = self.packStorage
-            dstStorage.Add(pck)
-            if pck.state != PacketState.HISTORIED:
-                self.packetNamesTracker.Add(pck.name)
-                pck.AddCallbackListener(self.packetNamesTracker)
-            q.relocatePacket(pck)
-        if q.IsAlive():
-            q.Resume(resumeWorkable=True)
-        self.qRef[q.name] = q
-        if q.HasStartableJobs() and q not in self.queues_with_jobs:
-            self.queues_with_jobs.push(q)
+    def RegisterQueue(self, q, pool=None):
+        """pool is used for parallel packets directories checking (it's a filesystem bound work)"""
+        packets = list(q.ListAllPackets())
+        revived = (pool.map if pool else map)(self.revivePacketPlace, packets)
+        with self.lock:
+            q.UpdateContext(self.context)
+            q.AddCallbackListener(self)
+            for pck, isAlive in zip(packets, revived):
+                pck.UpdateTagDependencies(self.tagRef)
+                if not isAlive:
+                    #do not print about already errored packets
+                    if not pck.CheckFlag(PacketFlag.RCVR_ERROR):
+                        logging.warning(
+                            "can't restore packet directory: %s for packet %s. Packet marked as error from old state %s",
+                            pck.directory, pck.name, pck.state)
+                        pck.SetFlag(PacketFlag.RCVR_ERROR)
+                        pck.changeState(PacketState.ERROR)
+                self.packStorage.Add(pck)
+                self.watchPacket(pck)
+                if pck.state != PacketState.HISTORIED:
+                    self.packetNamesTracker.Add(pck.name)
+                    pck.AddCallbackListener(self.packetNamesTracker)
+                q.relocatePacket(pck)
+            if q.IsAlive():
+                q.Resume(resumeWorkable=True)
+            self.qRef[q.name] = q
+            if q.HasStartableJobs() and q not in self.queues_with_jobs:
+                self.queues_with_jobs.push(q)
 
     def AddPacketToQueue(self, qname, pck):
         queue = self.Queue(qname)
         self.packStorage.Add(pck)
+        self.watchPacket(pck)
+        self.markPacket(pck)
         queue.Add(pck)
         self.packetNamesTracker.Add(pck.name)
         pck.AddCallbackListener(self.packetNamesTracker)
 
+    def MovePacketToQueue(self, pck, src_qname, dst_qname):
+        self.Queue(src_qname).Remove(pck)
+        self.Queue(dst_qname).Add(pck)
+        self.markPacket(pck)
+
+    def watchPacket(self, pck):
+        self.changesTracker.Watch(pck)
+        self.packetJournal.Watch(pck)
+        if self.eventsFeed.IsEnabled():
+            self.eventsFeed.Watch(pck)
+        self.tagsEvictor.Watch(pck)
+
+    def markPacket(self, pck):
+        self.changesTracker.MarkPacket(pck)
+        self.packetJournal.MarkPacket(pck)
+
     def RegisterNewPacket(self, pck, wait_tags):
         for tag in wait_tags:
             self.connManager.Subscribe(tag)
         self.tempStorage.StorePacket(pck)
 
     def GetPacket(self, pck_id):
-        return self.packStorage.GetPacket(pck_id)
+        pck = self.packStorage.GetPacket(pck_id)
+        if pck is None and not self.restored.isSet():
+            self.waitRestored()
+            pck = self.packStorage.GetPacket(pck_id)
+        return pck
+
+    def waitRestored(self):
+        # queues are being restored in background, unknown objects may appear later
+        while not self.restored.isSet():
+            self.restored.wait(1.0)
 
     def ScheduleTaskD(self, deadline, fn, *args, **kws):
         self.schedWatcher.AddTaskD(deadline, fn, *args, **kws)
@@ -565,6 +851,8 @@ class Scheduler(Unpickable(lock=PickableRLock,
         with self.lock:
             self.alive = True
             self.HasScheduledTask.notify_all()
+        self.tagRef.tag_logger.Start()
+        self.packetJournal.Start()
         self.connManager.Start()
 
     def Stop(self):
@@ -572,12 +860,39 @@ class Scheduler(Unpickable(lock=PickableRLock,
         with self.lock:
             self.alive = False
             self.HasScheduledTask.notify_all()
+        self.packetJournal.Stop()
+        self.tagRef.tag_logger.Stop()
 
     def GetConnectionManager(self):
         return self.connManager
 
     def OnTaskPending(self, ref):
+        queues = getattr(self.notificationsBatches, "queues", None)
+        if queues is not None and isinstance(ref, Queue):
+            queues[ref.name] = ref
+            return
         self.Notify(ref)
 
+    @contextlib.contextmanager
+    def NotificationsBatch(self):
+        """queues with pending packets found by the current thread inside the block are notified once at the end"""
+        if getattr(self.notificationsBatches, "queues", None) is not None:
+            yield
+            return
+        self.notificationsBatches.queues = {}
+        try:
+            yield
+        finally:
+            queues, self.notificationsBatches.queues = self.notificationsBatches.queues, None
+            for queue in queues.itervalues():
+                self.Notify(queue)
+
+    def OnTaskScheduled(self, ref):
+        # nearest deadline is tracked by SchedTimer
+        pass
+
+    def OnQueueChange(self, ref):
+        self.packetJournal.MarkQueues()
+
     def OnPacketReinitRequest(self, pck):
         pck.Reinit(self.context)
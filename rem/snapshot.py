@@ -0,0 +1,283 @@
+"""schema-driven encoding of scheduler objects for backups
+
+Objects are converted to tuples of builtin values which are written with marshal:
+    (class_name, field_1, ..., field_N, extra)
+Fields are listed in class schemas, so attribute names aren't saved at all.
+Links between objects aren't saved too and are rebuilt at decoding:
+    - jobs of packet get packetRef and packet listener
+    - packets of queue get queue listener
+    - tags get packets listeners later (see backups.LinkTags)
+Attributes unknown to the schema are pickled into the extra field,
+objects of classes without schema are pickled entirely as ("", data).
+Tag names, packet states and class names are interned, so marshal saves them once per record."""
+from __future__ import with_statement
+import itertools
+
+from callbacks import Tag, RemoteTag
+from common import BinaryFile, TimedMap
+from job import Job, IResult, CommandLineResult, JobStartErrorResult, TriesExceededResult, TimeOutExceededResult, \
+    PackedExecuteResult
+from packet import JobPacket
+from queue import Queue
+from storages import BinaryStorage, ShortStorage, TagStorage
+
+__all__ = ["ObjectsEncoder", "ObjectsDecoder", "EncodeTags", "DecodeTags", "EncodeQueue", "EncodeQueuePackets",
+           "DecodeQueuePackets", "RestoreQueuePackets"]
+
+# attribute is absent in object (marshal supports Ellipsis as a builtin value)
+MISSING = Ellipsis
+PICKLED = ""
+
+
+def interned(value):
+    return intern(value) if type(value) is str else value
+
+
+def encode_interned(encoder, value):
+    return interned(value)
+
+
+def encode_names(encoder, names):
+    return set(interned(name) for name in names)
+
+
+def encode_object(encoder, obj):
+    return encoder.Encode(obj)
+
+
+def decode_object(decoder, data):
+    return decoder.Decode(data)
+
+
+def encode_objects_list(encoder, objects):
+    return [encoder.Encode(obj) for obj in objects]
+
+
+def decode_objects_list(decoder, data):
+    return [decoder.Decode(item) for item in data]
+
+
+def encode_objects_dict(encoder, objects):
+    return dict((key, encoder.Encode(obj)) for key, obj in objects.iteritems())
+
+
+def decode_objects_dict(decoder, data):
+    return dict((key, decoder.Decode(item)) for key, item in data.iteritems())
+
+
+def encode_links(encoder, links):
+    return dict((binname, file.checksum if isinstance(file, BinaryFile) else file)
+                for binname, file in links.iteritems())
+
+
+def decode_links(decoder, links):
+    return dict((binname, decoder.GetBinary(checksum)) for binname, checksum in links.iteritems())
+
+
+class Schema(object):
+    """fields - (attribute, encoder, decoder) tuples, value is saved as is if encoder is None
+    transient - attributes that aren't saved and are restored by factories
+    dropped - attributes that aren't saved and are rebuilt by Unpickable or by the schema"""
+
+    def __init__(self, cls, fields, transient=None, dropped=()):
+        self.cls = cls
+        self.name = intern(cls.__name__)
+        self.fields = tuple((field, None, None) if isinstance(field, str) else field for field in fields)
+        self.transient = transient or {}
+        self.known = frozenset(itertools.chain((field[0] for field in self.fields), self.transient, dropped))
+
+    def getstate(self, obj):
+        return obj.__getstate__()
+
+    def setstate(self, decoder, obj, state):
+        obj.__setstate__(state)
+
+    def Encode(self, encoder, obj):
+        return self.encodeState(encoder, self.getstate(obj))
+
+    def encodeState(self, encoder, state):
+        record = [self.name]
+        for attr, encode, _ in self.fields:
+            value = state.get(attr, MISSING)
+            if encode and value is not MISSING and value is not None:
+                value = encode(encoder, value)
+            record.append(value)
+        extra = dict((attr, value) for attr, value in state.iteritems() if attr not in self.known)
+        record.append(encoder.dumps(extra) if extra else None)
+        return tuple(record)
+
+    def Decode(self, decoder, record):
+        state = {}
+        for (attr, _, decode), value in itertools.izip(self.fields, itertools.islice(record, 1, None)):
+            if value is not MISSING:
+                state[attr] = decode(decoder, value) if decode and value is not None else value
+        for attr, factory in self.transient.iteritems():
+            state[attr] = factory()
+        if record[-1] is not None:
+            state.update(decoder.loads(record[-1]))
+        obj = self.cls.__new__(self.cls)
+        self.setstate(decoder, obj, state)
+        return obj
+
+
+class JobPacketSchema(Schema):
+    def setstate(self, decoder, pck, state):
+        pck.__setstate__(state)
+        for job in pck.jobs.itervalues():
+            job.packetRef = pck
+            job.AddCallbackListener(pck)
+
+
+class QueueSchema(Schema):
+    """packets of all queue views are saved in one list of (view, time, packet) tuples"""
+    TIMED_VIEWS = frozenset(["worked", "errored"])
+
+    def getstate(self, queue):
+        state = queue.__getstate__()
+        packets = []
+        for view in Queue.VIEW_BY_ORDER:
+            if view in self.TIMED_VIEWS:
+                packets.extend((view, tm, pck) for pck, tm in state.pop(view).items())
+            else:
+                packets.extend((view, None, pck) for pck in state.pop(view))
+        state["packets"] = packets
+        return state
+
+    def setstate(self, decoder, queue, state):
+        packets = state.pop("packets", ())
+        queue.__setstate__(state)
+        self.RestorePackets(queue, packets)
+
+    @classmethod
+    def RestorePackets(cls, queue, packets):
+        for view, tm, pck in packets:
+            queue.RestorePacket(pck, view, tm)
+            pck.AddCallbackListener(queue)
+
+    @staticmethod
+    def encode_packets(encoder, packets):
+        return [(intern(view), tm, encoder.Encode(pck)) for view, tm, pck in packets]
+
+    @staticmethod
+    def decode_packets(decoder, packets):
+        return [(view, tm, decoder.Decode(pck)) for view, tm, pck in packets]
+
+
+class ShortStorageSchema(Schema):
+    """TimedMap of packets is saved as list of (id, time, packet) tuples"""
+
+    def getstate(self, storage):
+        with storage.lock:
+            state = storage.__dict__.copy()
+            state["packets"] = [(pck_id, tm, pck) for pck_id, (tm, pck) in storage.packets.items()]
+        return state
+
+    def setstate(self, decoder, storage, state):
+        packets = TimedMap()
+        for pck_id, tm, pck in state.pop("packets", ()):
+            packets.add(pck_id, pck, tm)
+        state["packets"] = packets
+        storage.__setstate__(state)
+
+    @staticmethod
+    def encode_packets(encoder, packets):
+        return [(pck_id, tm, encoder.Encode(pck)) for pck_id, tm, pck in packets]
+
+    @staticmethod
+    def decode_packets(decoder, packets):
+        return [(pck_id, tm, decoder.Decode(pck)) for pck_id, tm, pck in packets]
+
+
+RESULT_FIELDS = ("type", encode_interned, None), "code", "message"
+
+SCHEMAS = [
+    JobPacketSchema(JobPacket,
+                    ["id", "name", "priority", ("state", encode_interned, None), "flags", "directory",
+                     "notify_emails", "history", "kill_all_jobs_on_error", "isResetable", "waitingDeadline",
+                     ("done_indicator", encode_interned, None), "job_done_indicator",
+                     ("allTags", encode_names, None), ("waitTags", encode_names, None),
+                     "edges", "done", "leafs", "working", "waitJobs",
+                     ("result", encode_object, decode_object),
+                     ("binLinks", encode_links, decode_links),
+                     ("jobs", encode_objects_dict, decode_objects_dict)],
+                    transient={"streams": dict, "pipelineRuns": dict, "statusCache": dict, "pipeStreams": set},
+                    dropped=("lock", "callbacks", "_working_empty")),
+    Schema(Job,
+           ["id", "shell", "parents", "inputs", "maxTryCount", "limitter", "max_err_len", "retry_delay",
+            "pipe_fail", "description", "notify_timeout", "max_working_time", "output_to_status",
+            "tries", "working_time", "cached_working_time", "_notified", "alive", "running_pids",
+            ("results", encode_objects_list, decode_objects_list), "streaming", "stream_tee"],
+           transient={"input": lambda: None, "output": lambda: None, "errPipe": lambda: None},
+           dropped=("callbacks", "packetRef", "err")),
+    QueueSchema(Queue,
+                ["name", "isSuspended", "workingLimit", "success_lifetime", "errored_lifetime",
+                 "errorForgetTm", "successForgetTm",
+                 ("packets", QueueSchema.encode_packets, QueueSchema.decode_packets)],
+                dropped=("lock", "callbacks", "working", "packetViews", "listingIndex")),
+    Schema(Tag, [("name", encode_interned, None), "done"], dropped=("callbacks",)),
+    Schema(RemoteTag, [("remotehost", encode_interned, None), ("name", encode_interned, None), "done"],
+           dropped=("callbacks",)),
+    Schema(BinaryFile, ["checksum", "path", "accessTime", "links"], dropped=("lock",)),
+    Schema(BinaryStorage, ["lifeTime", "binDirectory", ("files", encode_objects_dict, decode_objects_dict)],
+           dropped=("uploadLock",)),
+    ShortStorageSchema(ShortStorage,
+                       [("packets", ShortStorageSchema.encode_packets, ShortStorageSchema.decode_packets)],
+                       dropped=("lock",)),
+] + [Schema(cls, RESULT_FIELDS) for cls in (IResult, CommandLineResult, JobStartErrorResult, TriesExceededResult,
+                                            TimeOutExceededResult, PackedExecuteResult)]
+
+SCHEMAS_BY_CLASS = dict((schema.cls, schema) for schema in SCHEMAS)
+SCHEMAS_BY_NAME = dict((schema.name, schema) for schema in SCHEMAS)
+
+
+class ObjectsEncoder(object):
+    """dumps - pickling function for objects and attributes without schema"""
+
+    def __init__(self, dumps):
+        self.dumps = dumps
+
+    def Encode(self, obj):
+        schema = SCHEMAS_BY_CLASS.get(type(obj))
+        if schema is None:
+            return (PICKLED, self.dumps(obj))
+        return schema.Encode(self, obj)
+
+
+class ObjectsDecoder(object):
+    """loads - unpickling function, binaries - function returning BinaryFile object by checksum"""
+
+    def __init__(self, loads, binaries):
+        self.loads = loads
+        self.binaries = binaries
+
+    def Decode(self, record):
+        if record[0] == PICKLED:
+            return self.loads(record[1])
+        return SCHEMAS_BY_NAME[record[0]].Decode(self, record)
+
+    def GetBinary(self, checksum):
+        return self.binaries(checksum) or checksum
+
+
+def EncodeTags(encoder, tagStorage):
+    with tagStorage.lock:
+        items = tagStorage.inmem_items.items()
+    return [(interned(tagname), encoder.Encode(tag)) for tagname, tag in items]
+
+
+def DecodeTags(decoder, items):
+    return TagStorage(dict((tagname, decoder.Decode(tag)) for tagname, tag in items))
+
+
+def EncodeQueue(encoder, queue):
+    """returns queue encoded without packets and list of its (view, time, packet) tuples,
+    so packets can be saved separately by small groups"""
+    schema = SCHEMAS_BY_CLASS[Queue]
+    state = schema.getstate(queue)
+    packets, state["packets"] = state["packets"], []
+    return schema.encodeState(encoder, state), packets
+
+
+EncodeQueuePackets = QueueSchema.encode_packets
+DecodeQueuePackets = QueueSchema.decode_packets
+RestoreQueuePackets = QueueSchema.RestorePackets
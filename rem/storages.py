@@ -1,4 +1,5 @@
 from __future__ import with_statement
+import contextlib
 import logging
 import os
 import sys
@@ -6,12 +7,17 @@ import time
 import weakref
 import bsddb3
 import cPickle
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
 
 from common import *
 from callbacks import Tag, RemoteTag, CallbackHolder
 from journal import TagLogger
 from callbacks import ICallbackAcceptor
 from packet import PacketState, JobPacket
+from queue import RegexPrefix
 from Queue import Queue
 import fork_locking
 
@@ -79,8 +85,9 @@ class ShortStorage(Unpickable(packets=(TimedMap.create, {}),
             return self.packets.pop(id)[1][1]
 
 
-class BinaryStorage(Unpickable(files=dict, lifeTime=(int, 3600), binDirectory=str)):
+class BinaryStorage(Unpickable(files=dict, lifeTime=(int, 3600), binDirectory=str, uploadLock=PickableLock)):
     digest_length = 32
+    UPLOAD_SUFFIX = ".upload"
 
     def __init__(self):
         getattr(super(BinaryStorage, self), "__init__")()
@@ -88,6 +95,7 @@ class BinaryStorage(Unpickable(files=dict, lifeTime=(int, 3600), binDirectory=st
     def __getstate__(self):
         sdict = self.__dict__.copy()
         sdict["files"] = sdict["files"].copy()
+        sdict.pop("uploadLock", None)
         return getattr(super(BinaryStorage, self), "__getstate__", lambda: sdict)()
 
     @classmethod
@@ -105,6 +113,19 @@ class BinaryStorage(Unpickable(files=dict, lifeTime=(int, 3600), binDirectory=st
                 bad_files.add(checksum)
         for checksum in bad_files:
             self.files.pop(checksum).release()
+        self.forgetOldUploads(curTime)
+
+    def forgetOldUploads(self, curTime):
+        if not os.path.isdir(self.binDirectory):
+            return
+        for filename in os.listdir(self.binDirectory):
+            if filename.endswith(self.UPLOAD_SUFFIX):
+                path = os.path.join(self.binDirectory, filename)
+                try:
+                    if curTime - os.path.getmtime(path) > self.lifeTime:
+                        os.unlink(path)
+                except OSError:
+                    pass
 
     def UpdateContext(self, context):
         for file in self.files.itervalues():
@@ -168,6 +189,61 @@ class BinaryStorage(Unpickable(files=dict, lifeTime=(int, 3600), binDirectory=st
         file = self.GetFileByHash(checksum)
         return file and os.path.isfile(file.path)
 
+    """chunked uploads: data is appended to <checksum>.upload file, so upload can be resumed after failure"""
+
+    def uploadPath(self, checksum):
+        if not isinstance(checksum, str) or len(checksum) != self.digest_length \
+                or checksum.strip("0123456789abcdef"):
+            raise AttributeError("incorrect binary checksum: %r" % checksum)
+        return os.path.join(self.binDirectory, checksum + self.UPLOAD_SUFFIX)
+
+    def BeginUpload(self, checksum):
+        """returns size of already uploaded data or -1 if the binary is stored already"""
+        path = self.uploadPath(checksum)
+        if self.HasBinary(checksum):
+            return -1
+        with self.uploadLock:
+            if not os.path.isfile(path):
+                open(path, "w").close()
+            return os.path.getsize(path)
+
+    def AppendUpload(self, checksum, offset, data):
+        """writes data at offset (not greater than uploaded size), returns new uploaded size"""
+        path = self.uploadPath(checksum)
+        with self.uploadLock:
+            if not os.path.isfile(path):
+                raise AttributeError("upload of binary %s isn't started" % checksum)
+            size = os.path.getsize(path)
+            if not 0 <= offset <= size:
+                raise AttributeError("incorrect offset %s for binary %s, %s bytes are uploaded" % (offset, checksum, size))
+            with open(path, "r+b") as writer:
+                writer.seek(offset)
+                writer.write(data)
+                writer.truncate()
+            return offset + len(data)
+
+    def CommitUpload(self, checksum):
+        path = self.uploadPath(checksum)
+        if not os.path.isfile(path):
+            if self.HasBinary(checksum):
+                return True
+            raise AttributeError("upload of binary %s isn't started" % checksum)
+        fileChecksum = BinaryFile.calcFileChecksum(path)
+        with self.uploadLock:
+            if not os.path.isfile(path):
+                # the same binary has been committed concurrently
+                return True
+            if fileChecksum != checksum:
+                os.unlink(path)
+                raise RuntimeError("checksum mismatch for uploaded binary %s: %s" % (checksum, fileChecksum))
+            if self.HasBinary(checksum):
+                os.unlink(path)
+                return True
+            remPath = os.path.join(self.binDirectory, checksum)
+            os.rename(path, remPath)
+            self.RegisterFile(BinaryFile(remPath, checksum, True))
+        return True
+
 
 class TagWrapper(object):
     __slots__ = ["inner", "__reduce_ex__"]
@@ -184,8 +260,71 @@ class TagWrapper(object):
         return self.inner.__getattribute__(attr)
 
 
+class TagsCache(object):
+    """LRU of decoded states (done flags) of tags stored in the file,
+    size is limited by estimated memory consumption of entries"""
+    ENTRY_OVERHEAD = 150
+
+    def __init__(self, size=64 << 20):
+        self.size = size
+        self.used = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        # is incremented by every Put (i.e. by writing of tags to the file)
+        self.generation = 0
+
+    def Get(self, tagname):
+        with self.lock:
+            done = self.items.pop(tagname, None)
+            if done is not None:
+                self.items[tagname] = done
+            return done
+
+    def Put(self, tagname, done):
+        with self.lock:
+            if self.items.pop(tagname, None) is None:
+                self.used += len(tagname) + self.ENTRY_OVERHEAD
+            self.items[tagname] = done
+            self.generation += 1
+            self.shrink()
+
+    def Fill(self, tagname, done, generation):
+        """caches state read from the file, if no Put has been made after the generation was taken
+        (otherwise the state may be older than the file one)"""
+        with self.lock:
+            if self.generation != generation or tagname in self.items:
+                return
+            self.used += len(tagname) + self.ENTRY_OVERHEAD
+            self.items[tagname] = done
+            self.shrink()
+
+    def Discard(self, tagname):
+        with self.lock:
+            if self.items.pop(tagname, None) is not None:
+                self.used -= len(tagname) + self.ENTRY_OVERHEAD
+
+    def Resize(self, size):
+        with self.lock:
+            self.size = size
+            self.shrink()
+
+    def shrink(self):
+        while self.used > self.size and self.items:
+            oldname, _ = self.items.popitem(last=False)
+            self.used -= len(oldname) + self.ENTRY_OVERHEAD
+
+
 class TagStorage(object):
-    __slots__ = ["db_file", "infile_items", "inmem_items", "lock", "additional_listeners", "conn_manager", "tag_logger", 'db_file_opened']
+    __slots__ = ["db_file", "infile_items", "inmem_items", "lock", "additional_listeners", "conn_manager", "tag_logger", 'db_file_opened', "cache",
+                 "evictionCandidates", "sweepNames", "dispatcher", "evictor"]
+    # acquired tags are checked for eviction not earlier than the delay
+    EVICTION_DELAY = 60
+    # tags are stored in the file as name -> state byte
+    SET_STATE = "1"
+    UNSET_STATE = "0"
+    LIST_PAGE_SIZE = 1000
+    # max number of file records scanned by one page of listing (page is shorter if regex matches rarely)
+    LIST_SCAN_LIMIT = 100000
 
     def __init__(self, *args):
         self.lock = PickableLock()
@@ -194,7 +333,14 @@ class TagStorage(object):
         self.db_file = ""
         self.db_file_opened = False
         self.additional_listeners = set()
+        self.conn_manager = None
         self.tag_logger = TagLogger(self)
+        self.cache = TagsCache()
+        # names of tags which may be unused -> time of becoming a candidate
+        self.evictionCandidates = OrderedDict()
+        self.sweepNames = []
+        self.dispatcher = None
+        self.evictor = None
         if len(args) == 1:
             if isinstance(args[0], dict):
                 self.inmem_items = args[0]
@@ -222,7 +368,39 @@ class TagStorage(object):
     def ResetTag(self, tagname, message):
         self.AcquireTag(tagname).Reset(message)
 
+    def SetTags(self, tagnames):
+        with self.eventsBatch():
+            for tag in self.AcquireTags(filter(None, tagnames)):
+                tag.Set()
+
+    def UnsetTags(self, tagnames):
+        with self.eventsBatch():
+            for tag in self.AcquireTags(filter(None, tagnames)):
+                tag.Unset()
+
+    def ResetTags(self, tagnames, message):
+        with self.eventsBatch():
+            for tag in self.AcquireTags(filter(None, tagnames)):
+                tag.Reset(message)
+
+    @contextlib.contextmanager
+    def eventsBatch(self):
+        """journal records and notifications of remote acceptors are grouped for tags changed inside the block"""
+        with self.tag_logger.Batch():
+            if self.conn_manager is None:
+                yield
+                return
+            with self.conn_manager.Batch():
+                yield
+
+    def CheckTags(self, tagnames):
+        return [self.CheckTag(tagname) for tagname in tagnames]
+
     def CheckTag(self, tagname):
+        if tagname not in self.inmem_items:
+            done = self.cache.Get(tagname)
+            if done is not None:
+                return done
         return self.RawTag(tagname).IsSet()
 
     def IsRemoteName(self, tagname):
@@ -230,44 +408,131 @@ class TagStorage(object):
 
     def AcquireTag(self, tagname):
         if tagname:
-            tag = self.RawTag(tagname)
-            with self.lock:
-                return TagWrapper(self.inmem_items.setdefault(tagname, tag))
+            return self.AcquireTags([tagname])[0]
+
+    def AcquireTags(self, tagnames):
+        """returns wrappers of tags in the same order, all tags are placed into memory by one lock acquisition"""
+        tags = [self.RawTag(tagname) for tagname in tagnames]
+        now = time.time()
+        with self.lock:
+            hadCandidates = bool(self.evictionCandidates)
+            wrappers = []
+            for tagname, tag in itertools.izip(tagnames, tags):
+                tag = self.inmem_items.setdefault(tagname, tag)
+                # tag in memory is authoritative until it's written to the file again
+                self.cache.Discard(tagname)
+                self.evictionCandidates.pop(tagname, None)
+                self.evictionCandidates[tagname] = now
+                wrappers.append(TagWrapper(tag))
+        if not hadCandidates:
+            self.wakeupEvictor()
+        return wrappers
 
     def RawTag(self, tagname):
         if tagname:
             tag = self.inmem_items.get(tagname, None)
             if tag is None:
-                if not self.db_file_opened:
-                    self.DBConnect()
-                tagDescr = self.infile_items.get(tagname, None)
-                if tagDescr:
-                    tag = cPickle.loads(tagDescr)
-                else:
-                    tag = RemoteTag(tagname) if self.IsRemoteName(tagname) else Tag(tagname)
+                done = self.cache.Get(tagname)
+                if done is None:
+                    if not self.db_file_opened:
+                        self.DBConnect()
+                    generation = self.cache.generation
+                    done = self.decodeState(self.infile_items.get(tagname, None))
+                    self.cache.Fill(tagname, done, generation)
+                tag = RemoteTag(tagname) if self.IsRemoteName(tagname) else Tag(tagname)
+                tag.done = done
             for obj in self.additional_listeners:
                 tag.AddNonpersistentCallbackListener(obj)
+            if self.dispatcher is not None:
+                tag.dispatcher = self.dispatcher
             return tag
 
+    @classmethod
+    def encodeState(cls, tag):
+        return cls.SET_STATE if tag.IsSet() else cls.UNSET_STATE
+
+    @classmethod
+    def decodeState(cls, record):
+        if record is None:
+            return False
+        if record in (cls.SET_STATE, cls.UNSET_STATE):
+            return record == cls.SET_STATE
+        # pickled tag written by previous versions
+        return cPickle.loads(record).IsSet()
+
+    @staticmethod
+    def narrowPrefix(name_regex, prefix):
+        """returns prefix of all names matched by both regex and prefix, None if there are no such names"""
+        prefix = prefix or ""
+        if name_regex:
+            regex_prefix = RegexPrefix(name_regex)
+            if regex_prefix.startswith(prefix):
+                return regex_prefix
+            if not prefix.startswith(regex_prefix):
+                return None
+        return prefix
+
     def ListTags(self, name_regex=None, prefix=None, memory_only=True):
+        prefix = self.narrowPrefix(name_regex, prefix)
+        if prefix is None:
+            return
         for name, tag in self.inmem_items.items():
-            if name and (not prefix or name.startswith(prefix)) \
-                and (not name_regex or name_regex.match(name)):
+            if name and name.startswith(prefix) and (not name_regex or name_regex.match(name)):
                 yield name, tag.IsSet()
         if memory_only:
             return
-        inner_db = bsddb3.btopen(self.db_file, "r")
-        try:
-            name, tagDescr = inner_db.set_location(prefix) if prefix else inner_db.first()
-            while True:
-                if prefix and not name.startswith(prefix):
-                    break
-                if not name_regex or name_regex.match(name):
-                    yield name, cPickle.loads(tagDescr).IsSet()
-                name, tagDescr = inner_db.next()
-        except bsddb3._pybsddb.DBNotFoundError:
-            pass
-        inner_db.close()
+        cursor = None
+        while True:
+            items, cursor = self.listFileTags(name_regex, prefix, cursor, self.LIST_PAGE_SIZE)
+            for item in items:
+                yield item
+            if cursor is None:
+                break
+
+    def ListTagsPage(self, name_regex=None, prefix=None, memory_only=True, cursor=None, limit=None):
+        """returns list of (name, state) ordered by names after cursor and cursor for the next page
+        (None if there are no more tags), page may be shorter than limit"""
+        if limit is None:
+            limit = self.LIST_PAGE_SIZE
+        elif limit <= 0:
+            raise ValueError("page limit must be positive: %r" % (limit,))
+        prefix = self.narrowPrefix(name_regex, prefix)
+        if prefix is None:
+            return [], None
+        fileItems, fileCursor = [], None
+        if not memory_only:
+            fileItems, fileCursor = self.listFileTags(name_regex, prefix, cursor, limit)
+        memoryItems = heapq.nsmallest(limit, (
+            (name, tag.IsSet()) for name, tag in self.inmem_items.items()
+            if name and name.startswith(prefix) and (cursor is None or name > cursor)
+            and (fileCursor is None or name <= fileCursor) and (not name_regex or name_regex.match(name))))
+        items = sorted(memoryItems + fileItems)[:limit]
+        if len(items) == limit:
+            return items, items[-1][0]
+        return items, fileCursor
+
+    def listFileTags(self, name_regex, prefix, cursor, limit):
+        """scans file tags with prefix after cursor, tags being in memory are skipped
+        returns (list of (name, state), cursor for the next scan or None at the end of prefix range)"""
+        items = []
+        scanned = 0
+        start = cursor if cursor and cursor > prefix else prefix
+        with self.lock:
+            if not self.db_file_opened:
+                self.DBConnect()
+            try:
+                name, record = self.infile_items.set_location(start) if start else self.infile_items.first()
+                while name.startswith(prefix):
+                    if name != cursor:
+                        scanned += 1
+                        if name not in self.inmem_items and (not name_regex or name_regex.match(name)):
+                            items.append((name, self.decodeState(record)))
+                        if len(items) >= limit or scanned >= self.LIST_SCAN_LIMIT:
+                            return items, name
+                    name, record = self.infile_items.next()
+            except bsddb3._pybsddb.DBNotFoundError:
+                pass
+        return items, None
 
     def DBConnect(self):
         self.infile_items = bsddb3.btopen(self.db_file, "c")
@@ -275,12 +540,17 @@ class TagStorage(object):
 
     def UpdateContext(self, context):
         self.db_file = context.tags_db_file
+        self.cache.Resize(context.tags_cache_size << 20)
         self.DBConnect()
         self.conn_manager = context.Scheduler.connManager
+        self.dispatcher = context.Scheduler.tagsDispatcher
+        self.evictor = context.Scheduler.tagsEvictor
         self.tag_logger.UpdateContext(context)
         self.additional_listeners = set()
         self.additional_listeners.add(context.Scheduler.connManager)
         self.additional_listeners.add(self.tag_logger)
+        if context.Scheduler.eventsFeed.IsEnabled():
+            self.additional_listeners.add(context.Scheduler.eventsFeed)
 
     def Restore(self, timestamp):
         self.tag_logger.Restore(timestamp)
@@ -288,27 +558,81 @@ class TagStorage(object):
     def ListDependentPackets(self, tag_name):
         return self.RawTag(tag_name).GetListenersIds()
 
-    def tofileOldItems(self):
-        old_tags = set()
-        for name, tag in self.inmem_items.items():
-            #tag for removing have no listeners and have no external links for himself (actualy 4 links)
-            if tag.GetListenersNumber() == 0 and sys.getrefcount(tag) == 4:
-                old_tags.add(name)
-        if not self.db_file_opened:
-            with self.lock:
-                self.DBConnect()
+    def AddEvictionCandidates(self, tagnames):
+        now = time.time()
+        with self.lock:
+            hadCandidates = bool(self.evictionCandidates)
+            for tagname in tagnames:
+                self.evictionCandidates.setdefault(tagname, now)
+        if not hadCandidates:
+            self.wakeupEvictor()
+
+    def wakeupEvictor(self):
+        # candidates are ordered by time, so the nearest eviction time changes only if there were no candidates
+        if self.evictor is not None and self.evictionCandidates:
+            self.evictor.Wakeup()
+
+    def NextEvictionTime(self):
+        """returns time when the oldest candidate may be evicted (None if there is nothing to check)"""
+        with self.lock:
+            if self.sweepNames:
+                return time.time()
+            if self.evictionCandidates:
+                return next(self.evictionCandidates.itervalues()) + self.EVICTION_DELAY
+
+    def StartSweep(self):
+        """all tags in memory will be checked by EvictTags after candidates,
+        so tags whose listeners have gone without notifications are evicted too"""
         with self.lock:
-            for name in old_tags:
-                tag = self.inmem_items.pop(name)
+            self.sweepNames = self.inmem_items.keys()
+
+    def popEvictionNames(self, count):
+        names = []
+        barrierTm = time.time() - self.EVICTION_DELAY
+        while self.evictionCandidates and len(names) < count:
+            name, tm = next(self.evictionCandidates.iteritems())
+            if tm > barrierTm:
+                break
+            del self.evictionCandidates[name]
+            names.append(name)
+        while self.sweepNames and len(names) < count:
+            names.append(self.sweepNames.pop())
+        return names
+
+    @staticmethod
+    def hasListeners(tag):
+        # historied packets will be collected soon, so they don't keep tags in memory
+        return any(getattr(listener, "state", None) != PacketState.HISTORIED for listener in tag.callbacks.keys())
+
+    def EvictTags(self, count):
+        """writes up to count unused tags from candidates and sweep list to the file,
+        returns number of checked tags"""
+        with self.lock:
+            if not self.db_file_opened:
+                self.DBConnect()
+            names = self.popEvictionNames(count)
+            evicted = 0
+            for name in names:
+                tag = self.inmem_items.get(name)
+                #tag for removing have no listeners and have no external links for himself (inmem_items, local variable and getrefcount argument)
+                if tag is None or self.hasListeners(tag) or sys.getrefcount(tag) > 3:
+                    continue
+                del self.inmem_items[name]
                 tag.callbacks.clear()
                 try:
-                    self.infile_items[name] = cPickle.dumps(tag)
+                    self.infile_items[name] = self.encodeState(tag)
+                    self.cache.Put(name, tag.done)
                 except bsddb3.error as e:
                     if 'BSDDB object has already been closed' in e.message:
                         self.db_file_opened = False
                         self.db_file = None
                     raise
-            self.infile_items.sync()
+                evicted += 1
+            if evicted:
+                self.infile_items.sync()
+        if evicted:
+            logging.debug("tags	%d of %d checked tags have been written to file", evicted, len(names))
+        return len(names)
 
 
 class PacketNamesStorage(ICallbackAcceptor):
@@ -0,0 +1,140 @@
+"""long-poll waiting for packets states
+
+pck_wait requests which can't be answered at once are detached from XML-RPC worker threads.
+PacketsWait listens to "change" events of the packets, the answer is written by the single
+PacketsWaiter thread when any packet reaches one of the target states or the wait deadline expires.
+The thread sleeps on self-pipe until the nearest deadline (as SchedTimer does), so pending waits cost nothing."""
+from __future__ import with_statement
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+from callbacks import ICallbackAcceptor
+
+__all__ = ["PacketsWait", "PacketsWaiter", "GetWaiter"]
+
+
+class PacketsWait(ICallbackAcceptor):
+    """respond - function writing the answer (dict of packets states) to the detached request"""
+
+    def __init__(self, packets, states, deadline, respond):
+        self.packets = packets
+        self.states = states
+        self.deadline = deadline
+        self.respond = respond
+        self.waiter = None
+
+    def IsReady(self):
+        return any(pck.state in self.states for pck in self.packets)
+
+    def Result(self):
+        return dict((pck.id, pck.state) for pck in self.packets)
+
+    def AcceptCallback(self, reference, event):
+        # other packet events are fired too often to be dispatched here
+        if event == "change" and reference.state in self.states:
+            self.waiter.Finish(self)
+
+
+class PacketsWaiter(threading.Thread):
+    def __init__(self):
+        super(PacketsWaiter, self).__init__(name="PacketsWaiter")
+        self.setDaemon(True)
+        self.lock = threading.Lock()
+        self.wakeupReader, self.wakeupWriter = os.pipe()
+        for fd in (self.wakeupReader, self.wakeupWriter):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.waits = set()
+        self.finished = []
+        self.deadlines = []
+        self.counter = itertools.count()
+
+    def Add(self, wait):
+        wait.waiter = self
+        with self.lock:
+            self.waits.add(wait)
+            heapq.heappush(self.deadlines, (wait.deadline, next(self.counter), wait))
+            isNearest = self.deadlines[0][2] is wait
+        if isNearest:
+            self.Wakeup()
+        for pck in wait.packets:
+            pck.AddNonpersistentCallbackListener(wait)
+        # state could be changed before the listeners registration
+        if wait.IsReady():
+            self.Finish(wait)
+
+    def Finish(self, wait):
+        with self.lock:
+            if wait not in self.waits:
+                return
+            self.waits.remove(wait)
+            self.finished.append(wait)
+        self.Wakeup()
+
+    def Wakeup(self):
+        try:
+            os.write(self.wakeupWriter, "\0")
+        except OSError, e:
+            # pipe is full, so waiter is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        while True:
+            try:
+                self.sleep(self.processWaits())
+            except Exception, e:
+                logging.exception("waiter\twaits processing error %s", e)
+
+    def sleep(self, timeout):
+        try:
+            rout, _, _ = select.select((self.wakeupReader,), (), (), timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if rout:
+            try:
+                os.read(self.wakeupReader, 4096)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def processWaits(self):
+        """answers finished and expired waits, returns timeout until the nearest deadline (None if there are no waits)"""
+        with self.lock:
+            finished, self.finished = self.finished, []
+            now = time.time()
+            while self.deadlines and (self.deadlines[0][0] <= now or self.deadlines[0][2] not in self.waits):
+                _, _, wait = heapq.heappop(self.deadlines)
+                if wait in self.waits:
+                    self.waits.remove(wait)
+                    finished.append(wait)
+            timeout = max(self.deadlines[0][0] - now, 0) if self.deadlines else None
+        for wait in finished:
+            for pck in wait.packets:
+                pck.DropCallbackListener(wait)
+            try:
+                wait.respond(wait.Result())
+            except Exception, e:
+                logging.warning("waiter\tcan't send packets states: %s", e)
+        return timeout
+
+
+_waiter = None
+_waiter_lock = threading.Lock()
+
+
+def GetWaiter():
+    global _waiter
+    with _waiter_lock:
+        if _waiter is None or not _waiter.isAlive():
+            _waiter = PacketsWaiter()
+            _waiter.start()
+        return _waiter
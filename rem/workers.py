@@ -1,11 +1,16 @@
 import copy
+import errno
+import fcntl
+import os
+import select
 import threading
 import logging
 import time
 import Queue as StdQueue
 
 import osspec
-from callbacks import CallbackHolder
+from callbacks import CallbackHolder, ICallbackAcceptor
+from packet import PacketState
 
 
 STACK_SZ = 1 << 18 # 4MB default stack size for threads
@@ -73,21 +78,75 @@ class ThreadJobWorker(KillableWorker):
 
 
 class XMLRPCWorker(KillableWorker):
-    TICK_PERIOD = 0.001
-    WAIT_PERIOD = 1
+    """blocks on the requests queue, Kill puts None into the queue to wake the worker up"""
+    TICK_PERIOD = 0.0
 
     def __init__(self, requests, func):
         super(XMLRPCWorker, self).__init__()
         self.requests = requests
         self.func = func
 
-    def do(self):
+    def run(self):
+        while not self.IsKilled():
+            obj = self.requests.get()
+            if obj is None:
+                continue
+            try:
+                self.func(*obj)
+            except Exception, e:
+                logging.exception("worker\trequest processing error %s", e)
+
+    def Kill(self):
+        super(XMLRPCWorker, self).Kill()
+        self.requests.put(None)
+
+
+class WakeableWorker(KillableWorker):
+    """sleeps between iterations until the timeout returned by do() (None - until Wakeup),
+    Wakeup interrupts the sleep through self-pipe"""
+    TICK_PERIOD = 0.0
+
+    def __init__(self):
+        super(WakeableWorker, self).__init__()
+        self.wakeupReader, self.wakeupWriter = os.pipe()
+        for fd in (self.wakeupReader, self.wakeupWriter):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def run(self):
+        while not self.IsKilled():
+            try:
+                timeout = self.do()
+            except Exception, e:
+                logging.exception("worker\tjob execution error %s", e)
+                timeout = self.TICK_PERIOD
+            if not self.IsKilled():
+                self.sleep(timeout)
+
+    def sleep(self, timeout):
         try:
-            obj = self.requests.get(True, self.WAIT_PERIOD)
-        except StdQueue.Empty:
+            rout, _, _ = select.select((self.wakeupReader,), (), (), timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
             return
-        else:
-            self.func(*obj)
+        if rout:
+            try:
+                os.read(self.wakeupReader, 4096)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def Wakeup(self):
+        try:
+            os.write(self.wakeupWriter, "\0")
+        except OSError, e:
+            # pipe is full, so worker is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def Kill(self):
+        super(WakeableWorker, self).Kill()
+        self.Wakeup()
 
 
 #awful threading.Thread doesn't care about starting other constructors over super object, 
@@ -100,3 +159,114 @@ class TimeTicker(CallbackHolder, KillableWorker):
 
     def do(self):
         self.FireEvent("tick")
+
+
+class TagsEvictor(ICallbackAcceptor, WakeableWorker):
+    """writes unused tags from memory to the file by bounded batches,
+    candidates are acquired tags and tags of historied packets, other tags are checked by periodical sweeps;
+    sleeps until the oldest candidate may be evicted, TagStorage wakes it up when candidates appear"""
+    TICK_PERIOD = 1.0
+    BATCH_SIZE = 1000
+    SWEEP_PERIOD = 3600
+
+    def __init__(self, scheduler):
+        super(TagsEvictor, self).__init__()
+        self.scheduler = scheduler
+        self.lastSweepTime = time.time()
+
+    def do(self):
+        if time.time() - self.lastSweepTime > self.SWEEP_PERIOD:
+            self.lastSweepTime = time.time()
+            self.scheduler.tagRef.StartSweep()
+        checked = self.scheduler.tagRef.EvictTags(self.BATCH_SIZE)
+        # full batch means there are more candidates
+        if checked >= self.BATCH_SIZE:
+            return 0.0
+        deadline = self.lastSweepTime + self.SWEEP_PERIOD
+        evictionTime = self.scheduler.tagRef.NextEvictionTime()
+        if evictionTime is not None:
+            deadline = min(deadline, evictionTime)
+        return max(deadline - time.time(), 0.0)
+
+    def Watch(self, pck):
+        pck.AddNonpersistentCallbackListener(self)
+
+    def OnChange(self, pck):
+        if pck.state == PacketState.HISTORIED:
+            self.scheduler.tagRef.AddEvictionCandidates(set(getattr(pck, "allTags", ())) | set(pck.waitTags))
+
+    def OnJobGet(self, job):
+        pass
+
+    def OnJobDone(self, job):
+        pass
+
+    def OnPacketReinitRequest(self, pck):
+        pass
+
+
+class TagsDispatcher(KillableWorker):
+    """delivers tags events to packets outside of threads setting tags,
+    listeners of a tag are processed by bounded batches, queues are notified about pending packets
+    once per batch (see Scheduler.NotificationsBatch); Kill stops the worker after all queued events"""
+    TICK_PERIOD = 0.0
+    BATCH_SIZE = 1000
+
+    def __init__(self, scheduler):
+        super(TagsDispatcher, self).__init__()
+        self.scheduler = scheduler
+        self.events = StdQueue.Queue()
+        self.lock = threading.Lock()
+
+    def IsRunning(self):
+        return self.is_alive() and not self.IsKilled()
+
+    def Dispatch(self, tag, event, reference, listeners):
+        """listeners - weak references to acceptors, returns False if events aren't accepted anymore"""
+        with self.lock:
+            if not self.IsRunning():
+                return False
+            self.events.put((tag, event, reference, listeners))
+            return True
+
+    def run(self):
+        while True:
+            obj = self.events.get()
+            if obj is None:
+                return
+            tag, event, reference, listeners = obj
+            for start in xrange(0, len(listeners), self.BATCH_SIZE):
+                with self.scheduler.NotificationsBatch():
+                    for listener in listeners[start:start + self.BATCH_SIZE]:
+                        # packet may have been forgotten since the event
+                        if listener() is None:
+                            continue
+                        try:
+                            tag.notifyListeners((listener,), event, reference)
+                        except Exception, e:
+                            logging.exception("tags dispatcher\tlistener %r of tag %s processing error: %s",
+                                              listener(), tag.GetFullname(), e)
+
+    def Kill(self):
+        with self.lock:
+            super(TagsDispatcher, self).Kill()
+            self.events.put(None)
+
+
+class SchedTimer(ICallbackAcceptor, WakeableWorker):
+    """sleeps until the nearest SchedWatcher deadline instead of periodical ticking,
+    earlier deadlines wake the timer up"""
+
+    def __init__(self, watcher):
+        super(SchedTimer, self).__init__()
+        self.watcher = watcher
+        self.watcher.AddNonpersistentCallbackListener(self)
+
+    def do(self):
+        return self.watcher.PopReadyTasks()
+
+    def OnTaskScheduled(self, ref):
+        self.Wakeup()
+
+    def OnTaskPending(self, ref):
+        pass
@@ -23,13 +23,10 @@ LmtTestQueue = SharedValue()
 Config = SharedValue()
 
 
-def WaitForExecution(pckInfo, fin_states=("SUCCESSFULL", "ERROR"), timeout=1.0):
-    while True:
-        pckInfo.update()
-        if pckInfo.state in fin_states:
-            break
+def WaitForExecution(pckInfo, fin_states=("SUCCESSFULL", "ERROR"), timeout=None):
+    """waits on the server side (pck_wait), current state is logged every timeout seconds if it is set"""
+    while pckInfo.Wait(fin_states, timeout) not in fin_states:
         logging.info("packet state: %s", pckInfo.state)
-        time.sleep(timeout)
     return pckInfo.state
 
 
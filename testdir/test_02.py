@@ -1,6 +1,8 @@
 from __future__ import print_function
 import unittest
 import logging
+import hashlib
+import os
 import time
 import tempfile
 import subprocess
@@ -52,6 +54,94 @@ class T02(unittest.TestCase):
         finally:
             pckInfo.Delete()
 
+    def testChunkedUpload(self):
+        pckname = "chunkedupload-%d" % self.timestamp
+        connector = remclient.Connector(self.connector.GetURL(), chunked_upload_threshold=1, upload_chunk_size=1000)
+        pck = connector.Packet(pckname, self.timestamp)
+        with tempfile.NamedTemporaryFile(dir=".", mode="w") as writer:
+            for i in range(10000):
+                print("line %d" % i, file=writer)
+            writer.flush()
+            pck.AddJob("wc -l data.txt | grep -q 10000", files={"data.txt": writer.name}, tries=1)
+        connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        pckInfo = connector.PacketInfo(pck.id)
+        self.assertEqual(WaitForExecution(pckInfo), "SUCCESSFULL")
+        pckInfo.Delete()
+
+    def testUploadLargeOffset(self):
+        server = Config.Get().server1
+        proxy = self.connector.proxy
+        checksum = hashlib.md5(("largeupload-%d" % self.timestamp).encode()).hexdigest()
+        self.assertEqual(proxy.binary_upload_begin(checksum), "0")
+        # sparse upload file pretends that more than 2GiB have been uploaded already
+        path = os.path.join(server.projectDir, server.binDir, checksum + ".upload")
+        offset = (1 << 31) + 1
+        with open(path, "r+b") as writer:
+            writer.truncate(offset)
+        try:
+            self.assertEqual(proxy.binary_upload_begin(checksum), str(offset))
+            self.assertEqual(proxy.binary_upload_append(checksum, str(offset), xmlrpc_client.Binary(b"x")),
+                             str(offset + 1))
+        finally:
+            os.unlink(path)
+
+    def testRangedFileReading(self):
+        pckname = "rangedfile-%d" % self.timestamp
+        pck = self.connector.Packet(pckname, self.timestamp)
+        pck.AddJob("seq 1 100000 > data.txt; sleep 3", tries=1)
+        self.connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        pckInfo = self.connector.PacketInfo(pck.id)
+        time.sleep(1.5)
+        expected = "".join("%d\n" % i for i in range(1, 100001))
+        data, offset, size = pckInfo.ReadFile("data.txt", tail=7)
+        self.assertEqual((data, offset, size), ("100000\n", len(expected) - 7, len(expected)))
+        self.assertEqual("".join(pckInfo.IterFile("data.txt", chunk_size=1000)), expected)
+        self.assertEqual(WaitForExecution(pckInfo), "SUCCESSFULL")
+        pckInfo.Delete()
+
+    def testLargeFileReading(self):
+        pckname = "largefile-%d" % self.timestamp
+        size = 3 << 30
+        pck = self.connector.Packet(pckname, self.timestamp)
+        pck.AddJob("truncate -s %d data.bin; sleep 3" % size, tries=1)
+        self.connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        pckInfo = self.connector.PacketInfo(pck.id)
+        time.sleep(1.5)
+        offset = (1 << 31) + 5
+        self.assertEqual(pckInfo.ReadFile("data.bin", offset, 10), (b"\0" * 10, offset, size))
+        self.assertEqual(pckInfo.ReadFile("data.bin", tail=4), (b"\0" * 4, size - 4, size))
+        self.assertEqual(WaitForExecution(pckInfo), "SUCCESSFULL")
+        pckInfo.Delete()
+
+    def testStatusPolling(self):
+        pckname = "statuspoll-%d" % self.timestamp
+        pck = self.connector.Packet(pckname, self.timestamp)
+        j1 = pck.AddJob("sleep 1")
+        pck.AddJob("echo done", parents=[j1])
+        self.connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        pckInfo = self.connector.PacketInfo(pck.id)
+        states = set()
+        while pckInfo.state not in ("SUCCESSFULL", "ERROR"):
+            states.add(tuple(sorted(job.state for job in pckInfo.jobs)))
+            time.sleep(0.1)
+            pckInfo.update()
+        self.assertEqual(pckInfo.state, "SUCCESSFULL")
+        self.assertEqual([job.state for job in pckInfo.jobs], ["done", "done"])
+        self.assertTrue(("suspended", "working") in states)
+        pckInfo.Delete()
+
+    def testPacketWait(self):
+        pckname = "pckwait-%d" % self.timestamp
+        pck = self.connector.Packet(pckname, self.timestamp)
+        pck.AddJob("sleep 3")
+        self.connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        pckInfo = self.connector.PacketInfo(pck.id)
+        start_time = time.time()
+        self.assertNotIn(pckInfo.Wait(timeout=1), ("SUCCESSFULL", "ERROR"))
+        self.assertTrue(time.time() - start_time < 2.5)
+        self.assertEqual(pckInfo.Wait(), "SUCCESSFULL")
+        pckInfo.Delete()
+
     def testWorkingPacket(self):
         pckname = "worktest-%d" % self.timestamp
         pck = self.connector.Packet(pckname, self.timestamp)
@@ -78,6 +168,22 @@ class T02(unittest.TestCase):
         self.assertEqual(self.connector.Tag(barriertag).Check(), True)
         pckInfo.Delete()
 
+    def testTagFanOut(self):
+        tagname = "fanouttag-%d" % self.timestamp
+        queue = self.connector.Queue(TestingQueue.Get())
+        pckList = []
+        for index in range(20):
+            pck = self.connector.Packet("fanoutpck-%d-%d" % (index, self.timestamp), self.timestamp,
+                                        wait_tags=[tagname])
+            pck.AddJob("true")
+            queue.AddPacket(pck)
+            pckList.append(self.connector.PacketInfo(pck.id))
+        self.connector.Tag(tagname).Set()
+        WaitForExecutionList(pckList)
+        for pck in pckList:
+            self.assertEqual(pck.state, "SUCCESSFULL")
+            pck.Delete()
+
     def testBulkAdding(self):
         pckList = []
         tagList = []
@@ -100,6 +206,18 @@ class T02(unittest.TestCase):
             self.assertEqual(pck.state, "SUCCESSFULL")
             pck.Delete()
 
+    def testStreamingPipeline(self):
+        pckname = "streaming-%d" % self.timestamp
+        pck = self.connector.Packet(pckname, self.timestamp)
+        j1 = pck.AddJob("seq 1 100000", tries=2)
+        j2 = pck.AddJob("wc -l", pipe_parents=[j1], tries=2, streaming=True, stream_tee=True)
+        j3 = pck.AddJob("grep -qx 100000", pipe_parents=[j2], tries=1)
+        self.connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        logging.info("packet %s(%s) added to queue %s, waiting until doing", pckname, pck.id, TestingQueue.Get())
+        pckInfo = self.connector.PacketInfo(pck.id)
+        self.assertEqual(WaitForExecution(pckInfo), "SUCCESSFULL")
+        pckInfo.Delete()
+
     def testBrokenPacket(self):
         pckname = "brktest-%d" % self.timestamp
         pck = self.connector.Packet(pckname, self.timestamp, notify_emails=[self.notifyEmail])
@@ -180,6 +298,9 @@ class T02(unittest.TestCase):
         bulkObj.Unset()
         self.assertEqual(len(tags), len(bulkObj.FilterUnset().GetTags()))
         self.assertEqual(0, len(bulkObj.FilterSet().GetTags()))
+        bulkObj.Set()
+        bulkObj.Reset()
+        self.assertEqual(len(tags), len(bulkObj.FilterUnset().GetTags()))
 
     def testMovePacket(self):
         pckname = "moving-packet-%d" % self.timestamp
@@ -2,7 +2,6 @@ import unittest
 import logging
 import time
 import six
-from six.moves import xmlrpc_client
 
 from testdir import Config, RestartService, TestingQueue, WaitForExecution, WaitForExecutionList
 
@@ -70,5 +69,41 @@ class T06(unittest.TestCase):
 
         self.RestartService()
         self.assertTrue(self.connector.Tag(tagname).Check())
-        self.assertRaises(xmlrpc_client.Fault, lambda: self.connector.PacketInfo(pck.id).state)
+        # packet is restored from packets journal
+        self.assertEqual("SUCCESSFULL", self.connector.PacketInfo(pck.id).state)
+        self.connector.PacketInfo(pck.id).Delete()
 
+    def testDurableTags(self):
+        tagname = "durabletag-%d" % self.timestamp
+        self.connector.proxy.set_backupable_state(False)
+        self.connector.Tag(tagname).Set(durable=True)
+        self.RestartService()
+        self.assertTrue(self.connector.Tag(tagname).Check())
+
+    def testPacketsJournal(self):
+        pckname = "journalpacket-%d" % self.timestamp
+        queue = self.connector.Queue(TestingQueue.Get())
+        workingLimit = queue.Status()["working-limit"]
+
+        self.connector.proxy.set_backupable_state(False)
+        pck = self.connector.Packet(pckname, self.timestamp)
+        pck.AddJob("true")
+        queue.AddPacket(pck)
+        self.connector.PacketInfo(pck.id).Suspend()
+        queue.ChangeWorkingLimit(workingLimit + 1)
+        time.sleep(1)
+
+        self.RestartService()
+        self.assertEqual("SUSPENDED", self.connector.PacketInfo(pck.id).state)
+        self.assertEqual(workingLimit + 1, queue.Status()["working-limit"])
+        queue.ChangeWorkingLimit(workingLimit)
+        self.connector.PacketInfo(pck.id).Delete()
+
+    def testRestoreProgress(self):
+        self.connector.proxy.do_backup()
+        self.RestartService()
+        queue = self.connector.Queue(TestingQueue.Get())
+        self.assertTrue(queue.Status())
+        progress = self.connector.proxy.get_restore_progress()
+        self.assertEqual("ready", progress["state"])
+        self.assertEqual(0, progress["broken-records"])
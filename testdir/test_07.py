@@ -1,7 +1,66 @@
 import unittest
+import marshal
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import signal
 import rem
 import six
 from six.moves import cPickle as pickle
+from six.moves import xmlrpc_client
+from rem import launcher, osspec
+from rem.callbacks import CallbackHolder
+from rem.context import Context
+from rem.launcher import JobsLauncher
+from rem.packet import JobPacket, PacketState
+from rem.queue import Queue
+from rem.reaper import ProcessReaper
+from rem.rpcserver import XMLRPCServer, detachable_method
+from rem.backups import ValidateSnapshot, SNAPSHOT_MAGIC, RECORD_HEADER
+from rem.scheduler import Scheduler, SchedWatcher
+from rem.snapshot import ObjectsEncoder, ObjectsDecoder
+from rem.storages import TagsCache, TagStorage
+from rem.waiters import PacketsWait, PacketsWaiter
+from rem.workers import SchedTimer, ThreadJobWorker
+
+CONFIG_TEMPLATE = """
+[DEFAULT]
+project_dir = %(project_dir)s
+[store]
+pck_dir = %%(project_dir)s/packets
+backup_dir = %%(project_dir)s/backups
+backup_period = 300
+backup_count = 10
+backup_child_max_working_time = 900
+incremental_backups_count = 3
+journal_lifetime = 3600
+binary_dir = %%(project_dir)s/bin
+binary_lifetime = 86400
+error_packet_lifetime = 604800
+success_packet_lifetime = 259200
+tags_db_file = %%(project_dir)s/backups/tags.db
+recent_tags_file = %%(project_dir)s/backups/recent_tags.db
+[log]
+dir = %%(project_dir)s/log
+[run]
+poolsize = 1
+[server]
+port = 0
+send_emails = no
+use_memory_profiler = no
+"""
+
+
+def CreateContext(projectDir):
+    cfgFile = os.path.join(projectDir, "rem.cfg")
+    with open(cfgFile, "w") as cfg:
+        cfg.write(CONFIG_TEMPLATE % {"project_dir": projectDir})
+    return Context(cfgFile, "test")
+
 
 class T07(unittest.TestCase):
     """Checking internal REM structures"""
@@ -16,3 +75,488 @@ class T07(unittest.TestCase):
         self.assertTrue(isinstance(wrapNew, rem.storages.TagWrapper))
         self.assertEqual(wrapNew.name, wrapOrig.name)
 
+    def testRPCServerConnections(self):
+        server = XMLRPCServer(1, ("", 0))
+        server.IDLE_CONNECTION_TIMEOUT = 0.5
+
+        @detachable_method
+        def fail(detach):
+            detach()
+            raise RuntimeError("detached call failure")
+
+        server.register_function(lambda: True, "ping")
+        server.register_function(fail, "fail")
+        server.Start()
+        defaultTimeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(5)
+        try:
+            url = "http://localhost:%d" % server.socket.getsockname()[1]
+            idle = socket.create_connection(("localhost", server.socket.getsockname()[1]))
+            proxy = xmlrpc_client.ServerProxy(url)
+            # idle connection is closed in spite of other clients activity
+            for _ in range(15):
+                self.assertTrue(proxy.ping())
+                time.sleep(0.1)
+            self.assertEqual(idle.recv(1), b"")
+            self.assertRaises(xmlrpc_client.Fault, xmlrpc_client.ServerProxy(url).fail)
+        finally:
+            socket.setdefaulttimeout(defaultTimeout)
+            server.Stop()
+
+    def testRPCServerBackpressure(self):
+        server = XMLRPCServer(1, ("", 0))
+        release = threading.Event()
+        server.register_function(lambda: release.wait(5) or True, "block")
+        server.Start()
+        try:
+            body = xmlrpc_client.dumps((), "block")
+            request = "POST /RPC2 HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+            clients = [socket.create_connection(("localhost", server.socket.getsockname()[1])) for _ in range(5)]
+            for client in clients:
+                client.sendall(request)
+            time.sleep(0.3)
+            # one call is processed, one is queued and the rest wait unread in their connections
+            self.assertEqual(server.calls.qsize(), 1)
+            self.assertEqual(len(server.stalled), 3)
+            release.set()
+            for client in clients:
+                client.settimeout(5)
+                self.assertTrue(client.recv(4096).startswith("HTTP/1.1 200"))
+                client.close()
+            self.assertEqual(len(server.stalled), 0)
+        finally:
+            release.set()
+            server.Stop()
+
+    def testPacketsWaiter(self):
+        class FakePacket(CallbackHolder):
+            def __init__(self, id, state):
+                CallbackHolder.__init__(self)
+                self.id = id
+                self.state = state
+
+        waiter = PacketsWaiter()
+        wakeups = []
+        processWaits = waiter.processWaits
+        waiter.processWaits = lambda: wakeups.append(time.time()) or processWaits()
+        waiter.start()
+        results = []
+        pck = FakePacket("pck-1", "PENDING")
+        waiter.Add(PacketsWait([pck], ["SUCCESSFULL"], time.time() + 60, results.append))
+        waiter.Add(PacketsWait([FakePacket("pck-2", "PENDING")], ["SUCCESSFULL"], time.time() + 0.3, results.append))
+        time.sleep(1.0)
+        self.assertEqual(results, [{"pck-2": "PENDING"}])
+        # waiter wakes up on new waits and deadlines only
+        self.assertTrue(len(wakeups) <= 4)
+        pck.state = "SUCCESSFULL"
+        pck.FireEvent("change")
+        time.sleep(0.1)
+        self.assertEqual(results[1:], [{"pck-1": "SUCCESSFULL"}])
+
+    def testDeltaBackupRestoring(self):
+        projectDir = tempfile.mkdtemp()
+        try:
+            sched = Scheduler(CreateContext(projectDir))
+            sched.tagRef.Restore(0)
+
+            def add_packet(name):
+                tag = sched.tagRef.AcquireTag(name + "-wait")
+                pck = JobPacket(name, 0, sched.context, [], wait_tags=[tag])
+                sched.RegisterNewPacket(pck, [tag])
+                sched.AddPacketToQueue("delta-queue", sched.tempStorage.PickPacket(pck.id))
+                return pck
+
+            add_packet("pck-full")
+            sched.RollBackup(force=True)
+            pck = add_packet("pck-delta")
+            sched.Queue("delta-queue").ChangeWorkingLimit(5)
+            sched.RollBackup()
+            backups = os.listdir(sched.backupDirectory)
+            self.assertEqual(len([name for name in backups if sched.CheckBackupFilename(name)]), 1)
+            self.assertEqual(len(sched.ListDeltaBackups()), 1)
+
+            restored = Scheduler(CreateContext(projectDir))
+            restored.LoadBackup(os.path.join(sched.backupDirectory, filter(sched.CheckBackupFilename, backups)[0]))
+            queue = restored.Queue("delta-queue", create=False)
+            self.assertEqual(queue.workingLimit, 5)
+            self.assertEqual(sorted(p.name for p in queue.ListAllPackets()), ["pck-delta", "pck-full"])
+            self.assertEqual(restored.GetPacket(pck.id).state, pck.state)
+        finally:
+            shutil.rmtree(projectDir)
+
+    def testTagsCacheLRU(self):
+        entrySize = len("tag-0") + TagsCache.ENTRY_OVERHEAD
+        cache = TagsCache(3 * entrySize)
+        for i in range(3):
+            cache.Put("tag-%d" % i, bool(i % 2))
+        self.assertEqual(cache.used, 3 * entrySize)
+        self.assertEqual(cache.Get("tag-0"), False)
+        # the least recently used entry is dropped
+        cache.Put("tag-3", True)
+        self.assertEqual(cache.used, 3 * entrySize)
+        self.assertEqual(cache.Get("tag-1"), None)
+        self.assertEqual(cache.Get("tag-0"), False)
+        # updating of an entry doesn't change used size
+        cache.Put("tag-0", True)
+        self.assertEqual(cache.used, 3 * entrySize)
+        self.assertEqual(cache.Get("tag-0"), True)
+        cache.Discard("tag-0")
+        cache.Discard("tag-0")
+        self.assertEqual(cache.used, 2 * entrySize)
+        self.assertEqual(cache.Get("tag-0"), None)
+        cache.Resize(entrySize)
+        self.assertEqual(cache.used, entrySize)
+        self.assertEqual(list(cache.items), ["tag-3"])
+
+    def testTagsCacheFill(self):
+        cache = TagsCache()
+        generation = cache.generation
+        cache.Fill("tag-read", False, generation)
+        self.assertEqual(cache.Get("tag-read"), False)
+        # state read from the file before a newer Put is thrown away
+        generation = cache.generation
+        cache.Put("tag-evicted", True)
+        cache.Fill("tag-evicted", False, generation)
+        cache.Fill("tag-other", False, generation)
+        self.assertEqual(cache.Get("tag-evicted"), True)
+        self.assertEqual(cache.Get("tag-other"), None)
+        cache.Fill("tag-evicted", False, cache.generation)
+        self.assertEqual(cache.Get("tag-evicted"), True)
+        self.assertEqual(cache.used, 2 * TagsCache.ENTRY_OVERHEAD + len("tag-read") + len("tag-evicted"))
+
+    def testTagsEviction(self):
+        projectDir = tempfile.mkdtemp()
+        evictionDelay = TagStorage.EVICTION_DELAY
+        TagStorage.EVICTION_DELAY = 0.3
+        sched = Scheduler(CreateContext(projectDir))
+        try:
+            sched.tagRef.Restore(0)
+            sched.tagsEvictor.start()
+            # the evictor has nothing to do and sleeps until candidates appear
+            time.sleep(0.1)
+            usedTag = sched.tagRef.AcquireTag("used-tag")
+            pck = JobPacket("pck-evictor", 0, sched.context, [], wait_tags=[usedTag])
+            sched.RegisterNewPacket(pck, [usedTag])
+            sched.tagRef.AcquireTag("unused-tag").Set()
+            del usedTag
+            time.sleep(0.6)
+            # tag with live listeners stays in memory, unused tag is written to the file
+            self.assertTrue("used-tag" in sched.tagRef.inmem_items)
+            self.assertFalse("unused-tag" in sched.tagRef.inmem_items)
+            self.assertEqual(sched.tagRef.infile_items["unused-tag"], TagStorage.SET_STATE)
+            self.assertTrue(sched.tagRef.CheckTag("unused-tag"))
+        finally:
+            sched.tagsEvictor.Kill()
+            sched.tagsEvictor.join()
+            TagStorage.EVICTION_DELAY = evictionDelay
+            shutil.rmtree(projectDir)
+
+    def startWatchedProcess(self, reaper, shell, **kws):
+        errReader, errWriter = os.pipe()
+        process = subprocess.Popen(["sh", "-c", shell], stderr=errWriter, close_fds=True, preexec_fn=os.setpgrp)
+        os.close(errWriter)
+        return reaper.Watch(process, errReader, **kws)
+
+    def testProcessReaperDeadlines(self):
+        reaper = ProcessReaper()
+        reaper.start()
+        notifications = []
+        startTime = time.time()
+        killed = self.startWatchedProcess(reaper, "sleep 10", kill_deadline=startTime + 0.3)
+        notified = self.startWatchedProcess(reaper, "echo error >&2; sleep 0.5",
+                                            notify_deadline=startTime + 0.2, kill_deadline=startTime + 10,
+                                            on_notify=lambda: notifications.append(time.time() - startTime))
+        self.assertNotEqual(killed.Wait(), 0)
+        self.assertTrue(killed.killed_by_timeout)
+        self.assertTrue(time.time() - startTime < 5)
+        # notification doesn't interrupt the process
+        self.assertEqual(notified.Wait(), 0)
+        self.assertFalse(notified.killed_by_timeout)
+        self.assertEqual(notified.GetErrors(), "error\n")
+        self.assertEqual(len(notifications), 1)
+        self.assertTrue(0.2 <= notifications[0] < 0.5)
+
+    def testProcessReaperBrokenWatch(self):
+        reaper = ProcessReaper()
+        processEvents = reaper.processEvents
+        calls = []
+        reaper.processEvents = lambda: calls.append(None) or processEvents()
+        reaper.start()
+        broken = self.startWatchedProcess(reaper, "sleep 10")
+
+        def poll():
+            raise OSError("process status is unavailable")
+        broken.process.poll = poll
+        os.killpg(broken.process.pid, 15)
+        broken.Wait()
+        # the broken watch is dropped and the reaper keeps working without spinning
+        self.assertEqual(self.startWatchedProcess(reaper, "true").Wait(), 0)
+        time.sleep(0.3)
+        self.assertTrue(len(calls) < 50)
+
+    def testSchedTimerDeadlines(self):
+        watcher = SchedWatcher()
+        timer = SchedTimer(watcher)
+        wakeups = []
+        popReadyTasks = watcher.PopReadyTasks
+        watcher.PopReadyTasks = lambda: wakeups.append(time.time()) or popReadyTasks()
+        timer.start()
+        try:
+            done = []
+            startTime = time.time()
+            watcher.AddTaskT(0.6, done.append, "far")
+            # nearer deadline wakes the sleeping timer up
+            watcher.AddTaskT(0.2, done.append, "near")
+            time.sleep(0.4)
+            task = watcher.GetTask()
+            self.assertTrue(task is not None)
+            task()
+            self.assertEqual(done, ["near"])
+            self.assertEqual(watcher.GetTask(), None)
+            time.sleep(0.4)
+            watcher.GetTask()()
+            self.assertEqual(done, ["near", "far"])
+            self.assertTrue(all(wakeup - startTime < 0.05 or abs(wakeup - startTime - 0.2) < 0.05
+                                or abs(wakeup - startTime - 0.6) < 0.05 for wakeup in wakeups))
+            self.assertTrue(len(wakeups) <= 5)
+        finally:
+            timer.Kill()
+            timer.join()
+
+        # tasks ready at the same deadline are run by all waiting workers at once
+        projectDir = tempfile.mkdtemp()
+        sched = Scheduler(CreateContext(projectDir))
+        sched.tagRef.Restore(0)
+        sched.Start()
+        timer = SchedTimer(sched.schedWatcher)
+        workers = [ThreadJobWorker(sched) for _ in range(3)]
+        for worker in workers + [timer]:
+            worker.start()
+        try:
+            finished = []
+
+            def task(mark):
+                time.sleep(0.3)
+                finished.append(mark)
+
+            time.sleep(0.1)
+            for i in range(3):
+                sched.schedWatcher.AddTaskT(0.2, task, i)
+            time.sleep(0.8)
+            self.assertEqual(sorted(finished), [0, 1, 2])
+            self.assertTrue(sched.schedWatcher.Empty())
+        finally:
+            sched.Stop()
+            for worker in workers + [timer]:
+                worker.Kill()
+            for worker in workers + [timer]:
+                worker.join()
+            shutil.rmtree(projectDir)
+
+    def testSnapshotSchemaEncoding(self):
+        projectDir = tempfile.mkdtemp()
+        try:
+            sched = Scheduler(CreateContext(projectDir))
+            sched.tagRef.Restore(0)
+            waitTag = sched.tagRef.AcquireTag("schema-wait-tag")
+            pck = JobPacket("pck-schema", 5, sched.context, ["user@localhost"], wait_tags=[waitTag])
+            first = pck.Add("echo first", [], [], None, 3, None, None, False, "first job", 60, 120, False)
+            pck.Add("cat", [first], [first], sched.tagRef.AcquireTag("schema-set-tag"), 1, 100, 5, True, "", 60, 120,
+                    True)
+            pck.customField = {"unknown": "to schema"}
+
+            encoder = ObjectsEncoder(lambda obj: pickle.dumps(obj, 2))
+            decoder = ObjectsDecoder(pickle.loads, lambda checksum: None)
+            record = marshal.loads(marshal.dumps(encoder.Encode(pck)))
+            self.assertEqual(record[0], "JobPacket")
+            restored = decoder.Decode(record)
+
+            for attr in ("id", "name", "priority", "state", "notify_emails", "waitTags", "edges", "customField"):
+                self.assertEqual(getattr(restored, attr), getattr(pck, attr))
+            self.assertEqual(sorted(restored.jobs), sorted(pck.jobs))
+            for jid, job in pck.jobs.iteritems():
+                restoredJob = restored.jobs[jid]
+                for attr in ("shell", "parents", "inputs", "maxTryCount", "max_err_len", "retry_delay", "pipe_fail", "description",
+                             "output_to_status"):
+                    self.assertEqual(getattr(restoredJob, attr), getattr(job, attr))
+                self.assertTrue(restoredJob.packetRef is restored)
+
+            tag = decoder.Decode(marshal.loads(marshal.dumps(encoder.Encode(rem.Tag("schema-tag")))))
+            self.assertEqual((type(tag), tag.name, tag.done), (rem.Tag, "schema-tag", False))
+        finally:
+            shutil.rmtree(projectDir)
+
+    def testSnapshotValidation(self):
+        projectDir = tempfile.mkdtemp()
+        try:
+            sched = Scheduler(CreateContext(projectDir))
+            sched.tagRef.Restore(0)
+            tag = sched.tagRef.AcquireTag("validation-wait-tag")
+            pck = JobPacket("pck-validation", 0, sched.context, [], wait_tags=[tag])
+            sched.RegisterNewPacket(pck, [tag])
+            sched.AddPacketToQueue("validation-queue", sched.tempStorage.PickPacket(pck.id))
+            sched.RollBackup(force=True)
+            filename = os.path.join(sched.backupDirectory,
+                                    filter(sched.CheckBackupFilename, os.listdir(sched.backupDirectory))[0])
+            ValidateSnapshot(filename)
+
+            with open(filename) as reader:
+                data = reader.read()
+            position = data.index("pck-validation")
+            corrupted = filename + ".corrupted"
+            with open(corrupted, "w") as writer:
+                writer.write(data[:position] + "P" + data[position + 1:])
+            self.assertRaisesRegexp(pickle.UnpicklingError, "checksum mismatch", ValidateSnapshot, corrupted)
+            with open(corrupted, "w") as writer:
+                writer.write(data[:-1])
+            self.assertRaisesRegexp(pickle.UnpicklingError, "truncated", ValidateSnapshot, corrupted)
+
+            # header of an older format must not let the snapshot skip the trailer check
+            header = marshal.dumps(("snapshot", {"version": 3}))
+            with open(corrupted, "w") as writer:
+                writer.write(SNAPSHOT_MAGIC + RECORD_HEADER.pack(len(header)) + header)
+            self.assertRaisesRegexp(pickle.UnpicklingError, "unsupported snapshot version", ValidateSnapshot, corrupted)
+        finally:
+            shutil.rmtree(projectDir)
+
+    def testQueuePacketsIndex(self):
+        projectDir = tempfile.mkdtemp()
+        try:
+            sched = Scheduler(CreateContext(projectDir))
+            sched.tagRef.Restore(0)
+            tag = sched.tagRef.AcquireTag("index-wait-tag")
+            pck = JobPacket("pck-index", 0, sched.context, [], wait_tags=[tag])
+            pck.Add("true", [], [], None, 1, None, None, False, "", 60, 120, False)
+            sched.RegisterNewPacket(pck, [tag])
+            sched.AddPacketToQueue("index-queue", sched.tempStorage.PickPacket(pck.id))
+            queue = sched.Queue("index-queue", create=False)
+
+            def views_of(pck):
+                return [view for view in Queue.VIEW_BY_ORDER if pck in getattr(queue, view)]
+
+            self.assertEqual(views_of(pck), [queue.getPacketsIndex()[pck]])
+            tag.Set()
+            self.assertEqual(queue.getPacketsIndex()[pck], "pending")
+            self.assertEqual(views_of(pck), ["pending"])
+            pck.UserSuspend()
+            self.assertEqual(queue.getPacketsIndex()[pck], "suspended")
+            self.assertEqual(views_of(pck), ["suspended"])
+            # index is rebuilt from views after restoring
+            index = dict(queue.getPacketsIndex())
+            queue.packetViews = None
+            self.assertEqual(queue.getPacketsIndex(), index)
+
+            queue.Remove(pck)
+            self.assertFalse(pck in queue.getPacketsIndex())
+            self.assertEqual(views_of(pck), [])
+            self.assertEqual(queue.ListPacketsPage()[0], [])
+        finally:
+            shutil.rmtree(projectDir)
+
+    def testConcatenatedInput(self):
+        workDir = tempfile.mkdtemp()
+        sendfile = osspec._sendfile
+        try:
+            contents = [os.urandom(osspec.FEED_CHUNK_SIZE + 12345), "", "short file\n", os.urandom(1000)]
+            filenames = []
+            for i, content in enumerate(contents):
+                filenames.append(os.path.join(workDir, "input-%d" % i))
+                with open(filenames[-1], "w") as writer:
+                    writer.write(content)
+            # sendfile() and read/write fallback are checked both
+            for _ in range(2):
+                reader = osspec.get_concatenated_input(filenames)
+                try:
+                    self.assertEqual(reader.read(), "".join(contents))
+                finally:
+                    reader.close()
+                osspec._sendfile = None
+        finally:
+            osspec._sendfile = sendfile
+            shutil.rmtree(workDir)
+
+    def stopLauncher(self, jobsLauncher):
+        # helper exits when the daemon's end of the socket is shut down
+        jobsLauncher.sock.shutdown(socket.SHUT_RDWR)
+        for _ in range(50):
+            if not jobsLauncher.IsAlive():
+                break
+            time.sleep(0.1)
+        self.assertFalse(jobsLauncher.IsAlive())
+
+    def testJobsLauncher(self):
+        workDir = tempfile.mkdtemp()
+        jobsLauncher = JobsLauncher()
+        jobsLauncher.Start()
+        try:
+            with open(os.path.join(workDir, "input"), "w") as writer:
+                writer.write("launcher input\n")
+            errReader, errWriter = os.pipe()
+            with open(os.path.join(workDir, "input")) as stdin, open(os.path.join(workDir, "output"), "w") as stdout:
+                process = jobsLauncher.Launch(["sh", "-c", "cat; pwd; echo error >&2; exit 3"],
+                                              stdin.fileno(), stdout.fileno(), errWriter, cwd=workDir)
+            os.close(errWriter)
+            with os.fdopen(errReader) as reader:
+                self.assertEqual(reader.read(), "error\n")
+            self.assertEqual(process.wait(), 3)
+            self.assertEqual(process.poll(), 3)
+            with open(os.path.join(workDir, "output")) as reader:
+                self.assertEqual(reader.read(), "launcher input\n%s\n" % os.path.realpath(workDir))
+
+            with open(os.devnull, "r+") as devnull:
+                fds = [devnull.fileno()] * 3
+                self.assertRaises(OSError, jobsLauncher.Launch, [os.path.join(workDir, "missing-binary")], *fds)
+
+                # job and all its descendants are in the separate process group
+                process = jobsLauncher.Launch(["sh", "-c", "sleep 30 & echo $! > child; wait"], *fds, cwd=workDir)
+                childFile = os.path.join(workDir, "child")
+                for _ in range(50):
+                    if os.path.exists(childFile) and os.path.getsize(childFile):
+                        break
+                    time.sleep(0.1)
+                with open(childFile) as reader:
+                    childPid = int(reader.read())
+                self.assertEqual(process.poll(), None)
+                self.assertEqual(os.getpgid(childPid), process.pid)
+                os.killpg(process.pid, signal.SIGKILL)
+                self.assertEqual(process.wait(), -signal.SIGKILL)
+                for _ in range(50):
+                    if not osspec.is_pid_alive(childPid) or open("/proc/%d/stat" % childPid).read().split()[2] == "Z":
+                        break
+                    time.sleep(0.1)
+                else:
+                    self.fail("child of the killed job is still running")
+        finally:
+            self.stopLauncher(jobsLauncher)
+            shutil.rmtree(workDir)
+
+    def testPacketWithJobsLauncher(self):
+        projectDir = tempfile.mkdtemp()
+        jobsLauncher = launcher.StartLauncher()
+        sched = Scheduler(CreateContext(projectDir))
+        sched.tagRef.Restore(0)
+        sched.Start()
+        worker = ThreadJobWorker(sched)
+        worker.start()
+        try:
+            resultFile = os.path.join(projectDir, "result")
+            pck = JobPacket("pck-launcher", 0, sched.context, [])
+            first = pck.Add("echo launched", [], [], None, 1, None, None, False, "", 60, 120, False)
+            pck.Add("tr a-z A-Z > %s" % resultFile, [first], [first], None, 1, None, None, False, "", 60, 120, False)
+            sched.RegisterNewPacket(pck, [])
+            sched.AddPacketToQueue("launcher-queue", sched.tempStorage.PickPacket(pck.id))
+            for _ in range(100):
+                if pck.state in (PacketState.SUCCESSFULL, PacketState.ERROR):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(pck.state, PacketState.SUCCESSFULL)
+            with open(resultFile) as reader:
+                self.assertEqual(reader.read(), "LAUNCHED\n")
+            self.assertEqual(jobsLauncher.nextRequestId, 2)
+        finally:
+            sched.Stop()
+            worker.Kill()
+            worker.join()
+            self.stopLauncher(jobsLauncher)
+            launcher._launcher = None
+            shutil.rmtree(projectDir)
@@ -95,6 +95,17 @@ class T10(unittest.TestCase):
         pckInfo = self.connector1.PacketInfo(pckMany.id)
         self.assertEqual(WaitForExecution(pckInfo, timeout=1.0), "SUCCESSFULL")
 
+    def testBulkRemoteTags(self):
+        tag = "bulk-remote-tag-%.0f" % time.time()
+        tags = ["%s-%d" % (tag, i) for i in range(300)]
+        pck = self.connector2.Packet("pck-%.0f" % time.time(),
+                                     wait_tags=[self.servername1 + ":" + tagname for tagname in tags])
+        self.connector2.Queue(TestingQueue.Get()).AddPacket(pck)
+        time.sleep(2)
+        self.connector1.TagsBulk(tags).Set()
+        pckInfo = self.connector2.PacketInfo(pck.id)
+        self.assertEqual(WaitForExecution(pckInfo), "SUCCESSFULL")
+
     def testSubscribing(self):
         tag1 = "subscription-tag-%.0f-1" % time.time()
         tag2 = "subscription-tag-%.0f-2" % time.time()
@@ -50,3 +50,90 @@ class T11(unittest.TestCase):
         packet = queue.ListPackets("all", prefix=pckname)[0]
         self.assertRaises(xmlrpc_client.Fault, lambda: packet.Suspend())
         self.assertRaises(xmlrpc_client.Fault, lambda: packet.Resume())
+
+    def testPaginatedListing(self):
+        """Test paginated packets listing in readonly interface"""
+        pckprefix = "readonlytest-pages-%d-" % self.timestamp
+        start_time = time.time() - 1
+        pcknames = [pckprefix + str(i) for i in range(5)]
+        for pckname in pcknames:
+            self._create_packet(pckname)
+        queue = self.readonly_connector.Queue(TestingQueue.Get())
+
+        listed, cursor = [], None
+        while True:
+            packets, cursor = queue.ListPackets("all", prefix=pckprefix, limit=2, cursor=cursor)
+            self.assertTrue(len(packets) <= 2)
+            listed.extend(pck.name for pck in packets)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(pcknames), listed)
+
+        updated, cursor = [], None
+        while True:
+            packets, cursor = queue.ListUpdated(start_time, limit=2, cursor=cursor)
+            updated.extend(pck.name for pck in packets)
+            if cursor is None:
+                break
+        self.assertTrue(set(pcknames) <= set(updated))
+        self.assertRaises(xmlrpc_client.Fault, queue.ListPackets, "all", prefix=pckprefix, limit=0)
+        self.assertRaises(xmlrpc_client.Fault, queue.ListUpdated, start_time, limit=0)
+
+    def testPaginatedTagsListing(self):
+        """Test paginated tags listing in readonly interface"""
+        tagprefix = "tag-readonlytest-pages-%d-" % self.timestamp
+        tagnames = [tagprefix + str(i) for i in range(5)]
+        self.connector.TagsBulk(tagnames[:3]).Set()
+        self.connector.TagsBulk(tagnames[3:]).Unset()
+
+        listed, cursor = [], None
+        while True:
+            tags, cursor = self.readonly_connector.ListTags(prefix=tagprefix, memory_only=False, limit=2, cursor=cursor)
+            self.assertTrue(len(tags) <= 2)
+            listed.extend(tuple(tag) for tag in tags)
+            if cursor is None:
+                break
+        self.assertEqual([(tagname, i < 3) for i, tagname in enumerate(tagnames)], listed)
+        self.assertRaises(xmlrpc_client.Fault, self.readonly_connector.ListTags, prefix=tagprefix, limit=0)
+
+    def testBulkStatus(self):
+        """Test bulk and query status methods in readonly interface"""
+        pckprefix = "readonlytest-status-%d-" % self.timestamp
+        start_time = time.time() - 1
+        pcknames = [pckprefix + str(i) for i in range(3)]
+        for pckname in pcknames:
+            self._create_packet(pckname)
+        queue = self.readonly_connector.Queue(TestingQueue.Get())
+        packets = queue.ListPackets("all", prefix=pckprefix)
+
+        statuses = self.readonly_connector.PacketsStatus(packets + ["nonexisted-packet"], fields=["name", "state"])
+        self.assertEqual(sorted(statuses), sorted(pck.pck_id for pck in packets))
+        self.assertEqual(sorted(status["name"] for status in statuses.values()), pcknames)
+        self.assertTrue(all(set(status) == set(["id", "name", "state"]) for status in statuses.values()))
+
+        rows = self.readonly_connector.QueryPackets(TestingQueue.Get(), name_prefix=pckprefix,
+                                                    modified_since=start_time, fields=["name"])
+        self.assertEqual(sorted(row["name"] for row in rows), pcknames)
+        rows = self.readonly_connector.QueryPackets(TestingQueue.Get(), state="ERROR", name_prefix=pckprefix)
+        self.assertEqual(rows, [])
+
+    def testEventsFeed(self):
+        """Test events reading in readonly interface"""
+        pckname = "readonlytest-events-%d" % self.timestamp
+        _, cursor, reset = self.readonly_connector.ReadEvents()
+        self.assertFalse(reset)
+        pck = self.connector.Packet(pckname, self.timestamp)
+        pck.AddJob("true")
+        self.connector.Queue(TestingQueue.Get()).AddPacket(pck)
+        self.assertEqual(WaitForExecution(self.connector.PacketInfo(pck.id)), "SUCCESSFULL")
+
+        events = []
+        while True:
+            page, cursor, reset = self.readonly_connector.ReadEvents(cursor, limit=10)
+            self.assertFalse(reset)
+            if not page:
+                break
+            events.extend(event for event in page if event["id"] == pck.id)
+        self.assertEqual([event["type"] for event in events if event["type"] != "packet_state"],
+                         ["job_start", "job_done"])
+        self.assertEqual(events[-1]["state"], "SUCCESSFULL")